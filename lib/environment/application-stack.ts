@@ -224,6 +224,80 @@ export class ApplicationStack extends cdk.Stack {
     });
     authFilter.node.addDependency(stackNamespace);
 
+    //Admission control: stamp inbound requests with the time the sidecar received them,
+    //so the services can tell how long a request queued before a worker picked it up
+    const requestStartFilter = cluster.addManifest(`RequestStartFilterManifest`, {
+      apiVersion: "networking.istio.io/v1alpha3",
+      kind: "EnvoyFilter",
+      metadata: {
+        name: "request-start",
+        namespace: this.namespace,
+      },
+      spec: {
+        configPatches: [
+          {
+            applyTo: "VIRTUAL_HOST",
+            match: {
+              context: "SIDECAR_INBOUND",
+            },
+            patch: {
+              operation: "MERGE",
+              value: {
+                request_headers_to_add: [
+                  {
+                    header: {
+                      key: "x-request-start",
+                      value: "t=%START_TIME(%s.%6f)%",
+                    },
+                    append_action: "OVERWRITE_IF_EXISTS_OR_ADD",
+                  },
+                ],
+              },
+            },
+          },
+        ],
+      },
+    });
+    requestStartFilter.node.addDependency(stackNamespace);
+
+    //Service-to-service calls: tell the services which workload sent a request. The header is
+    //replaced with the SPIFFE id of the mTLS peer, or removed when there is none, so callers
+    //cannot set it themselves
+    const peerPrincipalFilter = cluster.addManifest(`PeerPrincipalFilterManifest`, {
+      apiVersion: "networking.istio.io/v1alpha3",
+      kind: "EnvoyFilter",
+      metadata: {
+        name: "peer-principal",
+        namespace: this.namespace,
+      },
+      spec: {
+        configPatches: [
+          {
+            applyTo: "VIRTUAL_HOST",
+            match: {
+              context: "SIDECAR_INBOUND",
+            },
+            patch: {
+              operation: "MERGE",
+              value: {
+                request_headers_to_remove: ["x-peer-principal"],
+                request_headers_to_add: [
+                  {
+                    header: {
+                      key: "x-peer-principal",
+                      value: "%DOWNSTREAM_PEER_URI_SAN%",
+                    },
+                    append_action: "OVERWRITE_IF_EXISTS_OR_ADD",
+                  },
+                ],
+              },
+            },
+          },
+        ],
+      },
+    });
+    peerPrincipalFilter.node.addDependency(stackNamespace);
+
     const productStack = new ProductStack(this, `ProductStack`, {
       cluster: cluster,
       istioIngressGateway: istioIngressGateway,
@@ -270,6 +344,7 @@ export class ApplicationStack extends cdk.Stack {
         namespace: this.namespace,
         fulfillmentServiceDNS: fulfillmentStack.fulfillmentServiceDNS,
         fulfillmentServicePort: fulfillmentStack.fulfillmentServicePort,
+        productServiceDNS: productStack.productServiceDNS,
         applicationImageAsset: props.basicStack?.orderDockerImageAsset,
         sideCarImageAsset: sideCarImageAsset,
         tenantTier: tenantTier,
@@ -282,6 +357,7 @@ export class ApplicationStack extends cdk.Stack {
       });
       orderStack.node.addDependency(stackNamespace);
       orderStack.node.addDependency(fulfillmentStack);
+      orderStack.node.addDependency(productStack);
       this.orderServiceDNS = orderStack.orderServiceDNS;
       this.orderServicePort = orderStack.orderServicePort;
       this.orderDockerImageAsset = orderStack.orderDockerImageAsset;
@@ -3,28 +3,127 @@
 import os
 import json
 import time
-import requests
+import random
+import queue
+import threading
 import logging
-import boto3
-import jwt
-from shared.helper_functions import get_tenant_context
-from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
+from concurrent.futures import Future, ThreadPoolExecutor
+from shared.helper_functions import get_tenant_context, get_request_tenant_context, get_message_detail_with_tenant_context, get_shared_boto3_client, create_emf_log_with_tenant_context, init_logging, init_request_timing, init_request_deadlines, init_admission_control, warm_up
+from shared.fast_json import FastJSONProvider
 from flask import Flask, request
 
 logging.getLogger("boto").setLevel(logging.CRITICAL)
 app = Flask(__name__)
-app.logger.setLevel(logging.DEBUG)
+app.json = FastJSONProvider(app)
 event_bus_name = os.environ["EVENT_BUS_NAME"]
 event_source = os.environ["EVENT_SOURCE"]
 event_detail_type = os.environ["EVENT_DETAIL_TYPE"]
 service_name = os.environ["SERVICE_NAME"]
+init_logging(app, service_name)
+init_request_timing(app, service_name)
+init_request_deadlines(app)
+init_admission_control(app, service_name)
+publish_timeout_seconds = float(os.environ.get("EVENT_PUBLISH_TIMEOUT_SECONDS", "5"))
+max_fulfillment_batch_size = int(os.environ.get("MAX_FULFILLMENT_BATCH_SIZE", "100"))
 
 
-async def create_emf_log(service_name, metric_name, metric_value):
-    logger = create_metrics_logger()
-    logger.set_dimensions({"ServiceName": service_name})
-    logger.put_metric(metric_name, metric_value)
-    await logger.flush()
+# Groups the entries submitted by concurrent requests into PutEvents calls of
+# up to 10 entries, waiting at most linger_seconds for a batch to fill. Up to
+# concurrency batches are published at once, so a batch backing off between
+# retries does not hold up the others. Only the entries EventBridge reports
+# as failed are sent again. Submitting blocks once max_buffered entries are
+# waiting, so callers feel the backpressure.
+class EventBatcher():
+    max_batch_size = 10
+
+    def __init__(self, get_client, linger_seconds=0.01, max_buffered=1000, max_attempts=3, concurrency=4):
+        self.get_client = get_client
+        self.linger_seconds = linger_seconds
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.put_events_calls = 0
+        self._buffer = queue.Queue(maxsize=max_buffered)
+        self._lock = threading.Lock()
+        self._publisher_pid = None
+        self._executor = None
+        self._slots = None
+
+    def submit(self, entry, timeout=None):
+        self._ensure_publisher()
+        future = Future()
+        self._buffer.put((entry, future), timeout=timeout)
+        return future
+
+    def _ensure_publisher(self):
+        if self._publisher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._publisher_pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="event-sender")
+            self._slots = threading.Semaphore(self.concurrency)
+            self._publisher_pid = os.getpid()
+            threading.Thread(target=self._publish_loop, name="event-publisher", daemon=True).start()
+
+    def _publish_loop(self):
+        while True:
+            # the next batch keeps filling while every sender is busy
+            self._slots.acquire()
+            batch = [self._buffer.get()]
+            deadline = time.monotonic() + self.linger_seconds
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._buffer.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._executor.submit(self.publish, batch).add_done_callback(lambda _: self._slots.release())
+
+    def publish(self, batch):
+        for attempt in range(self.max_attempts):
+            try:
+                with self._lock:
+                    self.put_events_calls += 1
+                response = self.get_client().put_events(Entries=[entry for entry, _ in batch])
+            except Exception as e:
+                if attempt == self.max_attempts - 1:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    return
+            else:
+                failed = []
+                for (entry, future), result in zip(batch, response["Entries"]):
+                    if "ErrorCode" in result:
+                        failed.append((entry, future, result))
+                    else:
+                        future.set_result(result["EventId"])
+                if not failed:
+                    return
+                if attempt == self.max_attempts - 1:
+                    for _, future, result in failed:
+                        future.set_exception(Exception(f"{result['ErrorCode']}: {result.get('ErrorMessage')}"))
+                    return
+                batch = [(entry, future) for entry, future, _ in failed]
+            time.sleep(min(1.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+event_batcher = EventBatcher(
+    lambda: get_shared_boto3_client("events"),
+    linger_seconds=float(os.environ.get("EVENT_BATCH_LINGER_SECONDS", "0.01")),
+    max_buffered=int(os.environ.get("EVENT_BATCH_MAX_BUFFERED", "1000")),
+    concurrency=int(os.environ.get("EVENT_PUBLISH_CONCURRENCY", "4")),
+)
+
+
+def create_fulfillment_entry(order, tenant_context, authorization):
+    # IMPLEMENT BELOW: LAB3 assign me to message with tenant context
+    message_detail = get_message_detail_with_tenant_context({"order": order}, tenant_context, authorization)
+
+    return {
+        "Source": event_source,
+        "DetailType": event_detail_type,
+        "Detail": message_detail,
+        "EventBusName": event_bus_name
+    }
 
 
 @app.route("/fulfillments/health")
@@ -33,35 +132,68 @@ def health():
 
 
 @app.route("/fulfillments/<order_id>", methods=["POST"])
-async def postOrderFulfillment(order_id):
+def postOrderFulfillment(order_id):
     try:
         authorization = request.headers.get("Authorization", None)
         tenant_context = get_tenant_context(authorization)
         if tenant_context.tenant_id is None:
             return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
 
-        # IMPLEMENT BELOW: LAB3 assign me to message with tenant context
-        message_detail = None
-        
-        event_bus_client = boto3.client("events")
-        event_bus_client.put_events(
-            Entries=[
-                {
-                    "Source": event_source,
-                    "DetailType": event_detail_type,
-                    "Detail": message_detail,
-                    "EventBusName": event_bus_name
-                }
-            ]
-        )
-
-        app.logger.debug(
-            f"Message sent to event bus: {order_id}, tenant: {tenant_context.tenant_id}")
-        app.logger.debug(
-            f"Fulfillment complete: {order_id}, tenant: {tenant_context.tenant_id}")
-        await create_emf_log(service_name, "FulfillmentComplete", 1)
+        order = {**(request.get_json(silent=True) or {}), "order_id": order_id}
+        entry = create_fulfillment_entry(order, tenant_context, authorization)
+        try:
+            event_batcher.submit(entry, timeout=publish_timeout_seconds).result(timeout=publish_timeout_seconds)
+        except queue.Full:
+            return {"msg": "Too many pending fulfillment requests!"}, 503
+
+        app.logger.debug("Message sent to event bus: %s", order_id)
+        app.logger.debug("Fulfillment complete: %s", order_id)
+        create_emf_log_with_tenant_context(service_name, tenant_context, "FulfillmentComplete", 1)
         return {"msg": "Fulfillment successful", "order_id": order_id}, 200
 
     except Exception as e:
         app.logger.error(f"Exception raised! {e}")
         return {"msg": "Unable to submit fulfillment request!"}, 500
+
+
+@app.route("/fulfillments:batch", methods=["POST"])
+def postOrderFulfillments():
+    # the order service's outbox sends orders it retries without a token, see get_request_tenant_context
+    authorization = request.headers.get("Authorization", None)
+    tenant_context = get_request_tenant_context(request.headers)
+    if tenant_context.tenant_id is None:
+        return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
+
+    orders = (request.get_json(silent=True) or {}).get("orders", None)
+    if not isinstance(orders, list) or not all(isinstance(order, dict) and "order_id" in order for order in orders):
+        return {"msg": "\"orders\" must be a list of orders with an \"order_id\"!"}, 400
+    if len(orders) > max_fulfillment_batch_size:
+        return {"msg": f"At most {max_fulfillment_batch_size} orders can be fulfilled at once!"}, 400
+
+    futures = []
+    for order in orders:
+        try:
+            futures.append(event_batcher.submit(create_fulfillment_entry(order, tenant_context, authorization),
+                                                timeout=publish_timeout_seconds))
+        except queue.Full:
+            futures.append(None)
+
+    results = []
+    for order, future in zip(orders, futures):
+        try:
+            if future is None:
+                raise Exception("Too many pending fulfillment requests!")
+            future.result(timeout=publish_timeout_seconds)
+            results.append({"order_id": order["order_id"], "status": "fulfilled"})
+        except Exception as e:
+            app.logger.error(f"Exception raised! {e}")
+            results.append({"order_id": order["order_id"], "status": "failed"})
+
+    fulfilled = sum(1 for result in results if result["status"] == "fulfilled")
+    if fulfilled:
+        create_emf_log_with_tenant_context(service_name, tenant_context, "FulfillmentComplete", fulfilled)
+    app.logger.debug("Fulfilled %s of %s orders", fulfilled, len(orders))
+    return {"msg": "Fulfillment batch processed", "results": results}, 200
+
+
+warm_up(app, "/fulfillments/health", clients=["events"])
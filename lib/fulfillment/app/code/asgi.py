@@ -0,0 +1,19 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import time
+from a2wsgi import WSGIMiddleware
+from app import app as flask_app
+from shared.helper_functions import asgi_threads
+
+# Served by the uvicorn worker when GUNICORN_WORKER_PROFILE=async. The event
+# loop keeps many requests in flight per worker while the blocking boto3 and
+# requests calls of each request run on a pool of ASGI_THREADS threads.
+wsgi_app = WSGIMiddleware(flask_app, workers=asgi_threads)
+
+
+# Stamps X-Request-Start when the proxy has not, so that the time a request
+# waits for a free thread counts as queue delay for admission control.
+async def app(scope, receive, send):
+    if scope["type"] == "http" and not any(name == b"x-request-start" for name, _ in scope["headers"]):
+        scope = dict(scope, headers=[*scope["headers"], (b"x-request-start", f"t={time.time():.6f}".encode())])
+    await wsgi_app(scope, receive, send)
@@ -5,4 +5,5 @@ import { MicroserviceStackProps } from "./microservice-props";
 export interface OrderMicroserviceStackProps extends MicroserviceStackProps {
   fulfillmentServiceDNS: string;
   fulfillmentServicePort: number;
+  productServiceDNS: string;
 }
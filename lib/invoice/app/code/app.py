@@ -3,33 +3,65 @@
 import os
 import json
 import logging
-import sys
+import signal
+import threading
+import time
+import queue
 import requests
-import boto3
-import asyncio
-from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from decimal import Decimal
+from requests.adapters import HTTPAdapter
+from shared.helper_functions import create_emf_log_with_tenant_context, create_http_client, get_shared_boto3_client, get_tenant_context_from_message_detail, get_tenant_dimension_sets, metrics_aggregator
+from shared.resilient_http import deadline
+from shared.structured_logging import configure_logging, log_context
+from tenant_scheduler import DeficitRoundRobinScheduler, load_tier_weights
 
 product_endpoint = os.environ["PRODUCT_ENDPOINT"]
 service_name = os.environ["SERVICE_NAME"]
-logging.basicConfig(stream=sys.stdout)
+configure_logging(service_name)
 logger = logging.getLogger(service_name)
-logger.setLevel(logging.INFO)
 
-sqs_client = boto3.client("sqs")
 sqs_queue_url = os.environ["QUEUE_URL"]
 max_messages_to_read = 10
 wait_time_seconds = 20
+# long polls hold the connection open for wait_time_seconds, so the read timeout has to outlast them
+sqs_client = get_shared_boto3_client("sqs", read_timeout=wait_time_seconds + 10)
+invoice_workers = int(os.environ.get("INVOICE_WORKERS", "8"))
+invoice_receive_loops = int(os.environ.get("INVOICE_RECEIVE_LOOPS", "2"))
+visibility_timeout_seconds = int(os.environ.get("INVOICE_VISIBILITY_TIMEOUT_SECONDS", "30"))
+# the consumer runs as a KEDA ScaledJob, so by default it exits once the queue has been idle for a while; 0 keeps it running
+idle_exit_seconds = float(os.environ.get("INVOICE_IDLE_EXIT_SECONDS", "60"))
+delete_batch_linger_seconds = 0.5
+product_lookup_timeout_seconds = float(os.environ.get("PRODUCT_LOOKUP_TIMEOUT_SECONDS", "5"))
+product_lookup_max_retries = int(os.environ.get("PRODUCT_LOOKUP_MAX_RETRIES", "2"))
+product_lookup_concurrency = int(os.environ.get("PRODUCT_LOOKUP_CONCURRENCY", "8"))
+product_lookup_batch_size = int(os.environ.get("PRODUCT_LOOKUP_BATCH_SIZE", "100"))
+# a message that takes longer is left to become visible again
+message_deadline_seconds = float(os.environ.get("INVOICE_MESSAGE_DEADLINE_SECONDS", str(visibility_timeout_seconds / 2)))
+# messages are received ahead of the workers so they can be scheduled fairly across tenants
+fair_scheduling = os.environ.get("INVOICE_FAIR_SCHEDULING", "true").lower() == "true"
+buffered_messages = int(os.environ.get("INVOICE_BUFFERED_MESSAGES", "1000"))
+tenant_buffered_messages = int(os.environ.get("INVOICE_TENANT_BUFFERED_MESSAGES", "250"))
+tenant_concurrency = int(os.environ.get("INVOICE_TENANT_CONCURRENCY", str(max(1, invoice_workers // 2))))
+tier_weights = load_tier_weights(os.environ.get("INVOICE_TIER_WEIGHTS", None))
 
 
-async def create_emf_log(service_name, metric_name, metric_value):
-    logger = create_metrics_logger()
-    logger.set_dimensions({"ServiceName": service_name})
-    logger.put_metric(metric_name, metric_value)
-    await logger.flush()
+def create_product_client():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=product_lookup_concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return create_http_client(service_name, session, max_attempts=product_lookup_max_retries + 1)
 
 
-def receive_message_from_sqs(queue_url, max_messages=5):
-    response = sqs_client.receive_message(
+product_client = create_product_client()
+product_lookup_executor = ThreadPoolExecutor(max_workers=product_lookup_concurrency, thread_name_prefix="product-lookup")
+
+
+def receive_message_from_sqs(queue_url, max_messages=5, client=None):
+    response = (client or sqs_client).receive_message(
         QueueUrl=queue_url,
         AttributeNames=[
             "All"
@@ -38,59 +70,307 @@ def receive_message_from_sqs(queue_url, max_messages=5):
             "All"
         ],
         WaitTimeSeconds=wait_time_seconds,
+        VisibilityTimeout=visibility_timeout_seconds,
         MaxNumberOfMessages=max_messages
     )
     return response.get("Messages", [])
 
 
+def get_product_prices(product_ids, authorization):
+    url = f"http://{product_endpoint}/products:batchGet"
+    # products:batchGet is a read, so it is retried and hedged like a GET
+    response = product_client.post(
+        url=url,
+        headers={
+            "Authorization": authorization,
+        },
+        json={"productIds": product_ids},
+        timeout=product_lookup_timeout_seconds,
+        idempotent=True,
+        hedge=product_client.hedge,
+    )
+    if response.status_code != 200:
+        # pricing the products at 0 would acknowledge a wrong invoice; failing leaves the message for redelivery
+        logger.error(f"lookup for product_ids {product_ids} failed with status {response.status_code}")
+        raise Exception(f"product lookup returned {response.status_code}.")
+    response_json = response.json()
+    products = response_json.get("products", None)
+    if products is None:
+        logger.error(f"lookup for product_ids {product_ids} failed. Response from product service: {response_json}")
+        raise Exception("product data is None.")
+    return {product_id: float(product.get("price", 0)) for product_id, product in products.items()}
+
+
 def calculate_order_total(product_ids, authorization):
-    total_price = 0
-    for product_id in product_ids:
-        url = f"http://{product_endpoint}/products/{product_id}"
-        response = requests.get(
-            url=url,
-            headers={
-                "Authorization": authorization,
-            },
-        )
-        if response.status_code == 200:
-            response_json = response.json()
-            product_data = response.json().get("product", None)
-            if product_data is None:
-                logger.error(f"lookup for product_id {product_id} failed. Response from product service: {response_json}")
-                raise Exception("product data is None.")
-            total_price += float(product_data.get("price", 0))
-    return total_price
-
-
-async def main():
-    while True:
-        messages = receive_message_from_sqs(sqs_queue_url, max_messages=max_messages_to_read)
-            
-        if len(messages) < 1:
-            break
-
-        for message in messages:
-            message_body = json.loads(message["Body"])
-            message_detail = message_body.get("detail", {})
-            event = message_detail.get("event", {})
-            order = event.get("order", {})
-            product_ids = order.get("products", [])
-            
-            # IMPLEMENT BELOW: LAB3 assign me to tenant context from message_detail
-            tenant_context = None
-            
+    # each distinct product is priced once, in batches fetched concurrently, and weighted by how often it was ordered
+    quantities = Counter(product_ids)
+    distinct_ids = list(quantities)
+    batches = [distinct_ids[start:start + product_lookup_batch_size]
+               for start in range(0, len(distinct_ids), product_lookup_batch_size)]
+    prices = {}
+    # the lookups run within the deadline of the message
+    contexts = [copy_context() for _ in batches]
+    for batch_prices in product_lookup_executor.map(
+            lambda context, batch: context.run(get_product_prices, batch, authorization), contexts, batches):
+        prices.update(batch_prices)
+    return sum(prices.get(product_id, 0) * quantity for product_id, quantity in quantities.items())
+
+
+def calculate_line_items_total(line_items):
+    # prices were snapshotted when the order was created, so no lookups are needed
+    return float(sum(Decimal(str(line_item["unit_price"])) * int(line_item["quantity"]) for line_item in line_items))
+
+
+def process_message(message):
+    message_body = json.loads(message["Body"])
+    message_detail = message_body.get("detail", {})
+    event = message_detail.get("event", {})
+    order = event.get("order", {})
+    product_ids = order.get("products", [])
+
+    # IMPLEMENT BELOW: LAB3 assign me to tenant context from message_detail
+    tenant_context = get_tenant_context_from_message_detail(message_detail)
+
+    with log_context(tenantId=tenant_context.tenant_id, tenantTier=tenant_context.tenant_tier), deadline(message_deadline_seconds):
+        line_items = order.get("line_items", None)
+        if line_items is not None:
+            total_price = calculate_line_items_total(line_items)
+        else:
+            # only orders taken before their prices were snapshotted, every new order has line items
             authorization = message_detail.get("authorization", None)
             total_price = calculate_order_total(product_ids, authorization)
-            sqs_client.delete_message(QueueUrl=sqs_queue_url, ReceiptHandle=message["ReceiptHandle"])
-            
-            await create_emf_log(service_name, "InvoiceTotalPrice", total_price)
-            message_dict = {
-                "message": f"Invoice created for order {order['order_id']} with total price {total_price}",
-                "tenantTier": tenant_context.tenant_tier,
-                "tenantId": tenant_context.tenant_id
-            }
-            logger.info(json.dumps(message_dict))
+
+        create_emf_log_with_tenant_context(service_name, tenant_context, "InvoiceTotalPrice", total_price)
+        logger.info("Invoice created for order %s with total price %s", order["order_id"], total_price)
+
+
+def get_message_tenant_context(message):
+    try:
+        message_detail = json.loads(message["Body"]).get("detail", None) or {}
+    except (ValueError, AttributeError):
+        message_detail = {}
+    return get_tenant_context_from_message_detail(message_detail)
+
+
+def record_queue_wait(tenant_context, seconds):
+    metrics_aggregator.record("InvoiceQueueWait", seconds * 1000, get_tenant_dimension_sets(service_name, tenant_context),
+                              unit="Milliseconds")
+
+
+# Receives messages on several long-polling loops, schedules them across
+# tenants with a DeficitRoundRobinScheduler, processes them on a bounded worker
+# pool and acknowledges them with DeleteMessageBatch. Receive loops keep up to
+# buffered_messages received ahead of the workers, so a premium tenant's
+# invoice does not wait behind another tenant's burst. A tenant's messages
+# beyond tenant_buffered_messages go back to the queue, hidden for about as
+# long as its queued ones take, which lets the receive loops reach the
+# messages of other tenants behind them. Messages still queued or processing
+# close to their visibility timeout get it extended. How long each message
+# waited for a worker is reported per tenant. With fair_scheduling=False
+# messages are processed in the order they were received.
+class InvoiceConsumer():
+    def __init__(self, client, queue_url, process=process_message, workers=invoice_workers,
+                 receive_loops=invoice_receive_loops, idle_exit_seconds=idle_exit_seconds,
+                 fair_scheduling=fair_scheduling, buffered_messages=buffered_messages,
+                 tenant_buffered_messages=tenant_buffered_messages, tenant_concurrency=tenant_concurrency,
+                 tier_weights=tier_weights, on_queue_wait=record_queue_wait):
+        self.client = client
+        self.queue_url = queue_url
+        self.process = process
+        self.workers = workers
+        self.receive_loops = receive_loops
+        self.idle_exit_seconds = idle_exit_seconds
+        self.fair_scheduling = fair_scheduling
+        self.tenant_buffered_messages = tenant_buffered_messages
+        self.tenant_concurrency = tenant_concurrency
+        self.on_queue_wait = on_queue_wait
+        self.processed = 0
+        self.failed = 0
+        self.deleted = 0
+        self.deferred = 0
+        if fair_scheduling:
+            self._scheduler = DeficitRoundRobinScheduler(tier_weights, tenant_concurrency, tenant_buffered_messages)
+        else:
+            self._scheduler = DeficitRoundRobinScheduler(tenant_concurrency=workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="invoice-worker")
+        self._slots = threading.Semaphore(workers + buffered_messages)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._processing_seconds = 0.0
+        self._deferred_until = 0.0
+        self._acknowledgements = queue.Queue()
+        self._stopping = threading.Event()
+        self._last_activity = time.monotonic()
+
+    def run(self):
+        receivers = [threading.Thread(target=self._receive_loop, name=f"invoice-receiver-{i}")
+                     for i in range(self.receive_loops)]
+        acknowledger = threading.Thread(target=self._acknowledge_loop, name="invoice-acknowledger")
+        extender = threading.Thread(target=self._extend_visibility_loop, name="invoice-visibility", daemon=True)
+        for thread in receivers + [acknowledger, extender]:
+            thread.start()
+        for _ in range(self.workers):
+            self._executor.submit(self._work_loop)
+
+        while not self._stopping.wait(1):
+            now = time.monotonic()
+            with self._in_flight_lock:
+                # deferred messages are still to come back
+                idle = not self._in_flight and now > self._deferred_until and now - self._last_activity > self.idle_exit_seconds
+            if self.idle_exit_seconds > 0 and idle:
+                logger.info("Queue idle for %ss, shutting down", self.idle_exit_seconds)
+                self.stop()
+
+        for thread in receivers:
+            thread.join()
+        # the workers finish the messages already received, then exit
+        self._scheduler.close()
+        self._executor.shutdown(wait=True)
+        self._acknowledgements.put(None)
+        acknowledger.join()
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def _receive_loop(self):
+        while not self._stopping.is_set():
+            # wait for one free slot, then take any others that are free as well
+            if not self._slots.acquire(timeout=1):
+                continue
+            slots = 1
+            while slots < max_messages_to_read and self._slots.acquire(blocking=False):
+                slots += 1
+            try:
+                messages = receive_message_from_sqs(self.queue_url, max_messages=slots, client=self.client)
+            except Exception as e:
+                logger.error(f"Unable to receive messages: {e}")
+                messages = []
+                time.sleep(1)
+            for _ in range(slots - len(messages)):
+                self._slots.release()
+            now = time.monotonic()
+            with self._in_flight_lock:
+                if messages:
+                    self._last_activity = now
+                for message in messages:
+                    self._in_flight[message["ReceiptHandle"]] = now + visibility_timeout_seconds
+            deferred = []
+            for message in messages:
+                tenant_context = get_message_tenant_context(message)
+                tenant_id = tenant_context.tenant_id if self.fair_scheduling else None
+                if not self._scheduler.put(tenant_id, tenant_context.tenant_tier, (tenant_context, message)):
+                    deferred.append((tenant_context, message))
+            if deferred:
+                self._defer(deferred)
+
+    def _defer(self, entries):
+        # the tenant already has tenant_buffered_messages queued, hide these until those are
+        # about done, rounding down so they are back before the tenant runs out
+        with self._in_flight_lock:
+            for _, message in entries:
+                self._in_flight.pop(message["ReceiptHandle"], None)
+            drain_seconds = self.tenant_buffered_messages * self._processing_seconds / self.tenant_concurrency
+            hidden_seconds = min(visibility_timeout_seconds, max(1, int(drain_seconds)))
+            self._deferred_until = max(self._deferred_until, time.monotonic() + hidden_seconds)
+        for start in range(0, len(entries), 10):
+            batch = entries[start:start + 10]
+            request_entries = [{"Id": str(i), "ReceiptHandle": message["ReceiptHandle"], "VisibilityTimeout": hidden_seconds}
+                               for i, (_, message) in enumerate(batch)]
+            try:
+                self.client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=request_entries)
+            except Exception as e:
+                # they become visible again once their visibility timeout lapses
+                logger.error(f"Unable to defer {len(request_entries)} messages: {e}")
+        for tenant_context, _ in entries:
+            create_emf_log_with_tenant_context(service_name, tenant_context, "InvoiceDeferred", 1)
+            self._slots.release()
+        self.deferred += len(entries)
+
+    def _work_loop(self):
+        while True:
+            entry = self._scheduler.get()
+            if entry is None:
+                return
+            tenant_id, (tenant_context, message), queued_seconds = entry
+            try:
+                self.on_queue_wait(tenant_context, queued_seconds)
+                self._process(message)
+            finally:
+                self._scheduler.done(tenant_id)
+
+    def _process(self, message):
+        succeeded = False
+        started = time.monotonic()
+        try:
+            self.process(message)
+            succeeded = True
+            self._acknowledgements.put(message["ReceiptHandle"])
+        except Exception as e:
+            # leave the message on the queue, it becomes visible again once its timeout lapses
+            logger.error(f"Unable to process message {message.get('MessageId')}: {e}")
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(message["ReceiptHandle"], None)
+                self._last_activity = time.monotonic()
+                # moving average, used to tell how long deferred messages stay hidden
+                self._processing_seconds += (self._last_activity - started - self._processing_seconds) * 0.1
+                if succeeded:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+            self._slots.release()
+
+    def _acknowledge_loop(self):
+        stopping = False
+        while not stopping:
+            receipt_handles = []
+            deadline = time.monotonic() + delete_batch_linger_seconds
+            while len(receipt_handles) < 10:
+                try:
+                    receipt_handle = self._acknowledgements.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if receipt_handle is None:
+                    stopping = True
+                    break
+                receipt_handles.append(receipt_handle)
+            if receipt_handles:
+                self._delete_batch(receipt_handles)
+
+    def _delete_batch(self, receipt_handles):
+        entries = [{"Id": str(i), "ReceiptHandle": receipt_handle} for i, receipt_handle in enumerate(receipt_handles)]
+        try:
+            response = self.client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        except Exception as e:
+            logger.error(f"Unable to delete {len(entries)} messages: {e}")
+            return
+        self.deleted += len(response.get("Successful", []))
+        for failure in response.get("Failed", []):
+            logger.error(f"Unable to delete message {failure['Id']}: {failure.get('Message')}")
+
+    def _extend_visibility_loop(self):
+        while not self._stopping.wait(visibility_timeout_seconds / 3):
+            now = time.monotonic()
+            with self._in_flight_lock:
+                expiring = [receipt_handle for receipt_handle, deadline in self._in_flight.items()
+                            if deadline - now < visibility_timeout_seconds / 2]
+                for receipt_handle in expiring:
+                    self._in_flight[receipt_handle] = now + visibility_timeout_seconds
+            for start in range(0, len(expiring), 10):
+                entries = [{"Id": str(i), "ReceiptHandle": receipt_handle, "VisibilityTimeout": visibility_timeout_seconds}
+                           for i, receipt_handle in enumerate(expiring[start:start + 10])]
+                try:
+                    self.client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+                except Exception as e:
+                    logger.error(f"Unable to extend visibility of {len(entries)} messages: {e}")
+
+
+def main():
+    consumer = InvoiceConsumer(sqs_client, sqs_queue_url)
+    signal.signal(signal.SIGTERM, consumer.stop)
+    signal.signal(signal.SIGINT, consumer.stop)
+    consumer.run()
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
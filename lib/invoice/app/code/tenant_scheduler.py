@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import json
+import threading
+import time
+from collections import deque
+
+default_tier_weights = {"basic": 1, "advanced": 2, "premium": 4}
+
+
+# Hands out queued work across tenants with deficit round-robin. Tenants with
+# work waiting take turns; at the start of its turn a tenant's deficit grows by
+# its tier's weight and it takes one item per whole unit of deficit, so with
+# the default weights a premium tenant is served four times as often per round
+# as a basic one, however much either has queued. Tenants already running
+# tenant_concurrency items are passed over until one of them is done. put()
+# refuses an item once its tenant has max_queued_per_tenant waiting. Tenants of
+# a tier missing from tier_weights get the basic weight.
+class DeficitRoundRobinScheduler():
+    def __init__(self, tier_weights=None, tenant_concurrency=4, max_queued_per_tenant=None):
+        self.tier_weights = tier_weights or default_tier_weights
+        self.tenant_concurrency = tenant_concurrency
+        self.max_queued_per_tenant = max_queued_per_tenant
+        self._queues = {}
+        self._tiers = {}
+        self._deficits = {}
+        self._running = {}
+        self._active = deque()
+        self._head_credited = False
+        self._queued = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def weight_for(self, tenant_tier):
+        return self.tier_weights.get(tenant_tier, None) or self.tier_weights["basic"]
+
+    def put(self, tenant_id, tenant_tier, item):
+        with self._condition:
+            tenant_queue = self._queues.get(tenant_id, None)
+            if tenant_queue is None:
+                tenant_queue = self._queues[tenant_id] = deque()
+                self._deficits[tenant_id] = 0.0
+                self._active.append(tenant_id)
+            elif self.max_queued_per_tenant is not None and len(tenant_queue) >= self.max_queued_per_tenant:
+                return False
+            self._tiers[tenant_id] = tenant_tier
+            tenant_queue.append((item, time.monotonic()))
+            self._queued += 1
+            self._condition.notify()
+            return True
+
+    # Blocks for the next item, returned as (tenant_id, item, seconds it was
+    # queued). Returns None once the scheduler is closed and drained.
+    def get(self):
+        with self._condition:
+            while True:
+                entry = self._next()
+                if entry is not None:
+                    return entry
+                if self._closed and self._queued == 0:
+                    return None
+                self._condition.wait()
+
+    def done(self, tenant_id):
+        with self._condition:
+            running = self._running[tenant_id] - 1
+            if running:
+                self._running[tenant_id] = running
+            else:
+                del self._running[tenant_id]
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _next(self):
+        # gives up once every tenant with work waiting is at its concurrency cap
+        passed_over = 0
+        while self._active and passed_over < len(self._active):
+            tenant_id = self._active[0]
+            if self._running.get(tenant_id, 0) >= self.tenant_concurrency:
+                passed_over += 1
+            else:
+                passed_over = 0
+                if not self._head_credited:
+                    self._deficits[tenant_id] += self.weight_for(self._tiers[tenant_id])
+                    self._head_credited = True
+                if self._deficits[tenant_id] >= 1:
+                    return self._take(tenant_id)
+            self._active.rotate(-1)
+            self._head_credited = False
+        return None
+
+    def _take(self, tenant_id):
+        tenant_queue = self._queues[tenant_id]
+        item, queued_at = tenant_queue.popleft()
+        self._queued -= 1
+        self._deficits[tenant_id] -= 1
+        self._running[tenant_id] = self._running.get(tenant_id, 0) + 1
+        if not tenant_queue:
+            # an idle tenant does not keep its deficit for later
+            del self._queues[tenant_id], self._tiers[tenant_id], self._deficits[tenant_id]
+            self._active.popleft()
+            self._head_credited = False
+        return tenant_id, item, time.monotonic() - queued_at
+
+
+def load_tier_weights(value):
+    if not value:
+        return default_tier_weights
+    return {**default_tier_weights, **json.loads(value)}
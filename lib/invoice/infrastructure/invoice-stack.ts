@@ -101,7 +101,7 @@ export class InvoiceStack extends MicroserviceStack {
 
     invoiceServiceAccount.role.addToPrincipalPolicy(
       new iam.PolicyStatement({
-        actions: ["sqs:ReceiveMessage", "sqs:DeleteMessage"],
+        actions: ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:ChangeMessageVisibility"],
         resources: [invoiceQueue.queueArn],
       })
     );
@@ -41,7 +41,7 @@ export class WorkshopDashboardStack extends cdk.Stack {
           namespace: namespace,
           metricName: metric.metricName,
           dimensionsMap: { ServiceName: metric.serviceName },
-          statistic: cloudwatch.Stats.SAMPLE_COUNT,
+          statistic: cloudwatch.Stats.SUM,
           period: period,
         })
       );
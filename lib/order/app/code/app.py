@@ -1,22 +1,48 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
-import boto3
-import jwt
 import json
 import os
-import logging
-import requests
-import random
-from shared.helper_functions import get_tenant_context, get_boto3_resource
-from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
-from flask import Flask, request
-from boto3.dynamodb.conditions import Key
+import base64
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from shared.helper_functions import get_tenant_context, get_internal_tenant_headers, TenantContext, get_boto3_client, get_boto3_resource, get_shared_boto3_resource, create_emf_log_with_tenant_context, create_http_client, init_logging, init_request_timing, init_request_deadlines, init_admission_control, warm_up
+from shared.id_generator import new_id, first_id_at, last_id_at
+from shared.fast_json import FastJSONProvider, dumps_bytes, from_attribute_map, from_attribute_value
+from outbox import OutboxDispatcher, new_outbox_item, write_order_with_outbox, write_orders_with_outbox
+from flask import Flask, Response, request, stream_with_context
+from boto3.dynamodb.conditions import ConditionExpressionBuilder, Key
+from boto3.dynamodb.types import TypeSerializer
 
 app = Flask(__name__)
-app.logger.setLevel(logging.DEBUG)
+app.json = FastJSONProvider(app)
 table_name = os.environ["TABLE_NAME"]
 fulfillment_endpoint = os.environ["FULFILLMENT_ENDPOINT"]
+product_endpoint = os.environ["PRODUCT_ENDPOINT"]
+product_lookup_timeout_seconds = float(os.environ.get("PRODUCT_LOOKUP_TIMEOUT_SECONDS", "2"))
+product_lookup_batch_size = int(os.environ.get("PRODUCT_LOOKUP_BATCH_SIZE", "100"))
+outbox_table_name = os.environ["OUTBOX_TABLE_NAME"]
+outbox_lease_seconds = int(os.environ.get("OUTBOX_LEASE_SECONDS", "60"))
+fulfillment_timeout_seconds = float(os.environ.get("FULFILLMENT_TIMEOUT_SECONDS", "5"))
+max_order_write_attempts = 3
+max_order_batch_size = int(os.environ.get("MAX_ORDER_BATCH_SIZE", "1000"))
+order_batch_write_concurrency = int(os.environ.get("ORDER_BATCH_WRITE_CONCURRENCY", "8"))
 service_name = os.environ["SERVICE_NAME"]
+init_logging(app, service_name)
+init_request_timing(app, service_name)
+init_request_deadlines(app)
+init_admission_control(app, service_name)
+default_orders_page_size = int(os.environ.get("DEFAULT_ORDERS_PAGE_SIZE", "100"))
+max_orders_page_size = int(os.environ.get("MAX_ORDERS_PAGE_SIZE", "1000"))
+type_serializer = TypeSerializer()
+order_projection = {
+    "ProjectionExpression": "orderId, #name, description, products, lineItems",
+    "ExpressionAttributeNames": {"#name": "name"},
+}
+
+
+def new_order_id():
+    return new_id("ord-")
 
 
 class Order():
@@ -25,19 +51,77 @@ class Order():
     tenant_id: str
     description: str = None
     products: list
+    line_items: list = None
 
     def __init__(self, order_json):
-        self.order_id = f"ord-{random.randint(10000, 99999)}"
+        self.order_id = new_order_id()
         self.name = order_json["name"]
         self.description = order_json.get("description", "")
         self.products = order_json["products"]
 
 
-async def create_emf_log(service_name, metric_name, metric_value):
-    logger = create_metrics_logger()
-    logger.set_dimensions({"ServiceName": service_name})
-    logger.put_metric(metric_name, metric_value)
-    await logger.flush()
+class UnknownProductsError(Exception):
+    def __init__(self, product_ids):
+        super().__init__(f"Unknown products: {product_ids}")
+        self.product_ids = product_ids
+
+
+def get_product_prices(authorization, product_ids):
+    # one products:batchGet per product_lookup_batch_size distinct products
+    distinct_ids = list(dict.fromkeys(product_ids))
+    prices = {}
+    for start in range(0, len(distinct_ids), product_lookup_batch_size):
+        # products:batchGet only reads, so it is retried and hedged like a GET
+        response = product_client.post(
+            f"http://{product_endpoint}/products:batchGet",
+            json={"productIds": distinct_ids[start:start + product_lookup_batch_size]},
+            headers={"Authorization": authorization},
+            timeout=product_lookup_timeout_seconds,
+            idempotent=True,
+            hedge=product_client.hedge,
+        )
+        response.raise_for_status()
+        prices.update({product_id: str(product["price"]) for product_id, product in response.json()["products"].items()})
+    return prices
+
+
+def to_line_items(product_ids, prices):
+    quantities = Counter(product_ids)
+    missing = [product_id for product_id in quantities if product_id not in prices]
+    if missing:
+        raise UnknownProductsError(missing)
+    return [{"productId": product_id, "unitPrice": prices[product_id], "quantity": quantity}
+            for product_id, quantity in quantities.items()]
+
+
+def get_line_items(authorization, product_ids):
+    # snapshots the price of each product, so invoicing needs no lookups
+    return to_line_items(product_ids, get_product_prices(authorization, product_ids))
+
+
+def validate_order_json(order_json):
+    # returns what is wrong with an order of a batch, None when it is valid
+    if not isinstance(order_json, dict):
+        return "An order must be an object!"
+    if not isinstance(order_json.get("name", None), str):
+        return "\"name\" must be a string!"
+    if not isinstance(order_json.get("description", ""), str):
+        return "\"description\" must be a string!"
+    products = order_json.get("products", None)
+    if not isinstance(products, list) or not all(isinstance(product_id, str) for product_id in products):
+        return "\"products\" must be a list of product ids!"
+    return None
+
+
+def new_order_item(tenant_context, order, line_items):
+    return {
+        "tenantId": tenant_context.tenant_id,
+        "orderId": order.order_id,
+        "name": order.name,
+        "description": order.description,
+        "products": order.products,
+        "lineItems": line_items,
+    }
 
 
 @app.route("/orders/health")
@@ -45,6 +129,114 @@ def health():
     return {"message": "Status is Ok!"}
 
 
+def encode_cursor(last_evaluated_key):
+    if last_evaluated_key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, tenant_id):
+    last_evaluated_key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    # exactly the table's key, anything else would reach DynamoDB as an invalid ExclusiveStartKey
+    if not isinstance(last_evaluated_key, dict) or set(last_evaluated_key) != {"tenantId", "orderId"}:
+        raise ValueError("cursor is not an order key")
+    if not isinstance(last_evaluated_key["orderId"], str) or not last_evaluated_key["orderId"]:
+        raise ValueError("cursor is not an order key")
+    if last_evaluated_key["tenantId"] != tenant_id:
+        raise ValueError("cursor does not belong to this tenant")
+    return last_evaluated_key
+
+
+def to_line_item_dict(line_item):
+    return {
+        "product_id": line_item["productId"],
+        "unit_price": line_item["unitPrice"],
+        "quantity": int(line_item["quantity"]),
+    }
+
+
+def order_from_attributes(item):
+    # to_order_dict for the attribute-value maps of the low-level client
+    order_dict = {
+        "order_id": item["orderId"]["S"],
+        "name": item["name"]["S"],
+        "description": item["description"]["S"],
+        "products": from_attribute_value(item["products"]),
+    }
+    if "lineItems" in item:
+        order_dict["line_items"] = [{
+            "product_id": line_item["M"]["productId"]["S"],
+            "unit_price": line_item["M"]["unitPrice"]["S"],
+            "quantity": int(line_item["M"]["quantity"]["N"]),
+        } for line_item in item["lineItems"]["L"]]
+    return order_dict
+
+
+def to_order_dict(item):
+    order_dict = {
+        "order_id": item["orderId"],
+        "name": item["name"],
+        "description": item["description"],
+        "products": item["products"]
+    }
+    # orders created before prices were snapshotted have no line items
+    if "lineItems" in item:
+        order_dict["line_items"] = [to_line_item_dict(line_item) for line_item in item["lineItems"]]
+    return order_dict
+
+
+def parse_timestamp_ms(value):
+    # epoch seconds or an ISO 8601 timestamp, UTC unless it carries an offset
+    try:
+        timestamp_ms = int(float(value) * 1000)
+    except ValueError:
+        timestamp = datetime.fromisoformat(value)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        timestamp_ms = int(timestamp.timestamp() * 1000)
+    if not 0 <= timestamp_ms < 1 << 48:
+        raise ValueError("timestamp out of range")
+    return timestamp_ms
+
+
+def get_order_key_condition(tenant_id, since=None, until=None):
+    # order ids sort by creation time, so a time window is a range of the sort key
+    key_condition = Key("tenantId").eq(tenant_id)
+    if since is None and until is None:
+        return key_condition
+    since_ms = parse_timestamp_ms(since) if since is not None else 0
+    until_ms = parse_timestamp_ms(until) if until is not None else time.time_ns() // 1000000
+    if since_ms > until_ms:
+        raise ValueError("since is after until")
+    return key_condition & Key("orderId").between(first_id_at(since_ms, "ord-"), last_id_at(until_ms, "ord-"))
+
+
+def query_order_pages(dynamodb_client, key_condition, limit, exclusive_start_key=None):
+    # yields (items, last_evaluated_key) for each DynamoDB page until limit items have been read;
+    # items are the attribute-value maps of the low-level client, keys are plain values
+    expression = ConditionExpressionBuilder().build_expression(key_condition, is_key_condition=True)
+    query_kwargs = {
+        "TableName": table_name,
+        "KeyConditionExpression": expression.condition_expression,
+        "ProjectionExpression": order_projection["ProjectionExpression"],
+        "ExpressionAttributeNames": {**order_projection["ExpressionAttributeNames"], **expression.attribute_name_placeholders},
+        "ExpressionAttributeValues": {placeholder: type_serializer.serialize(value)
+                                      for placeholder, value in expression.attribute_value_placeholders.items()},
+    }
+    remaining = limit
+    while remaining > 0:
+        query_kwargs["Limit"] = remaining
+        if exclusive_start_key is not None:
+            query_kwargs["ExclusiveStartKey"] = {name: type_serializer.serialize(value)
+                                                 for name, value in exclusive_start_key.items()}
+        resp = dynamodb_client.query(**query_kwargs)
+        exclusive_start_key = from_attribute_map(resp["LastEvaluatedKey"]) if "LastEvaluatedKey" in resp else None
+        remaining -= len(resp["Items"])
+        yield resp["Items"], exclusive_start_key
+        if exclusive_start_key is None or remaining <= 0:
+            break
+
+
 @app.route("/orders")
 def getAllOrders():
     authorization = request.headers.get("Authorization", None)
@@ -53,30 +245,68 @@ def getAllOrders():
         return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
 
     try:
-        dynamodb_resource = get_boto3_resource("dynamodb", authorization)
-        order_table = dynamodb_resource.Table(table_name)
-        resp = order_table.query(
-            KeyConditionExpression=Key("tenantId").eq(tenant_context.tenant_id)
-        )
+        limit = min(int(request.args.get("limit", default_orders_page_size)), max_orders_page_size)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        cursor = request.args.get("next", None)
+        exclusive_start_key = decode_cursor(cursor, tenant_context.tenant_id) if cursor else None
+        key_condition = get_order_key_condition(
+            tenant_context.tenant_id, request.args.get("since", None), request.args.get("until", None))
+    except (ValueError, TypeError):
+        return {"msg": "Invalid \"limit\", \"next\", \"since\" or \"until\" parameter!"}, 400
+
+    try:
+        dynamodb_client = get_boto3_client("dynamodb", authorization)
+        pages = query_order_pages(dynamodb_client, key_condition, limit, exclusive_start_key)
 
-        items = resp["Items"]
-        list = []
+        if request.args.get("stream", "false").lower() == "true":
+            return Response(stream_with_context(stream_orders(pages)), mimetype="application/x-ndjson")
 
-        for item in items:
-            list.append({
-                "order_id": item["orderId"],
-                "name": item["name"],
-                "description": item["description"],
-                "products": item["products"]
-            })
+        items, last_evaluated_key = next(pages)
+        orders = [order_from_attributes(item) for item in items]
+        if last_evaluated_key is not None and len(orders) < limit:
+            # more pages to read, send each one as it arrives instead of holding the whole response
+            return Response(stream_with_context(stream_orders_document(orders, pages)), mimetype="application/json")
 
-        return {"msg": "GET successful!", "orders": list}, 200
+        return {"msg": "GET successful!", "orders": orders, "next": encode_cursor(last_evaluated_key)}, 200
 
     except Exception as e:
         app.logger.error(f"Exception raised! {e}")
         return {"msg": "Unable to get all orders!"}, 500
 
 
+def stream_orders_document(orders, pages):
+    # the same document as the buffered response, written one DynamoDB page at a time
+    yield b'{"msg":"GET successful!","orders":' + dumps_bytes(orders)[:-1]
+    separator = b"," if orders else b""
+    next_cursor = None
+    try:
+        for items, last_evaluated_key in pages:
+            if items:
+                yield separator + dumps_bytes([order_from_attributes(item) for item in items])[1:-1]
+                separator = b","
+            next_cursor = encode_cursor(last_evaluated_key)
+    except Exception as e:
+        # the status has been sent, cut the document short so the client sees it is incomplete
+        app.logger.error(f"Exception raised! {e}")
+        return
+    yield b'],"next":' + dumps_bytes(next_cursor) + b"}\n"
+
+
+def stream_orders(pages):
+    # one JSON document per line, written as each DynamoDB page arrives; the last line carries the cursor
+    next_cursor = None
+    try:
+        for items, last_evaluated_key in pages:
+            yield b"".join(dumps_bytes(order_from_attributes(item)) + b"\n" for item in items)
+            next_cursor = encode_cursor(last_evaluated_key)
+    except Exception as e:
+        app.logger.error(f"Exception raised! {e}")
+        yield dumps_bytes({"msg": "Unable to get all orders!"}) + b"\n"
+        return
+    yield dumps_bytes({"next": next_cursor}) + b"\n"
+
+
 @app.route("/orders/<order_id>")
 def getOrder(order_id):
     try:
@@ -88,20 +318,13 @@ def getOrder(order_id):
         dynamodb_resource = get_boto3_resource("dynamodb", authorization)
         order_table = dynamodb_resource.Table(table_name)
         resp = order_table.query(
-            KeyConditionExpression=Key("tenantId").eq(tenant_context.tenant_id) & Key("order_id").eq(order_id),
+            KeyConditionExpression=Key("tenantId").eq(tenant_context.tenant_id) & Key("orderId").eq(order_id),
         )
 
         if len(resp["Items"]) < 1:
             return {"msg": "Order not found!", "order_id": order_id}, 404
 
-        order_dict = {
-            "order_id": order_id,
-            "name": resp["Items"][0]["name"],
-            "description": resp["Items"][0]["description"],
-            "products": resp["Items"][0]["products"]
-        }
-
-        return {"msg": "GET successful!", "order_id": order_dict}, 200
+        return {"msg": "GET successful!", "order_id": to_order_dict(resp["Items"][0])}, 200
 
     except Exception as e:
         app.logger.error(f"Exception raised! {e}")
@@ -109,7 +332,7 @@ def getOrder(order_id):
 
 
 @app.route("/orders", methods=["POST"])
-async def postOrder():
+def postOrder():
     try:
         authorization = request.headers.get("Authorization", None)
         tenant_context = get_tenant_context(authorization)
@@ -117,25 +340,128 @@ async def postOrder():
             return {"message": "Unable to read \"tenant_id\" claim from JWT."}, 400
 
         order = Order(request.get_json())
+        try:
+            line_items = get_line_items(authorization, order.products)
+            order.line_items = [to_line_item_dict(line_item) for line_item in line_items]
+        except UnknownProductsError as e:
+            return {"msg": "Order contains unknown products!", "products": e.product_ids}, 400
+        except Exception as e:
+            # an order is only taken with its prices, the outbox may send it on without a token to look them up
+            app.logger.warning(f"Unable to snapshot prices of order {order.order_id}: {e}")
+            return {"msg": "Unable to price the order, please retry later."}, 503
         dynamodb_resource = get_boto3_resource("dynamodb", authorization)
-        order_table = dynamodb_resource.Table(table_name)
-        order_table.put_item(
-            Item={
-                "tenantId": tenant_context.tenant_id,
-                "orderId": order.order_id,
-                "name": order.name,
-                "description": order.description,
-                "products": order.products,
-            },
-        )
-        submitFulfillment(order, authorization, tenant_context, fulfillment_endpoint)
-        await create_emf_log(service_name, "OrderCreated", 1)
-        app.logger.debug(f"Order created: {order.order_id}, tenant: {tenant_context.tenant_id}")
+        for attempt in range(max_order_write_attempts):
+            order_item = new_order_item(tenant_context, order, line_items)
+            outbox_item = new_outbox_item(tenant_context, to_order_dict(order_item), outbox_lease_seconds)
+            if write_order_with_outbox(dynamodb_resource.meta.client, table_name, order_item, outbox_table_name, outbox_item):
+                break
+            if attempt == max_order_write_attempts - 1:
+                raise Exception(f"Unable to find a free order id after {max_order_write_attempts} attempts")
+            app.logger.warning(f"orderId {order.order_id} already exists, retrying with a new id")
+            order.order_id = new_order_id()
+        outbox_dispatcher.enqueue(outbox_item, authorization)
+        create_emf_log_with_tenant_context(service_name, tenant_context, "OrderCreated", 1)
+        app.logger.debug("Order created: %s", order.order_id)
         return {"msg": "Order created", "order": order.__dict__}, 200
     except Exception as e:
         app.logger.error(f"Exception raised! {e}")
         return {"msg": "Unable to save order!", "order": order.__dict__}, 500
 
+
+@app.route("/orders:batch", methods=["POST"])
+def postOrders():
+    authorization = request.headers.get("Authorization", None)
+    tenant_context = get_tenant_context(authorization)
+    if tenant_context.tenant_id is None:
+        return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
+
+    orders_json = (request.get_json(silent=True) or {}).get("orders", None)
+    if not isinstance(orders_json, list) or not orders_json:
+        return {"msg": "\"orders\" must be a non-empty list of orders!"}, 400
+    if len(orders_json) > max_order_batch_size:
+        return {"msg": f"At most {max_order_batch_size} orders can be created at once!"}, 400
+
+    # every order is validated and priced before anything is written
+    results = [None] * len(orders_json)
+    orders = []
+    for index, order_json in enumerate(orders_json):
+        error = validate_order_json(order_json)
+        if error is None:
+            orders.append((index, Order(order_json)))
+        else:
+            results[index] = {"index": index, "status": "invalid", "msg": error}
+    try:
+        prices = get_product_prices(authorization, [product_id for _, order in orders for product_id in order.products])
+    except Exception as e:
+        # orders are only taken with their prices, see postOrder
+        app.logger.warning(f"Unable to snapshot prices of {len(orders)} orders: {e}")
+        return {"msg": "Unable to price the orders, please retry later."}, 503
+
+    order_items = []
+    outbox_items = []
+    accepted = []
+    for index, order in orders:
+        try:
+            line_items = to_line_items(order.products, prices)
+        except UnknownProductsError as e:
+            results[index] = {"index": index, "status": "invalid", "msg": str(e)}
+            continue
+        order.line_items = [to_line_item_dict(line_item) for line_item in line_items]
+        order_item = new_order_item(tenant_context, order, line_items)
+        order_items.append(order_item)
+        outbox_items.append(new_outbox_item(tenant_context, to_order_dict(order_item), outbox_lease_seconds))
+        accepted.append((index, order))
+
+    try:
+        dynamodb_resource = get_boto3_resource("dynamodb", authorization)
+        failed = write_orders_with_outbox(dynamodb_resource.meta.client, table_name, order_items, outbox_table_name,
+                                          outbox_items, concurrency=order_batch_write_concurrency)
+    except Exception as e:
+        app.logger.error(f"Exception raised! {e}")
+        failed = {order.order_id for _, order in accepted}
+
+    for (index, order), outbox_item in zip(accepted, outbox_items):
+        if order.order_id in failed:
+            results[index] = {"index": index, "status": "failed", "msg": "Unable to save order!"}
+        else:
+            outbox_dispatcher.enqueue(outbox_item, authorization)
+            results[index] = {"index": index, "status": "created", "order": order.__dict__}
+    created = len(accepted) - len(failed)
+    if created:
+        create_emf_log_with_tenant_context(service_name, tenant_context, "OrderCreated", created)
+    app.logger.debug("Created %s of %s orders", created, len(orders_json))
+    return {"msg": "Order batch processed", "results": results}, 200
+
+
 # IMPLEMENT ME: LAB3 (submitFulfillment)
-def submitFulfillment(order, authorization, tenant_context, fulfillment_endpoint):
-    pass
+def submit_fulfillments(tenant_id, tenant_tier, authorization, orders):
+    # returns the fulfillment status of each order, in order
+    # not retried here, the outbox sends failed orders again
+    # without a token the fulfillment service takes the tenant from the headers of this service's call
+    headers = {"Content-Type": "application/json", **get_internal_tenant_headers(TenantContext(tenant_id, tenant_tier))}
+    if authorization is not None:
+        headers["Authorization"] = authorization
+    response = fulfillment_client.post(
+        f"http://{fulfillment_endpoint}/fulfillments:batch",
+        data=app.json.dumps({"orders": orders}),
+        headers=headers,
+        timeout=fulfillment_timeout_seconds,
+    )
+    response.raise_for_status()
+    return [result["status"] for result in response.json()["results"]]
+
+
+fulfillment_client = create_http_client(service_name)
+product_client = create_http_client(service_name)
+outbox_dispatcher = OutboxDispatcher(
+    lambda: get_shared_boto3_resource("dynamodb").Table(outbox_table_name),
+    submit_fulfillments,
+    batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", "25")),
+    concurrency=int(os.environ.get("OUTBOX_CONCURRENCY", "4")),
+    lease_seconds=outbox_lease_seconds,
+    sweep_interval_seconds=float(os.environ.get("OUTBOX_SWEEP_INTERVAL_SECONDS", "10")),
+)
+
+
+# the order routes use tenant-scoped dynamodb clients and resources, the outbox a shared resource
+warm_up(app, "/orders/health", clients=["dynamodb"], resources=["dynamodb"])
@@ -1,7 +1,50 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
+import os
+import sys
+import time
+
+wsgi_app = "app:app"
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+loglevel = os.environ.get("LOG_LEVEL", "info").lower()
+# GUNICORN_PRELOAD=true (the default) imports and warms up the app once in the
+# master and forks the workers from it, so they serve as soon as they start.
+# With false each worker loads the app itself.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# GUNICORN_WORKER_PROFILE=async serves asgi:app with uvicorn workers instead of
+# the default sync workers. Note that uvicorn workers do not call pre_request
+# and post_request, the Flask request hooks in the app time requests either way.
+if os.environ.get("GUNICORN_WORKER_PROFILE", "sync") == "async":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+
+
 def pre_request(worker, req):
+    req.started = time.perf_counter()
     if req.path == "/orders/health" and req.method == "GET":
         # skip logging health checks
         return
     worker.log.debug("%s %s" % (req.method, req.path))
+
+
+def post_request(worker, req, environ, resp):
+    if req.path == "/orders/health" and req.method == "GET":
+        return
+    elapsed_ms = (time.perf_counter() - req.started) * 1000
+    worker.log.debug("%s %s %s %.2fms" % (req.method, req.path, resp.status, elapsed_ms))
+
+
+def post_fork(server, worker):
+    # clients created before the fork share sockets with the master, drop them;
+    # the boto3 session and the botocore models it loaded are kept
+    shared_helpers = sys.modules.get("shared.helper_functions", None)
+    if shared_helpers is not None:
+        shared_helpers.boto3_factory.reset()
+
+
+def worker_exit(server, worker):
+    # write out metrics and consumption still buffered by the shared aggregators
+    from shared.helper_functions import metering_aggregator, metrics_aggregator
+    metrics_aggregator.close()
+    metering_aggregator.close()
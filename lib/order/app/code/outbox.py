@@ -0,0 +1,294 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import queue
+import contextvars
+import random
+import threading
+import time
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+parked_until = 1 << 48
+batch_write_max_items = 25
+# The sweepers query the keys-only index sweep_index_name of the outbox table,
+# partitioned by sweepBucket and sorted by claimedUntil, so a sweep reads only
+# the entries whose lease has passed. The buckets spread the index over
+# partitions; their count is part of the table's data and must not change.
+sweep_index_name = "sweep-index"
+sweep_bucket_count = 8
+
+
+def get_sweep_bucket(order_id):
+    return zlib.crc32(order_id.encode("utf-8")) % sweep_bucket_count
+
+
+# The tenant's bearer token is not stored: it expires long before the last
+# retry of an entry would use it.
+def new_outbox_item(tenant_context, order, lease_seconds):
+    return {
+        "tenantId": tenant_context.tenant_id,
+        "orderId": order["order_id"],
+        "tenantTier": tenant_context.tenant_tier,
+        "order": order,
+        "sweepBucket": get_sweep_bucket(order["order_id"]),
+        "attempts": 0,
+        "createdAt": int(time.time()),
+        "claimedUntil": int(time.time()) + lease_seconds,
+    }
+
+
+# Writes the order and its pending fulfillment in one transaction, so an
+# order is never stored without the record that gets it fulfilled. The order
+# must not exist yet; returns False when its key is already taken. client is
+# the client of a DynamoDB resource, which converts the items from Python types.
+def write_order_with_outbox(client, order_table_name, order_item, outbox_table_name, outbox_item):
+    try:
+        client.transact_write_items(TransactItems=[
+            {"Put": {
+                "TableName": order_table_name,
+                "Item": order_item,
+                "ConditionExpression": "attribute_not_exists(orderId)",
+            }},
+            {"Put": {"TableName": outbox_table_name, "Item": outbox_item}},
+        ])
+        return True
+    except ClientError as e:
+        reasons = e.response.get("CancellationReasons", [])
+        if e.response["Error"]["Code"] == "TransactionCanceledException" and reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+            return False
+        raise
+
+
+def batch_write(client, request_items, max_attempts=8):
+    # returns the writes still unprocessed after max_attempts, retried with backoff
+    for attempt in range(max_attempts):
+        request_items = client.batch_write_item(RequestItems=request_items).get("UnprocessedItems", {})
+        if not request_items or attempt == max_attempts - 1:
+            return request_items
+        time.sleep(min(1.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+# Writes many orders with BatchWriteItem, each in the same chunk as its
+# pending fulfillment, so up to batch_write_max_items // 2 orders per call and
+# concurrency calls at a time. BatchWriteItem is neither conditional nor
+# transactional: orders rely on their ids being unique, and an order whose
+# pair could not be written is deleted again. Returns the ids of the orders
+# that were not written.
+def write_orders_with_outbox(client, order_table_name, order_items, outbox_table_name, outbox_items, max_attempts=8,
+                             concurrency=8):
+    pairs_per_chunk = batch_write_max_items // 2
+
+    def write_chunk(start):
+        orders = order_items[start:start + pairs_per_chunk]
+        request_items = {
+            order_table_name: [{"PutRequest": {"Item": item}} for item in orders],
+            outbox_table_name: [{"PutRequest": {"Item": item}} for item in outbox_items[start:start + pairs_per_chunk]],
+        }
+        try:
+            unprocessed = batch_write(client, request_items, max_attempts)
+        except ClientError as e:
+            logger.error(f"Unable to write {len(orders)} orders: {e}")
+            return {item["orderId"] for item in orders}
+        return {write["PutRequest"]["Item"]["orderId"] for writes in unprocessed.values() for write in writes}
+
+    starts = range(0, len(order_items), pairs_per_chunk)
+    # each chunk runs in the caller's context, so its calls are timed and metered for the caller's tenant
+    contexts = [contextvars.copy_context() for _ in starts]
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(starts)))) as executor:
+        failed = set().union(*executor.map(lambda context, start: context.run(write_chunk, start), contexts, starts))
+    if failed:
+        delete_orders_with_outbox(client, order_table_name, outbox_table_name,
+                                  [item for item in order_items if item["orderId"] in failed], max_attempts)
+    return failed
+
+
+def delete_orders_with_outbox(client, order_table_name, outbox_table_name, order_items, max_attempts=8):
+    pairs_per_chunk = batch_write_max_items // 2
+    for start in range(0, len(order_items), pairs_per_chunk):
+        keys = [{"tenantId": item["tenantId"], "orderId": item["orderId"]}
+                for item in order_items[start:start + pairs_per_chunk]]
+        try:
+            unprocessed = batch_write(client, {
+                table_name: [{"DeleteRequest": {"Key": key}} for key in keys]
+                for table_name in (order_table_name, outbox_table_name)
+            }, max_attempts)
+        except ClientError as e:
+            unprocessed = {"error": str(e)}
+        if unprocessed:
+            logger.error(f"Unable to roll back orders {[key['orderId'] for key in keys]}: {unprocessed}")
+
+
+# Sends the pending fulfillments of the outbox table to the fulfillment
+# service. Entries written by this process are handed over in memory, with the
+# bearer token of the request that wrote them, and sent in batches of up to
+# batch_size orders per tenant and token, concurrency batches at a time,
+# retrying failed orders max_attempts times. Entries still failing, and
+# entries whose writer went away, are leased by claimedUntil: once it passes,
+# the sweeper of any worker claims them with a conditional update and sends
+# them again without a token, as the order service itself, backing off
+# exponentially per entry. After max_dispatch_attempts an entry is parked in
+# the table for an operator. An entry is deleted once it is fulfilled.
+# send_fulfillments(tenant_id, tenant_tier, authorization, orders) returns
+# the status of each order.
+class OutboxDispatcher():
+    def __init__(self, get_table, send_fulfillments, batch_size=25, concurrency=4, linger_seconds=0.05, max_attempts=3,
+                 max_dispatch_attempts=10, lease_seconds=60, sweep_interval_seconds=10, max_buffered=1000):
+        self.get_table = get_table
+        self.send_fulfillments = send_fulfillments
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.linger_seconds = linger_seconds
+        self.max_attempts = max_attempts
+        self.max_dispatch_attempts = max_dispatch_attempts
+        self.lease_seconds = lease_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.max_buffered = max_buffered
+        self.dispatched = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._executor = None
+
+    def enqueue(self, item, authorization=None):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((item, authorization))
+        except queue.Full:
+            # the entry is in the table, a sweeper sends it once its lease ends
+            logger.warning(f"Outbox buffer full, leaving {item['orderId']} to the sweeper")
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_buffered)
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox-sender")
+            self._pid = os.getpid()
+            threading.Thread(target=self._dispatch_loop, name="outbox-dispatcher", daemon=True).start()
+            if self.sweep_interval_seconds > 0:
+                threading.Thread(target=self._sweep_loop, name="outbox-sweeper", daemon=True).start()
+
+    def _dispatch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger_seconds
+            while len(batch) < self.batch_size * self.concurrency:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.dispatch(batch)
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+
+    # entries are (item, authorization) pairs, authorization may be None
+    def dispatch(self, entries):
+        groups = {}
+        for item, authorization in entries:
+            groups.setdefault((item["tenantId"], item.get("tenantTier", None), authorization), []).append(item)
+        chunks = [(sender, group[start:start + self.batch_size])
+                  for sender, group in groups.items()
+                  for start in range(0, len(group), self.batch_size)]
+        if self._executor is None or len(chunks) == 1:
+            for sender, chunk in chunks:
+                self._dispatch_chunk(sender, chunk)
+            return
+        for future in [self._executor.submit(self._dispatch_chunk, sender, chunk) for sender, chunk in chunks]:
+            future.result()
+
+    def _dispatch_chunk(self, sender, items):
+        failed = self._send(sender, items)
+        failed_ids = {id(item) for item in failed}
+        self._delete([item for item in items if id(item) not in failed_ids])
+        for item in failed:
+            self._release(item)
+
+    def _send(self, sender, items):
+        tenant_id, tenant_tier, authorization = sender
+        pending = items
+        for attempt in range(self.max_attempts):
+            try:
+                statuses = self.send_fulfillments(tenant_id, tenant_tier, authorization, [item["order"] for item in pending])
+                pending = [item for item, status in zip(pending, statuses) if status != "fulfilled"]
+            except Exception as e:
+                logger.warning(f"Sending {len(pending)} fulfillments failed: {e}")
+            if not pending or attempt == self.max_attempts - 1:
+                return pending
+            time.sleep(min(1.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def _delete(self, items):
+        if not items:
+            return
+        with self.get_table().batch_writer() as batch:
+            for item in items:
+                batch.delete_item(Key={"tenantId": item["tenantId"], "orderId": item["orderId"]})
+        with self._lock:
+            self.dispatched += len(items)
+
+    def _release(self, item):
+        attempts = int(item.get("attempts", 0)) + 1
+        if attempts >= self.max_dispatch_attempts:
+            logger.error(f"Giving up on fulfillment of {item['orderId']}, tenant: {item['tenantId']}")
+            claimed_until = parked_until
+        else:
+            claimed_until = int(time.time() + min(3600, self.lease_seconds * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0))
+        with self._lock:
+            self.failed += 1
+        self.get_table().update_item(
+            Key={"tenantId": item["tenantId"], "orderId": item["orderId"]},
+            UpdateExpression="SET claimedUntil = :claimed_until, attempts = :attempts",
+            ExpressionAttributeValues={":claimed_until": claimed_until, ":attempts": attempts},
+        )
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval_seconds * random.uniform(0.5, 1.5))
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Outbox sweep failed: {e}")
+
+    def sweep(self):
+        self._ensure_started()
+        now = int(time.time())
+        claimed = 0
+        for bucket in range(sweep_bucket_count):
+            query_kwargs = {
+                "IndexName": sweep_index_name,
+                "KeyConditionExpression": Key("sweepBucket").eq(bucket) & Key("claimedUntil").lt(now),
+            }
+            while True:
+                resp = self.get_table().query(**query_kwargs)
+                for key in resp["Items"]:
+                    item = self._claim(key, now)
+                    if item is not None:
+                        self._queue.put((item, None))
+                        claimed += 1
+                if "LastEvaluatedKey" not in resp:
+                    break
+                query_kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+        return claimed
+
+    def _claim(self, key, now):
+        # only one worker wins an expired lease, and reads the entry the index does not project
+        try:
+            return self.get_table().update_item(
+                Key={"tenantId": key["tenantId"], "orderId": key["orderId"]},
+                UpdateExpression="SET claimedUntil = :claimed_until",
+                ConditionExpression="claimedUntil = :seen",
+                ExpressionAttributeValues={":claimed_until": now + self.lease_seconds, ":seen": key["claimedUntil"]},
+                ReturnValues="ALL_NEW",
+            )["Attributes"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return None
+            raise
@@ -25,6 +25,7 @@ export class OrderStack extends MicroserviceStack {
     const cluster = props.cluster;
     const istioIngressGateway = props.istioIngressGateway;
     const fulfillmentServiceDNS = props.fulfillmentServiceDNS;    
+    const productServiceDNS = props.productServiceDNS;
     const baseImage = props.baseImage;
 
     const tenantTier = props.tenantTier;
@@ -66,6 +67,26 @@ export class OrderStack extends MicroserviceStack {
       tableName: `SaaSMicroservices-Orders-${namespace}`,
     });
 
+    // pending fulfillments, written with each order and drained by the order service
+    const outboxTable = new dynamodb.Table(this, "OrderOutboxTable", {
+      partitionKey: { name: "tenantId", type: dynamodb.AttributeType.STRING },
+      sortKey: { name: "orderId", type: dynamodb.AttributeType.STRING },
+      readCapacity: 5,
+      writeCapacity: 5,
+      billingMode: dynamodb.BillingMode.PROVISIONED,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      tableName: `SaaSMicroservices-OrderOutbox-${namespace}`,
+    });
+    // the sweepers query the entries whose lease has passed, see sweep_index_name in outbox.py
+    outboxTable.addGlobalSecondaryIndex({
+      indexName: "sweep-index",
+      partitionKey: { name: "sweepBucket", type: dynamodb.AttributeType.NUMBER },
+      sortKey: { name: "claimedUntil", type: dynamodb.AttributeType.NUMBER },
+      projectionType: dynamodb.ProjectionType.KEYS_ONLY,
+      readCapacity: 5,
+      writeCapacity: 5,
+    });
+
     const orderServiceAccount = cluster.addServiceAccount(
       "OrderServiceAccount",
       {
@@ -99,8 +120,8 @@ export class OrderStack extends MicroserviceStack {
       new iam.Policy(this, "OrderAccessPolicy", {
         statements: [
           new iam.PolicyStatement({
-            actions: ["dynamodb:query", "dynamodb:PutItem"],
-            resources: [orderTable.tableArn],
+            actions: ["dynamodb:query", "dynamodb:PutItem", "dynamodb:BatchWriteItem"],
+            resources: [orderTable.tableArn, outboxTable.tableArn],
             conditions: {
               "ForAllValues:StringLike": {
                 "dynamodb:LeadingKeys": [`\${aws:PrincipalTag/TenantID}`],
@@ -111,6 +132,22 @@ export class OrderStack extends MicroserviceStack {
       })
     );
 
+    // the outbox dispatcher works across tenants with the service account's own role
+    orderServiceAccount.role.attachInlinePolicy(
+      new iam.Policy(this, "OrderOutboxDispatchPolicy", {
+        statements: [
+          new iam.PolicyStatement({
+            actions: ["dynamodb:UpdateItem", "dynamodb:BatchWriteItem", "dynamodb:DeleteItem"],
+            resources: [outboxTable.tableArn],
+          }),
+          new iam.PolicyStatement({
+            actions: ["dynamodb:Query"],
+            resources: [`${outboxTable.tableArn}/index/sweep-index`],
+          }),
+        ],
+      })
+    );
+
     if(props.policyStoreArn) {
       orderServiceAccount.role.attachInlinePolicy(
         new iam.Policy(this, "AccessPolicyStoreFromSideCar", {
@@ -203,6 +240,14 @@ export class OrderStack extends MicroserviceStack {
                     name: "FULFILLMENT_ENDPOINT",
                     value: fulfillmentServiceDNS,
                   },
+                  {
+                    name: "PRODUCT_ENDPOINT",
+                    value: productServiceDNS,
+                  },
+                  {
+                    name: "OUTBOX_TABLE_NAME",
+                    value: outboxTable.tableName,
+                  },
                 ]),
                 ports: [
                   {
@@ -1,18 +1,46 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 import os
-import logging
 import random
-import boto3
-# from shared.helper_functions import get_tenant_context
+import time
+from shared.helper_functions import get_tenant_context, get_shared_boto3_resource, create_emf_log_with_tenant_context, metrics_aggregator, init_logging, init_request_timing, init_request_deadlines, init_admission_control, put_new_item, warm_up
+from shared.id_generator import new_id
+from shared.tenant_cache import SharedTenantCache, default_cache_path
+from shared.fast_json import FastJSONProvider
 from botocore.exceptions import ClientError
-from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
 from flask import Flask, request
 from boto3.dynamodb.conditions import Key
 app = Flask(__name__)
-app.logger.setLevel(logging.DEBUG)
+app.json = FastJSONProvider(app)
 table_name = os.environ["TABLE_NAME"]
 service_name = os.environ["SERVICE_NAME"]
+init_logging(app, service_name)
+init_request_timing(app, service_name)
+init_request_deadlines(app)
+init_admission_control(app, service_name)
+max_batch_get_products = int(os.environ.get("MAX_BATCH_GET_PRODUCTS", "300"))
+batch_get_item_chunk_size = 100
+batch_get_item_max_attempts = 5
+
+
+def report_product_cache_stats(tenant_id, hits, misses, evictions, size):
+    dimension_sets = [{"ServiceName": service_name}, {"ServiceName": service_name, "Tenant": tenant_id}]
+    metrics_aggregator.increment("ProductCacheHit", hits, dimension_sets)
+    metrics_aggregator.increment("ProductCacheMiss", misses, dimension_sets)
+    metrics_aggregator.increment("ProductCacheEviction", evictions, dimension_sets)
+    metrics_aggregator.record("ProductCacheBytes", size, dimension_sets[1:], unit="Bytes")
+
+
+product_cache = SharedTenantCache(
+    os.environ.get("PRODUCT_CACHE_PATH", default_cache_path("product-cache")),
+    ttl_seconds=float(os.environ.get("PRODUCT_CACHE_TTL_SECONDS", "60")),
+    tenant_quota_bytes=int(os.environ.get("PRODUCT_CACHE_TENANT_QUOTA_BYTES", "1048576")),
+    report=report_product_cache_stats,
+)
+
+
+def new_product_id():
+    return new_id("prod-")
 
 
 class Product():
@@ -22,57 +50,114 @@ class Product():
     price: str
 
     def __init__(self, product_json):
-        self.product_id = f"prod-{random.randint(10000, 99999)}"
+        self.product_id = new_product_id()
         self.name = product_json["name"]
         self.description = product_json.get("description", "")
         self.price = str(float(product_json["price"]))
 
 
-async def create_emf_log(service_name, metric_name, metric_value):
-    logger = create_metrics_logger()
-    logger.set_dimensions({"ServiceName": service_name})
-    logger.put_metric(metric_name, metric_value)
-    await logger.flush()
-
-
 @app.route("/products/health")
 def health():
     return {"message": "Status is Ok!"}
 
 
+def to_product_dict(item):
+    return {
+        "productId": item["productId"],
+        "name": item["name"],
+        "description": item["description"],
+        "price": item["price"],
+    }
+
+
+def batch_get_products(dynamodb_resource, tenant_id, product_ids):
+    products = {}
+    for start in range(0, len(product_ids), batch_get_item_chunk_size):
+        keys = [{"tenantId": tenant_id, "productId": product_id}
+                for product_id in product_ids[start:start + batch_get_item_chunk_size]]
+        request_items = {table_name: {"Keys": keys}}
+        for attempt in range(batch_get_item_max_attempts):
+            resp = dynamodb_resource.batch_get_item(RequestItems=request_items)
+            for item in resp["Responses"].get(table_name, []):
+                products[item["productId"]] = to_product_dict(item)
+            request_items = resp.get("UnprocessedKeys", {})
+            if not request_items:
+                break
+            time.sleep(min(1.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+        else:
+            raise Exception(f"BatchGetItem left unprocessed keys after {batch_get_item_max_attempts} attempts")
+    return products
+
+
 @app.route("/products/<product_id>")
 def getProduct(product_id):
     # PASTE: LAB1 (GET route tenant context)
+    authorization = request.headers.get("Authorization", None)
+    tenant_context = get_tenant_context(authorization)
+    if tenant_context.tenant_id is None:
+        return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
 
     try:
-        dynamodb_resource = boto3.resource("dynamodb")
-        product_table = dynamodb_resource.Table(table_name)
+        product_dict = product_cache.get(tenant_context.tenant_id, product_id)
+        if product_dict is None:
+            dynamodb_resource = get_shared_boto3_resource("dynamodb")
+            product_table = dynamodb_resource.Table(table_name)
+
+            # REPLACE START: LAB1 (query DynamoDB with tenant context)
+            resp = product_table.query(
+                KeyConditionExpression=Key("tenantId").eq(tenant_context.tenant_id) & Key("productId").eq(product_id)
+            )
+            # REPLACE END: LAB1 (query DynamoDB with tenant context)
+
+            if len(resp["Items"]) < 1:
+                return {"msg": "Product not found!", "product_id": product_id}, 404
+
+            product_dict = to_product_dict(resp["Items"][0])
+            product_cache.put(tenant_context.tenant_id, product_id, product_dict)
+        return {"msg": "GET successful!", "product": product_dict}, 200
 
-        # REPLACE START: LAB1 (query DynamoDB with tenant context)
-        resp = product_table.query(
-            KeyConditionExpression=Key("productId").eq(product_id)
-        )
-        # REPLACE END: LAB1 (query DynamoDB with tenant context)
+    except Exception as e:
+        app.logger.error(f"Exception: {e}")
+        return {"msg": "Unable to get product!", "product_id": product_id}, 500
 
-        if len(resp["Items"]) < 1:
-            return {"msg": "Product not found!", "product_id": product_id}, 404
 
-        product_dict = {
-            "productId": product_id,
-            "name": resp["Items"][0]["name"],
-            "description": resp["Items"][0]["description"],
-            "price": resp["Items"][0]["price"],
-        }
-        return {"msg": "GET successful!", "product": product_dict}, 200
+@app.route("/products:batchGet", methods=["POST"])
+def batchGetProducts():
+    authorization = request.headers.get("Authorization", None)
+    tenant_context = get_tenant_context(authorization)
+    if tenant_context.tenant_id is None:
+        return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
+
+    product_ids = (request.get_json(silent=True) or {}).get("productIds", None)
+    if not isinstance(product_ids, list) or not all(isinstance(product_id, str) for product_id in product_ids):
+        return {"msg": "\"productIds\" must be a list of product ids!"}, 400
+    product_ids = list(dict.fromkeys(product_ids))
+    if len(product_ids) > max_batch_get_products:
+        return {"msg": f"At most {max_batch_get_products} product ids can be requested at once!"}, 400
+
+    try:
+        products = product_cache.get_many(tenant_context.tenant_id, product_ids)
+        uncached = [product_id for product_id in product_ids if product_id not in products]
+        if uncached:
+            dynamodb_resource = get_shared_boto3_resource("dynamodb")
+            fetched = batch_get_products(dynamodb_resource, tenant_context.tenant_id, uncached)
+            product_cache.put_many(tenant_context.tenant_id, fetched)
+            products.update(fetched)
+        missing = [product_id for product_id in product_ids if product_id not in products]
+        return {"msg": "GET successful!", "products": products, "missing": missing}, 200
 
     except Exception as e:
         app.logger.error(f"Exception: {e}")
-        return {"msg": "Unable to get product!", "product_id": product_id}, 500
+        return {"msg": "Unable to get products!"}, 500
 
 
 @app.route("/products", methods=["POST"])
-async def postProduct():
+def postProduct():
     # PASTE: LAB1 (post tenant context)
+    authorization = request.headers.get("Authorization", None)
+    tenant_context = get_tenant_context(authorization)
+    if tenant_context.tenant_id is None:
+        return {"msg": "Unable to read \"tenantId\" claim from JWT."}, 400
 
     try:
         product = Product(request.get_json())
@@ -81,22 +166,27 @@ async def postProduct():
         return {"message": "Error reading product!"}, 400
 
     try:
-        dynamodb_resource = boto3.resource("dynamodb")
+        dynamodb_resource = get_shared_boto3_resource("dynamodb")
         product_table = dynamodb_resource.Table(table_name)
 
         # REPLACE START: LAB1 (DynamoDB put_item with tenant context)
-        product_table.put_item(
-            Item={
+        product.product_id = put_new_item(
+            product_table,
+            {
+                "tenantId": tenant_context.tenant_id,
                 "productId": product.product_id,
                 "name": product.name,
                 "description": product.description,
                 "price": str(product.price),
             },
+            "productId",
+            new_product_id,
         )
         # REPLACE END: LAB1 (DynamoDB put_item with tenant context)
+        product_cache.invalidate(tenant_context.tenant_id, product.product_id)
 
-        app.logger.debug(f"Product created: {product.product_id}")
-        await create_emf_log(service_name, "ProductCreated", 1)
+        app.logger.debug("Product created: %s", product.product_id)
+        create_emf_log_with_tenant_context(service_name, tenant_context, "ProductCreated", 1)
         return {"msg": "Product created", "product": product.__dict__}, 201
 
     except Exception as e:
@@ -104,3 +194,6 @@ async def postProduct():
         return {"msg": "Unable to create product", "product": product.__dict__}, 500
 
 # IMPLEMENT ME: LAB1 (GET /products)
+
+
+warm_up(app, "/products/health", resources=["dynamodb"])
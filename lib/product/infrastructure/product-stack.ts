@@ -30,13 +30,16 @@ export class ProductStack extends MicroserviceStack {
     // PASTE: LAB1(tenant context tags)
 
     // REPLACE START: LAB1 (product table)
-    const productTable = new dynamodb.Table(this, "ProductTable", {
-      partitionKey: { name: "productId", type: dynamodb.AttributeType.STRING },
+    // keyed by tenant under a new id and name: CloudFormation cannot replace
+    // the named SaaSMicroservices-Products table with a different key in place
+    const productTable = new dynamodb.Table(this, "TenantProductTable", {
+      partitionKey: { name: "tenantId", type: dynamodb.AttributeType.STRING },
+      sortKey: { name: "productId", type: dynamodb.AttributeType.STRING },
       readCapacity: 5,
       writeCapacity: 5,
       billingMode: dynamodb.BillingMode.PROVISIONED,
       removalPolicy: cdk.RemovalPolicy.DESTROY,
-      tableName: `SaaSMicroservices-Products`,
+      tableName: `SaaSMicroservices-TenantProducts`,
     });
     // REPLACE END: LAB1 (product table)
 
@@ -82,7 +85,7 @@ export class ProductStack extends MicroserviceStack {
       new iam.Policy(this, "ProductServicePolicy", {
         statements: [
           new iam.PolicyStatement({
-            actions: ["dynamodb:query", "dynamodb:PutItem"],
+            actions: ["dynamodb:query", "dynamodb:PutItem", "dynamodb:BatchGetItem"],
             resources: [productTable.tableArn],
           }),
         ],
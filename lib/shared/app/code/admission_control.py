@@ -0,0 +1,94 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import json
+import threading
+import time
+from shared.tenant_cache import connect_shared_database
+
+default_tier_limits = {
+    "basic": {"rate": 20, "burst": 40, "max_queue_delay_ms": 50},
+    "advanced": {"rate": 100, "burst": 200, "max_queue_delay_ms": 200},
+    "premium": {"rate": 500, "burst": 1000, "max_queue_delay_ms": 1000},
+}
+
+
+# Token buckets kept in an SQLite database on tmpfs, so every worker process
+# of the pod draws from the same bucket for a key. Each pod has its own
+# /dev/shm, so the buckets, and the limits, are per pod. Refilling and taking a
+# token is a single statement, which SQLite applies atomically.
+class SharedTokenBuckets():
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        connection = connect_shared_database(self.path, [
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL,"
+            " updated_at REAL NOT NULL) WITHOUT ROWID",
+        ])
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    # Returns 0 when a token was taken, otherwise the seconds until one is available.
+    def acquire(self, key, rate, burst):
+        now = time.time()
+        connection = self._connection()
+        taken = connection.execute(
+            "INSERT INTO buckets VALUES (:key, :burst - 1, :now) ON CONFLICT (key) DO UPDATE SET"
+            " tokens = MIN(:burst, tokens + (:now - updated_at) * :rate) - 1, updated_at = :now"
+            " WHERE MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1 RETURNING tokens",
+            {"key": key, "rate": rate, "burst": burst, "now": now}).fetchone()
+        if taken is not None:
+            return 0
+        row = connection.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return 0
+        tokens = min(burst, row[0] + (now - row[1]) * rate)
+        return max(0.0, (1 - tokens) / rate)
+
+
+# Decides whether a tenant's request may run. Requests are shed first when the
+# time they waited before reaching the app exceeds their tier's
+# max_queue_delay_ms, so lower tiers give way before higher tiers notice the
+# load, and then limited to their tenant's token bucket (rate per second,
+# burst). Tenants of a tier missing from tier_limits get the basic limits.
+class AdmissionController():
+    def __init__(self, buckets, tier_limits=None):
+        self.buckets = buckets
+        self.tier_limits = tier_limits or default_tier_limits
+
+    def limits_for(self, tenant_tier):
+        return self.tier_limits.get(tenant_tier, None) or self.tier_limits["basic"]
+
+    # Returns (decision, retry_after_seconds), decision being "admitted", "shed" or "throttled".
+    def admit(self, tenant_context, queue_delay_seconds=None):
+        limits = self.limits_for(tenant_context.tenant_tier)
+        if queue_delay_seconds is not None and queue_delay_seconds * 1000 > limits["max_queue_delay_ms"]:
+            return "shed", 1
+        retry_after = self.buckets.acquire(tenant_context.tenant_id, limits["rate"], limits["burst"])
+        if retry_after > 0:
+            return "throttled", retry_after
+        return "admitted", 0
+
+
+def load_tier_limits(value):
+    if not value:
+        return default_tier_limits
+    return {**default_tier_limits, **json.loads(value)}
+
+
+# Seconds since the request start stamped into the X-Request-Start header
+# by the proxy in front of the app, as "t=<epoch seconds>"; None when absent.
+def get_queue_delay(request_start_header, now=None):
+    if not request_start_header:
+        return None
+    try:
+        started = float(request_start_header.removeprefix("t="))
+    except ValueError:
+        return None
+    return max(0.0, (now or time.time()) - started)
@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+from shared.request_timing import current_request_timer
+
+read_operations = {"GetItem", "BatchGetItem", "Query", "Scan", "TransactGetItems"}
+throttle_error_codes = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
+unattributed_tenant = "_unattributed"
+
+
+def _current_tenant():
+    timer = current_request_timer.get()
+    tenant_context = timer.tenant_context if timer is not None else None
+    if tenant_context is None or tenant_context.tenant_id is None:
+        return unattributed_tenant, "unknown"
+    return tenant_context.tenant_id, tenant_context.tenant_tier or "unknown"
+
+
+def _primary_table(params):
+    if "TableName" in params:
+        return params["TableName"]
+    for table_name in params.get("RequestItems", {}):
+        return table_name
+    for transact_item in params.get("TransactItems", []):
+        for request in transact_item.values():
+            return request.get("TableName", None)
+    return None
+
+
+# Meters what each tenant consumes of DynamoDB. Every call of a registered
+# client asks for ReturnConsumedCapacity=TOTAL unless the caller set it, and
+# the capacity units, requests, payload bytes and throttled attempts are
+# counted per tenant, tier and table in a MetricsAggregator, so each flush
+# writes one EMF document per tenant and table. Calls made outside a request,
+# like the outbox sweeps, are counted for the _unattributed tenant.
+class ConsumptionMeter():
+    def __init__(self, aggregator, service_name, enabled=True):
+        self.aggregator = aggregator
+        self.service_name = service_name
+        self.enabled = enabled
+
+    def register(self, client):
+        if not self.enabled or client.meta.service_model.service_name != "dynamodb":
+            return client
+        events = client.meta.events
+        # ahead of the handler of boto3 resources that replaces params with a copy
+        events.register_first("provide-client-params.dynamodb", self._provide_client_params)
+        events.register("before-call.dynamodb", self._before_call)
+        events.register("needs-retry.dynamodb", self._needs_retry)
+        events.register("after-call.dynamodb", self._after_call)
+        return client
+
+    def _provide_client_params(self, params, model, context, **kwargs):
+        if "ReturnConsumedCapacity" in model.input_shape.members:
+            params.setdefault("ReturnConsumedCapacity", "TOTAL")
+        context["metering_table"] = _primary_table(params)
+
+    def _before_call(self, params, context, **kwargs):
+        context["metering_request_bytes"] = len(params.get("body", None) or b"")
+
+    def _needs_retry(self, response, operation, request_dict, **kwargs):
+        if response is None:
+            return None
+        _, parsed = response
+        if parsed.get("Error", {}).get("Code", None) in throttle_error_codes:
+            self._count(request_dict["context"].get("metering_table", None), [("DynamoDBThrottles", 1, "Count")])
+        return None
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        table_name = context.get("metering_table", None)
+        self._count(table_name, [
+            ("DynamoDBRequests", 1, "Count"),
+            ("DynamoDBRequestBytes", context.get("metering_request_bytes", 0), "Bytes"),
+            ("DynamoDBResponseBytes", len(http_response.content or b""), "Bytes"),
+        ])
+        consumed = parsed.get("ConsumedCapacity", None)
+        if consumed is None:
+            return
+        metric_name = "DynamoDBReadCapacityUnits" if model.name in read_operations else "DynamoDBWriteCapacityUnits"
+        for capacity in consumed if isinstance(consumed, list) else [consumed]:
+            units = capacity.get("CapacityUnits", None)
+            if units is not None:
+                self._count(capacity.get("TableName", table_name), [(metric_name, units, "Count")])
+
+    def _count(self, table_name, metrics):
+        tenant_id, tenant_tier = _current_tenant()
+        self.aggregator.increment_all(
+            metrics,
+            [{"ServiceName": self.service_name, "TenantTier": tenant_tier}],
+            {"Tenant": tenant_id, "Table": table_name or "unknown"},
+        )
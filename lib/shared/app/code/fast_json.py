@@ -0,0 +1,86 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import base64
+import json
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    # the stdlib json produces the same documents, only slower
+    orjson = None
+
+
+def json_default(value):
+    # numbers read through a boto3 resource come back as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_bytes(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=json_default, separators=(",", ":")).encode("utf-8")
+
+
+# Serializes responses with orjson when it is installed. Decimal values are
+# written as JSON numbers, sets as lists. Keys keep their insertion order.
+class FastJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            kwargs.setdefault("default", json_default)
+            return json.dumps(obj, **kwargs)
+        return dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+
+def _number(value):
+    return float(value) if "." in value or "e" in value or "E" in value else int(value)
+
+
+# Converts a DynamoDB attribute value, as returned by a low-level client, to
+# the value a JSON response carries: numbers become int or float, binary
+# becomes base64 text and sets become lists.
+def from_attribute_value(value):
+    (kind, data), = value.items()
+    if kind == "S":
+        return data
+    if kind == "N":
+        return _number(data)
+    if kind == "M":
+        return {key: from_attribute_value(item) for key, item in data.items()}
+    if kind == "L":
+        return [from_attribute_value(item) for item in data]
+    if kind == "BOOL":
+        return data
+    if kind == "NULL":
+        return None
+    if kind == "SS":
+        return data
+    if kind == "NS":
+        return [_number(item) for item in data]
+    if kind == "B":
+        return base64.b64encode(data).decode("ascii")
+    if kind == "BS":
+        return [base64.b64encode(item).decode("ascii") for item in data]
+    raise ValueError(f"Unknown DynamoDB attribute type {kind}")
+
+
+def from_attribute_map(item):
+    return {key: from_attribute_value(value) for key, value in item.items()}
@@ -2,21 +2,901 @@
 # SPDX-License-Identifier: MIT-0
 import jwt
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import os
 import requests
 import json
-from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
+import asyncio
+import atexit
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from shared.consumption_metering import ConsumptionMeter
+from shared.admission_control import AdmissionController, SharedTokenBuckets, get_queue_delay, load_tier_limits
+from shared.tenant_cache import default_cache_path
+from shared.structured_logging import configure_logging, current_log_context
+from shared.resilient_http import ResilientHTTPClient, current_deadline, deadline_header, get_propagated_deadline
+from shared.request_timing import RequestProfiler, RequestTimer, current_request_timer, register_botocore_timing, timed_phase
+
+logger = logging.getLogger(__name__)
+token_vendor_endpoint = f"http://127.0.0.1:{os.environ.get('TOKEN_VENDOR_ENDPOINT_PORT', '8081')}"
+# the threads each uvicorn worker runs requests on, see asgi.py
+asgi_threads = int(os.environ.get("ASGI_THREADS", "16"))
+botocore_config = Config(
+    # one pooled connection per request thread
+    max_pool_connections=int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", asgi_threads)),
+    retries={"max_attempts": int(os.environ.get("AWS_MAX_ATTEMPTS", "3")), "mode": "adaptive"},
+    connect_timeout=float(os.environ.get("AWS_CONNECT_TIMEOUT_SECONDS", "2")),
+    read_timeout=float(os.environ.get("AWS_READ_TIMEOUT_SECONDS", "5")),
+)
+
+
+# Creates boto3 clients and resources lazily and keeps them for the life of the
+# process, so requests reuse the same connection pools. Clients are shared by
+# all threads, resources are not thread safe and are kept per thread. Clients
+# and resources are dropped when the process id changes, so forked workers
+# never reuse the parent's connections. They are all created from one boto3
+# session, which holds no connections and is kept across forks, so the botocore
+# models it has loaded serve every client, including those signed with a
+# tenant's credentials, and every worker forked after warm_up().
+class Boto3Factory():
+    def __init__(self, config=botocore_config):
+        self.config = config
+        self._session = None
+        self._clients = {}
+        self._resources = threading.local()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def client(self, service_name, read_timeout=None):
+        self._check_pid()
+        key = (service_name, read_timeout)
+        client = self._clients.get(key, None)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key, None)
+                if client is None:
+                    client = self._register(self._boto3_session().client(service_name, config=self._config(read_timeout)))
+                    self._clients[key] = client
+        return client
+
+    def resource(self, service_name):
+        self._check_pid()
+        resources = self._resources.__dict__
+        resource = resources.get(service_name, None)
+        if resource is None:
+            with self._lock:
+                resource = self._boto3_session().resource(service_name, config=self.config)
+            self._register(resource.meta.client)
+            resources[service_name] = resource
+        return resource
+
+    # A client or resource of its own, signed with the given credentials
+    # (aws_access_key_id, aws_secret_access_key, aws_session_token), for the
+    # caller to keep.
+    def credentials_client(self, service_name, credentials):
+        with self._lock:
+            client = self._boto3_session().client(service_name, config=self.config, **credentials)
+        return self._register(client)
+
+    def credentials_resource(self, service_name, credentials):
+        with self._lock:
+            resource = self._boto3_session().resource(service_name, config=self.config, **credentials)
+        self._register(resource.meta.client)
+        return resource
+
+    def reset(self):
+        with self._lock:
+            self._clients = {}
+            self._resources = threading.local()
+            self._pid = os.getpid()
+
+    def _boto3_session(self):
+        # called with the lock held
+        if self._session is None:
+            self._session = boto3.Session()
+        return self._session
+
+    def _register(self, client):
+        register_botocore_timing(client)
+        consumption_meter.register(client)
+        return client
+
+    def _config(self, read_timeout):
+        if read_timeout is None:
+            return self.config
+        return self.config.merge(Config(read_timeout=read_timeout))
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self.reset()
+
+
+boto3_factory = Boto3Factory()
+
+
+def get_shared_boto3_client(service, read_timeout=None):
+    return boto3_factory.client(service, read_timeout)
+
+
+def get_shared_boto3_resource(service):
+    return boto3_factory.resource(service)
+
+
+# Writes an item that must not replace an existing one. When the key is
+# already taken the id attribute is replaced with a fresh new_id() and the put
+# is tried again. Returns the id the item was stored under.
+def put_new_item(table, item, id_attribute, new_id, max_attempts=3):
+    for attempt in range(max_attempts):
+        try:
+            table.put_item(Item=item, ConditionExpression=f"attribute_not_exists({id_attribute})")
+            return item[id_attribute]
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException" or attempt == max_attempts - 1:
+                raise
+            logger.warning(f"{id_attribute} {item[id_attribute]} already exists, retrying with a new id")
+        item = {**item, id_attribute: new_id()}
+
 
 # IMPLEMENT ME: LAB1 (TenantContext and get_tenant_context)
+@dataclass(frozen=True, slots=True)
+class TenantContext():
+    tenant_id: str = None
+    tenant_tier: str = None
+
+
+def get_token(authorization):
+    if authorization is None:
+        return None
+    return authorization.replace("Bearer ", "", 1)
+
+
+# Holds the signing keys published at JWKS_URI. The key set is fetched once
+# and then refreshed by a background thread, so verifying a token never waits
+# on the network after the first load. A token with an unknown kid fetches
+# the keys again at most once per min_refresh_interval_seconds, one request
+# at a time, and otherwise fails fast, so random kids cannot make every
+# request wait on the JWKS endpoint. Keys fetched before a fork, by warm_up()
+# in the gunicorn master, are kept by the workers.
+class JwksKeyStore():
+    def __init__(self, jwks_uri, refresh_interval_seconds=3600, min_refresh_interval_seconds=30):
+        self.jwks_uri = jwks_uri
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.min_refresh_interval_seconds = min_refresh_interval_seconds
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at = None
+        self._refresher_pid = None
+
+    def get_signing_key(self, token):
+        self._ensure_refresher()
+        kid = jwt.get_unverified_header(token).get("kid", None)
+        key = self._keys.get(kid, None)
+        if key is None:
+            # an unknown kid usually means the keys were rotated since the last refresh
+            self._refresh_on_demand()
+            key = self._keys.get(kid, None)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unable to find signing key {kid}")
+        return key
+
+    def refresh(self):
+        response = requests.get(self.jwks_uri, timeout=5)
+        response.raise_for_status()
+        key_set = jwt.PyJWKSet.from_dict(response.json())
+        self._keys = {key.key_id: key for key in key_set.keys}
+        self._refreshed_at = time.monotonic()
+
+    def _refresh_on_demand(self):
+        # requests waiting here find the keys the first one fetched
+        with self._refresh_lock:
+            if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.min_refresh_interval_seconds:
+                return
+            # a failed fetch counts too, so an unreachable endpoint is not asked on every request
+            self._refreshed_at = time.monotonic()
+            try:
+                self.refresh()
+            except requests.RequestException as e:
+                raise jwt.InvalidTokenError(f"Unable to fetch signing keys: {e}") from e
+
+    def _ensure_refresher(self):
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            threading.Thread(target=self._refresh_loop, name="jwks-refresher", daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"JWKS refresh failed: {e}")
+
+
+# Maps the digest of a bearer token to the TenantContext decoded from it. An
+# entry never outlives the token's exp claim and the cache is bounded in LRU
+# order, so repeated requests with the same token skip the decode entirely.
+class TenantContextCache():
+    def __init__(self, max_entries=4096, max_ttl_seconds=300, jwks_key_store=None):
+        self.max_entries = max_entries
+        self.max_ttl_seconds = max_ttl_seconds
+        self.jwks_key_store = jwks_key_store
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+            self.misses += 1
+
+        claims = self.decode(token)
+        tenant_context = TenantContext(claims.get("custom:tenant_id", None), claims.get("custom:tenant_tier", None))
+        expires_at = now + self.max_ttl_seconds
+        if claims.get("exp", None) is not None:
+            expires_at = min(expires_at, float(claims["exp"]))
+        if expires_at > now:
+            with self._lock:
+                self._entries[key] = (tenant_context, expires_at)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return tenant_context
+
+    def decode(self, token):
+        if self.jwks_key_store is None:
+            # signatures are verified by the istio RequestAuthentication at the ingress
+            return jwt.decode(token, options={"verify_signature": False})
+        signing_key = self.jwks_key_store.get_signing_key(token)
+        return jwt.decode(token, signing_key.key, algorithms=[signing_key.algorithm_name or "RS256"],
+                          options={"verify_aud": False})
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+tenant_context_cache = TenantContextCache(
+    max_entries=int(os.environ.get("TENANT_CONTEXT_CACHE_MAX_ENTRIES", "4096")),
+    max_ttl_seconds=int(os.environ.get("TENANT_CONTEXT_CACHE_TTL_SECONDS", "300")),
+    jwks_key_store=JwksKeyStore(os.environ["JWKS_URI"]) if os.environ.get("JWKS_URI") else None,
+)
+empty_tenant_context = TenantContext(None, None)
+
+
+def get_tenant_context(authorization):
+    token = get_token(authorization)
+    if not token:
+        return empty_tenant_context
+    with timed_phase("jwt"):
+        tenant_context = tenant_context_cache.get(token)
+    return _set_request_tenant_context(tenant_context)
+
+
+def _set_request_tenant_context(tenant_context):
+    timer = current_request_timer.get()
+    if timer is not None:
+        timer.tenant_context = tenant_context
+    log_fields = current_log_context.get()
+    if log_fields is not None and "tenantId" not in log_fields:
+        log_fields["tenantId"] = tenant_context.tenant_id
+        log_fields["tenantTier"] = tenant_context.tenant_tier
+    return tenant_context
+
+
+# The istio sidecar sets this header on every inbound request to the SPIFFE id
+# of the workload at the other end of the mTLS connection, and removes it when
+# there is none, see the peer-principal EnvoyFilter of the application stack.
+peer_principal_header = "X-Peer-Principal"
+tenant_id_header = "X-Tenant-Id"
+tenant_tier_header = "X-Tenant-Tier"
+pod_namespace = os.environ.get("POD_NAMESPACE", None)
+
+
+# Returns the service account of the workload that sent the request when it
+# runs in this service's namespace, None for requests through the ingress.
+def get_internal_caller(headers):
+    principal = headers.get(peer_principal_header, None)
+    if not principal or pod_namespace is None:
+        return None
+    # spiffe://<trust domain>/ns/<namespace>/sa/<service account>
+    parts = principal.split("/")
+    if len(parts) != 7 or parts[0] != "spiffe:" or parts[3] != "ns" or parts[4] != pod_namespace or parts[5] != "sa":
+        return None
+    return parts[6]
+
+
+# Headers that tell another service which tenant a call without a bearer token
+# acts for. Only honored on calls from this namespace.
+def get_internal_tenant_headers(tenant_context):
+    return {tenant_id_header: tenant_context.tenant_id, tenant_tier_header: tenant_context.tenant_tier}
+
+
+# The tenant a request acts for: decoded from its bearer token or, for a call
+# from another service of this namespace that sent none, taken from its
+# X-Tenant-Id and X-Tenant-Tier headers.
+def get_request_tenant_context(headers):
+    authorization = headers.get("Authorization", None)
+    if authorization or get_internal_caller(headers) is None:
+        return get_tenant_context(authorization)
+    return _set_request_tenant_context(TenantContext(headers.get(tenant_id_header, None),
+                                                     headers.get(tenant_tier_header, None)))
+
+
+# The credentials vended for a tenant and the boto3 clients and resources
+# signed with them. Like those of Boto3Factory, the clients are shared by all
+# threads and the resources, which are not thread safe, are kept per thread.
+class TenantSession():
+    tenant_id: str
+    authorization: str
+    credentials: dict
+    expiration: float
+    token_expiration: float = None
+
+    def __init__(self, tenant_id, authorization, credentials, expiration, token_expiration=None):
+        self.tenant_id = tenant_id
+        self.authorization = authorization
+        self.credentials = credentials
+        self.expiration = expiration
+        self.token_expiration = token_expiration
+        self.resources = threading.local()
+        self.clients = {}
+
+    def client(self, service_name):
+        client = self.clients.get(service_name, None)
+        if client is None:
+            client = boto3_factory.credentials_client(service_name, self.credentials)
+            self.clients[service_name] = client
+        return client
+
+    def resource(self, service_name):
+        resources = self.resources.__dict__
+        resource = resources.get(service_name, None)
+        if resource is None:
+            resource = boto3_factory.credentials_resource(service_name, self.credentials)
+            resources[service_name] = resource
+        return resource
+
+
+# Caches the tenant-scoped sessions vended by the token vendor sidecar so that
+# steady-state requests skip the vendor round trip, the STS AssumeRole and
+# creating boto3 clients. Entries are keyed by tenant and token digest,
+# evicted in LRU order and refreshed in the background before they expire.
+class TenantSessionCache():
+    def __init__(self, max_entries=256, refresh_margin_seconds=300, refresh_interval_seconds=30, default_ttl_seconds=900):
+        self.max_entries = max_entries
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.default_ttl_seconds = default_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def get_resource(self, service_name, authorization):
+        return self.get_session(authorization).resource(service_name)
+
+    def get_session(self, authorization):
+        self._ensure_refresher()
+        key = self._cache_key(authorization)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry.expiration > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self._vend_session(key[0], authorization)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _cache_key(self, authorization):
+        token = get_token(authorization) or ""
+        tenant_context = get_tenant_context(authorization)
+        return (tenant_context.tenant_id, hashlib.sha256(token.encode("utf-8")).hexdigest())
+
+    def _vend_session(self, tenant_id, authorization):
+        with timed_phase("credentials"):
+            response = requests.get(token_vendor_endpoint, headers={"Authorization": authorization}, timeout=5)
+            response.raise_for_status()
+            credentials = response.json()["Credentials"]
+        session_credentials = {
+            "aws_access_key_id": credentials["AccessKeyId"],
+            "aws_secret_access_key": credentials["SecretAccessKey"],
+            "aws_session_token": credentials["SessionToken"],
+        }
+        return TenantSession(tenant_id, authorization, session_credentials, self._parse_expiration(credentials.get("Expiration", None)),
+                             self._token_expiration(authorization))
+
+    def _parse_expiration(self, expiration):
+        try:
+            return datetime.fromisoformat(expiration).timestamp()
+        except (TypeError, ValueError):
+            return time.time() + self.default_ttl_seconds
+
+    def _token_expiration(self, authorization):
+        try:
+            return jwt.decode(get_token(authorization), options={"verify_signature": False}).get("exp", None)
+        except jwt.PyJWTError:
+            return None
+
+    def _ensure_refresher(self):
+        # the refresher thread does not survive a fork, so each worker starts its own
+        if self._refresher_pid == os.getpid() or self.refresh_interval_seconds <= 0:
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            self._refresher = threading.Thread(target=self._refresh_loop, name="tenant-session-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval_seconds)
+            try:
+                self.refresh_expiring()
+            except Exception as e:
+                logger.error(f"Tenant session refresh failed: {e}")
+
+    def refresh_expiring(self):
+        now = time.time()
+        with self._lock:
+            expiring = [(key, entry) for key, entry in self._entries.items()
+                        if entry.expiration - now < self.refresh_margin_seconds]
+
+        for key, entry in expiring:
+            # a token that has expired cannot be exchanged again, so let the entry lapse
+            if entry.token_expiration is not None and entry.token_expiration <= now:
+                self._discard(key, entry)
+                continue
+            try:
+                refreshed = self._vend_session(entry.tenant_id, entry.authorization)
+            except Exception:
+                if entry.expiration <= now:
+                    self._discard(key, entry)
+                continue
+            with self._lock:
+                if self._entries.get(key, None) is entry:
+                    self._entries[key] = refreshed
+                    self.refreshes += 1
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key, None) is entry:
+                del self._entries[key]
+
+
+tenant_session_cache = TenantSessionCache(
+    max_entries=int(os.environ.get("TENANT_SESSION_CACHE_MAX_ENTRIES", "256")),
+    refresh_margin_seconds=int(os.environ.get("TENANT_SESSION_REFRESH_MARGIN_SECONDS", "300")),
+    refresh_interval_seconds=int(os.environ.get("TENANT_SESSION_REFRESH_INTERVAL_SECONDS", "30")),
+)
+
+
+def get_boto3_client(service, authorization):
+    return tenant_session_cache.get_session(authorization).client(service)
 
 
 # IMPLEMENT ME: LAB2 (get_boto3_resource)
+def get_boto3_resource(service, authorization):
+    return tenant_session_cache.get_resource(service, authorization)
 
 
 # IMPLEMENT ME: LAB3 (get_message_detail_with_tenant_context)
+def get_message_detail_with_tenant_context(event, tenant_context, authorization):
+    return json.dumps({
+        "tenantId": tenant_context.tenant_id,
+        "tenantTier": tenant_context.tenant_tier,
+        "authorization": authorization,
+        "event": event,
+    })
 
 
 # IMPLEMENT ME: LAB3 (get_tenant_context_from_message_detail)
+def get_tenant_context_from_message_detail(message_detail):
+    return TenantContext(message_detail.get("tenantId", None), message_detail.get("tenantTier", None))
+
+
+# Aggregates metrics in memory per dimension set and writes them as EMF
+# documents from a background thread, once per flush interval or as soon as
+# max_pending_values data points are buffered. Counters are summed between
+# flushes, distributions keep every recorded value.
+class MetricsAggregator():
+    max_metrics_per_document = 100
+    max_values_per_metric = 100
+
+    def __init__(self, flush_interval_seconds=10, max_pending_values=1000):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_values = max_pending_values
+        self.flushes = 0
+        self._pending = {}
+        self._pending_values = 0
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = False
+        self._flusher_pid = None
+
+    def increment(self, metric_name, value=1, dimension_sets=None, properties=None, unit="None"):
+        self._put("counters", metric_name, value, dimension_sets, properties, unit)
+
+    def record(self, metric_name, value, dimension_sets=None, properties=None, unit="None"):
+        self._put("distributions", metric_name, value, dimension_sets, properties, unit)
+
+    def increment_all(self, metrics, dimension_sets=None, properties=None):
+        # metrics is a list of (metric_name, value, unit) counted in one go
+        with timed_phase("metrics"):
+            self._put_values("counters", metrics, dimension_sets, properties)
+
+    def _put(self, kind, metric_name, value, dimension_sets, properties, unit):
+        with timed_phase("metrics"):
+            self._put_values(kind, [(metric_name, value, unit)], dimension_sets, properties)
+
+    def _put_values(self, kind, metrics, dimension_sets, properties):
+        self._ensure_flusher()
+        dimension_sets = dimension_sets or [{}]
+        properties = properties or {}
+        key = (tuple(tuple(sorted(dimensions.items())) for dimensions in dimension_sets), tuple(sorted(properties.items())))
+        with self._lock:
+            group = self._pending.get(key, None)
+            if group is None:
+                group = {"dimension_sets": dimension_sets, "properties": properties, "counters": {}, "distributions": {}}
+                self._pending[key] = group
+            for metric_name, value, unit in metrics:
+                if kind == "counters":
+                    # a counter buffers one data point however often it is incremented
+                    total, _ = group["counters"].get(metric_name, (None, unit))
+                    if total is None:
+                        total = 0
+                        self._pending_values += 1
+                    group["counters"][metric_name] = (total + value, unit)
+                else:
+                    values, _ = group["distributions"].setdefault(metric_name, ([], unit))
+                    values.append(value)
+                    self._pending_values += 1
+            if self._pending_values >= self.max_pending_values:
+                self._flush_requested.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_values = 0
+        if pending:
+            asyncio.run(self._write(pending.values()))
+            self.flushes += 1
+
+    async def _write(self, groups):
+        for group in groups:
+            metrics = [(name, [total], unit) for name, (total, unit) in group["counters"].items()]
+            metrics += [(name, values[start:start + self.max_values_per_metric], unit)
+                        for name, (values, unit) in group["distributions"].items()
+                        for start in range(0, len(values), self.max_values_per_metric)]
+            document = {}
+            for name, values, unit in metrics:
+                if name in document or len(document) == self.max_metrics_per_document:
+                    await self._write_document(group, document)
+                    document = {}
+                document[name] = (values, unit)
+            if document:
+                await self._write_document(group, document)
+
+    async def _write_document(self, group, document):
+        # aws_embedded_metrics pulls in aiohttp, which is only needed once metrics are written
+        from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
+
+        metrics_logger = create_metrics_logger()
+        metrics_logger.set_dimensions(*group["dimension_sets"])
+        for name, value in group["properties"].items():
+            metrics_logger.set_property(name, value)
+        for name, (values, unit) in document.items():
+            for value in values:
+                metrics_logger.put_metric(name, value, unit)
+        await metrics_logger.flush()
+
+    def close(self):
+        self._closed = True
+        self._flush_requested.set()
+        self.flush()
+
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            self._closed = False
+            threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True).start()
+            atexit.register(self.close)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._flush_requested.wait(self.flush_interval_seconds)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Metrics flush failed: {e}")
+
+
+metrics_aggregator = MetricsAggregator(
+    flush_interval_seconds=float(os.environ.get("METRICS_FLUSH_INTERVAL_SECONDS", "10")),
+    max_pending_values=int(os.environ.get("METRICS_MAX_PENDING_VALUES", "1000")),
+)
+# consumption is flushed less often, one document per tenant and table
+metering_aggregator = MetricsAggregator(
+    flush_interval_seconds=float(os.environ.get("METERING_FLUSH_INTERVAL_SECONDS", "60")),
+    max_pending_values=int(os.environ.get("METERING_MAX_PENDING_VALUES", "10000")),
+)
+consumption_meter = ConsumptionMeter(
+    metering_aggregator,
+    os.environ.get("SERVICE_NAME", "unknown"),
+    enabled=os.environ.get("CONSUMPTION_METERING", "true").lower() == "true",
+)
+
+
+def create_emf_log(service_name, metric_name, metric_value):
+    metrics_aggregator.increment(metric_name, metric_value, [{"ServiceName": service_name}])
+
+
+def get_tenant_dimension_sets(service_name, tenant_context):
+    dimension_sets = [{"ServiceName": service_name}]
+    if tenant_context.tenant_id is not None:
+        dimension_sets.append({"ServiceName": service_name, "Tenant": tenant_context.tenant_id})
+    if tenant_context.tenant_tier is not None:
+        dimension_sets.append({"ServiceName": service_name, "TenantTier": tenant_context.tenant_tier})
+    return dimension_sets
 
 
 # IMPLEMENT ME: LAB6 (create_emf_log_with_tenant_context)
+def create_emf_log_with_tenant_context(service_name, tenant_context, metric_name, metric_value):
+    metrics_aggregator.increment(metric_name, metric_value, get_tenant_dimension_sets(service_name, tenant_context))
+
+
+request_profiler = RequestProfiler(
+    sample_rate=float(os.environ.get("REQUEST_PROFILE_SAMPLE_RATE", "0")),
+    profile_dir=os.environ.get("REQUEST_PROFILE_DIR", "/tmp/profiles"),
+)
+
+
+# Times every request of a Flask app, except health checks. The phases timed
+# by the shared helpers go back to the caller in a Server-Timing header and
+# into EMF as Latency distributions per phase, by service and by tenant. A
+# REQUEST_PROFILE_SAMPLE_RATE fraction of requests is also run under cProfile.
+def init_request_timing(app, service_name):
+    # flask is only installed in the web services, not in the invoice consumer
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timing():
+        if request.path.endswith("/health"):
+            return
+        g.request_timer_token = current_request_timer.set(RequestTimer())
+        g.request_profiler = request_profiler.start(random.random())
+
+    @app.after_request
+    def finish_request_timing(response):
+        timer = current_request_timer.get()
+        if timer is None:
+            return response
+        response.headers["Server-Timing"] = timer.server_timing_header()
+        phases = dict(timer.phases, total=timer.total())
+        tenant_context = timer.tenant_context or empty_tenant_context
+        for phase, seconds in phases.items():
+            dimension_sets = [dict(dimensions, Phase=phase)
+                              for dimensions in get_tenant_dimension_sets(service_name, tenant_context)]
+            metrics_aggregator.record("Latency", seconds * 1000, dimension_sets, unit="Milliseconds")
+        return response
+
+    @app.teardown_request
+    def stop_request_timing(exception=None):
+        profiler = g.pop("request_profiler", None)
+        if profiler is not None:
+            path = request_profiler.stop(profiler, service_name)
+            logger.info("Wrote request profile %s for %s %s", path, request.method, request.path)
+        token = g.pop("request_timer_token", None)
+        if token is not None:
+            current_request_timer.reset(token)
+
+
+def invalid_token_response(e):
+    logger.warning(f"Rejected bearer token: {e}")
+    return {"msg": "Invalid bearer token."}, 401
+
+
+admission_controller = AdmissionController(
+    SharedTokenBuckets(os.environ.get("ADMISSION_BUCKETS_PATH", default_cache_path("admission-buckets"))),
+    load_tier_limits(os.environ.get("ADMISSION_TIER_LIMITS", None)),
+)
+
+
+# Rejects requests before they reach the route when the tenant is over its
+# tier's rate or the request queued too long, see AdmissionController. Every
+# decision is counted per tenant and tier. ADMISSION_CONTROL=true enables it;
+# the buckets are shared by the workers of a pod, so a tenant's limit for a
+# service is its tier's rate times the service's replicas. Calls from the
+# other services of the namespace are admitted without drawing a token, the
+# tenant request they serve was already admitted by the calling service. A
+# bearer token that does not decode is answered with a 401 either way,
+# before admission runs.
+def init_admission_control(app, service_name):
+    from flask import request
+
+    @app.errorhandler(jwt.PyJWTError)
+    def reject_invalid_token(e):
+        return invalid_token_response(e)
+
+    if os.environ.get("ADMISSION_CONTROL", "false").lower() != "true":
+        return
+
+    @app.before_request
+    def admit_request():
+        if request.path.endswith("/health") or get_internal_caller(request.headers) is not None:
+            return None
+        try:
+            tenant_context = get_tenant_context(request.headers.get("Authorization", None))
+        except jwt.PyJWTError as e:
+            return invalid_token_response(e)
+        if tenant_context.tenant_id is None:
+            return None
+        queue_delay = get_queue_delay(request.headers.get("X-Request-Start", None))
+        with timed_phase("admission"):
+            decision, retry_after = admission_controller.admit(tenant_context, queue_delay)
+        metrics_aggregator.increment(f"Request{decision.capitalize()}", 1, get_tenant_dimension_sets(service_name, tenant_context))
+        if decision == "admitted":
+            return None
+        return {"msg": "Too many requests, please retry later."}, 429, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+# Creates the client a service calls other services with, see
+# ResilientHTTPClient. Retries, hedges, rejected calls, missed deadlines and
+# circuit state changes are counted per endpoint. HTTP_MAX_ATTEMPTS,
+# HTTP_BREAKER_FAILURES, HTTP_BREAKER_RESET_SECONDS and HTTP_HEDGING=true set
+# the defaults.
+def create_http_client(service_name, session=None, **kwargs):
+    def count_event(metric_name, endpoint):
+        metrics_aggregator.increment(metric_name, 1, [{"ServiceName": service_name, "Endpoint": endpoint}])
+
+    kwargs.setdefault("max_attempts", int(os.environ.get("HTTP_MAX_ATTEMPTS", "3")))
+    kwargs.setdefault("failure_threshold", int(os.environ.get("HTTP_BREAKER_FAILURES", "5")))
+    kwargs.setdefault("reset_timeout_seconds", float(os.environ.get("HTTP_BREAKER_RESET_SECONDS", "10")))
+    kwargs.setdefault("hedge", os.environ.get("HTTP_HEDGING", "false").lower() == "true")
+    return ResilientHTTPClient(session, on_event=count_event, **kwargs)
+
+
+# Gives each request REQUEST_DEADLINE_SECONDS (10), or what is left of the
+# caller's budget when it sent a shorter one, for the calls made through the
+# resilient HTTP clients while handling it. A request whose caller already
+# gave up is answered with a 504 without doing the work.
+def init_request_deadlines(app):
+    from flask import g, request
+
+    budget_seconds = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "10"))
+
+    @app.before_request
+    def start_request_deadline():
+        if request.path.endswith("/health"):
+            return None
+        propagated = get_propagated_deadline(request.headers.get(deadline_header, None))
+        if propagated == 0:
+            return {"msg": "Deadline exceeded"}, 504
+        seconds = budget_seconds if propagated is None else min(budget_seconds, propagated)
+        g.request_deadline_token = current_deadline.set(time.monotonic() + seconds)
+        return None
+
+    @app.teardown_request
+    def reset_request_deadline(exception=None):
+        token = g.pop("request_deadline_token", None)
+        if token is not None:
+            current_deadline.reset(token)
+
+
+def get_trace_id(headers):
+    # istio propagates B3 headers, other callers may send W3C traceparent or an X-Ray header
+    trace_id = headers.get("X-B3-TraceId", None)
+    if trace_id:
+        return trace_id
+    traceparent = headers.get("traceparent", "").split("-")
+    if len(traceparent) == 4:
+        return traceparent[1]
+    for part in headers.get("X-Amzn-Trace-Id", "").split(";"):
+        if part.startswith("Root="):
+            return part[len("Root="):]
+    return headers.get("X-Request-Id", None)
+
+
+# Logs every record of the process as JSON from a background thread, see
+# configure_logging. Records logged while a request is handled carry its
+# trace id and, once get_tenant_context has run, its tenant and tier.
+def init_logging(app, service_name):
+    from flask import g, request
+    from flask.logging import default_handler
+
+    configure_logging(service_name)
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(logging.NOTSET)
+
+    @app.before_request
+    def set_log_context():
+        if request.path.endswith("/health"):
+            return
+        g.log_context_token = current_log_context.set({"traceId": get_trace_id(request.headers)})
+
+    @app.teardown_request
+    def reset_log_context(exception=None):
+        token = g.pop("log_context_token", None)
+        if token is not None:
+            current_log_context.reset(token)
+
+
+# Does before the app reports ready what its first requests would otherwise
+# wait for: loads the botocore models of the clients and resources the app
+# uses, fetches the JWKS signing keys and serves health_path once. With
+# preload_app the gunicorn master does this once and every worker forks warm.
+# Call it once all routes are registered, Flask takes no new ones after
+# serving a request. WARM_UP=false skips it.
+def warm_up(app, health_path, clients=(), resources=()):
+    if os.environ.get("WARM_UP", "true").lower() != "true":
+        return
+    started = time.perf_counter()
+    for service_name in clients:
+        boto3_factory.client(service_name)
+    for service_name in resources:
+        boto3_factory.resource(service_name)
+    if tenant_context_cache.jwks_key_store is not None:
+        try:
+            tenant_context_cache.jwks_key_store.refresh()
+        except Exception as e:
+            # the first request fetches them instead
+            logger.warning(f"Unable to fetch JWKS signing keys: {e}")
+    app.test_client().get(health_path)
+    logger.info("Warmed up in %.0fms", (time.perf_counter() - started) * 1000)
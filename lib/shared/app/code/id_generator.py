@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import threading
+import time
+
+crockford_alphabet = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+crockford_pairs = [first + second for first in crockford_alphabet for second in crockford_alphabet]
+max_randomness = (1 << 80) - 1
+
+
+def encode_ulid(timestamp_ms, randomness):
+    # two characters (10 bits) per lookup, most significant first
+    value = (timestamp_ms << 80) | randomness
+    return "".join([crockford_pairs[(value >> shift) & 1023] for shift in range(120, -10, -10)])
+
+
+def decode_ulid_timestamp(ulid):
+    value = 0
+    for char in ulid[:10]:
+        value = (value << 5) | crockford_alphabet.index(char)
+    return value
+
+
+# Generates ULIDs: 26 character ids made of a 48 bit millisecond timestamp and
+# 80 random bits, so they sort by creation time as plain strings. Ids created
+# in the same millisecond by one process increment the random part instead of
+# drawing new bits, which keeps them strictly increasing. Other processes draw
+# their own random bits, making a collision between them vanishingly unlikely.
+class UlidGenerator():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_timestamp_ms = 0
+        self._last_randomness = 0
+        self._pid = os.getpid()
+
+    def new_id(self):
+        timestamp_ms = time.time_ns() // 1000000
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked worker must not continue the parent's sequence
+                self._pid = os.getpid()
+                self._last_timestamp_ms = 0
+            if timestamp_ms <= self._last_timestamp_ms:
+                # same millisecond, or the clock went back
+                timestamp_ms = self._last_timestamp_ms
+                randomness = self._last_randomness + 1
+                if randomness > max_randomness:
+                    timestamp_ms += 1
+                    randomness = int.from_bytes(os.urandom(10), "big")
+            else:
+                randomness = int.from_bytes(os.urandom(10), "big")
+            self._last_timestamp_ms = timestamp_ms
+            self._last_randomness = randomness
+        return encode_ulid(timestamp_ms, randomness)
+
+
+ulid_generator = UlidGenerator()
+
+
+def new_id(prefix=""):
+    return prefix + ulid_generator.new_id()
+
+
+# Smallest and largest ids that can be generated in the millisecond of
+# timestamp_ms, for range queries over ids sorted by creation time.
+def first_id_at(timestamp_ms, prefix=""):
+    return prefix + encode_ulid(timestamp_ms, 0)
+
+
+def last_id_at(timestamp_ms, prefix=""):
+    return prefix + encode_ulid(timestamp_ms, max_randomness)
@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import time
+import cProfile
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+current_request_timer = ContextVar("current_request_timer", default=None)
+
+
+# Collects how long each phase of one request took (jwt, credentials,
+# dynamodb, ...). Time spent in the same phase more than once is summed.
+class RequestTimer():
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.tenant_context = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing_header(self):
+        entries = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in list(self.phases.items())]
+        entries.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def timed_phase(phase):
+    timer = current_request_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(phase, time.perf_counter() - started)
+
+
+def _before_call(context, **kwargs):
+    context["timing_started"] = time.perf_counter()
+
+
+def _after_call(model, context, **kwargs):
+    timer = current_request_timer.get()
+    started = context.get("timing_started", None)
+    if timer is not None and started is not None:
+        timer.add(model.service_model.service_name, time.perf_counter() - started)
+
+
+# Times every API call of a boto3 client, retries included, as a phase named
+# after the service (dynamodb, events, ...).
+def register_botocore_timing(client):
+    client.meta.events.register("before-call", _before_call)
+    client.meta.events.register("after-call", _after_call)
+    return client
+
+
+# Profiles a sampled fraction of requests with cProfile and writes one .prof
+# file per request to profile_dir, for pstats or snakeviz.
+class RequestProfiler():
+    def __init__(self, sample_rate=0.0, profile_dir="/tmp/profiles"):
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+
+    def start(self, random_value):
+        if random_value >= self.sample_rate:
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop(self, profiler, name):
+        profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}-{os.getpid()}-{time.time_ns()}.prof")
+        profiler.dump_stats(path)
+        return path
@@ -0,0 +1,291 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from urllib.parse import urlsplit
+import requests
+
+idempotent_methods = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+retryable_statuses = {429, 502, 503, 504}
+# remaining budget of the caller in milliseconds, sent with every call
+deadline_header = "X-Request-Deadline-Ms"
+
+# time.monotonic() by which the request or message being handled has to be done
+current_deadline = ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    # never extends a deadline set further up
+    expires = time.monotonic() + seconds
+    current = current_deadline.get()
+    token = current_deadline.set(expires if current is None else min(current, expires))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining_seconds():
+    expires = current_deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def get_propagated_deadline(header_value):
+    # seconds left of the caller's budget, None when it sent none
+    if not header_value:
+        return None
+    try:
+        return max(0.0, float(header_value) / 1000)
+    except ValueError:
+        return None
+
+
+# Stops calls to an endpoint after failure_threshold consecutive failures.
+# Once reset_timeout_seconds have passed a single probe is let through: its
+# success closes the circuit again, its failure keeps it open for another
+# reset_timeout_seconds. on_state_change is called with each new state.
+class CircuitBreaker():
+    def __init__(self, failure_threshold=5, reset_timeout_seconds=10, on_state_change=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.on_state_change = on_state_change
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout_seconds:
+                    return False
+                self._set_state("half_open")
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def _set_state(self, state):
+        self.state = state
+        if self.on_state_change is not None:
+            self.on_state_change(state)
+
+
+# Latencies of the last size successful calls to an endpoint.
+class LatencyWindow():
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+# Calls other services over HTTP within the deadline of the request or
+# message being handled (see deadline()), which is also passed on in the
+# X-Request-Deadline-Ms header. Each endpoint (scheme and host) has its own
+# CircuitBreaker; 5xx responses and connection errors count as failures.
+# Idempotent calls, GET and the like or any call made with idempotent=True,
+# are tried up to max_attempts times on connection errors, timeouts and
+# 429/502/503/504, with full jitter backoff that honors Retry-After. With
+# hedge=True, a GET still running after the endpoint's hedge_percentile
+# latency is sent a second time and the first good answer wins; reads sent as
+# POST opt in with hedge=True and idempotent=True. on_event is called with a
+# metric name and the endpoint for retries, hedges, rejected calls, missed
+# deadlines and circuit state changes.
+class ResilientHTTPClient():
+    def __init__(self, session=None, max_attempts=3, backoff_base_seconds=0.05, backoff_max_seconds=1.0,
+                 failure_threshold=5, reset_timeout_seconds=10, hedge=False, hedge_percentile=0.95,
+                 min_hedge_delay_seconds=0.005, hedge_concurrency=16, on_event=None):
+        self.session = session or requests.Session()
+        self.max_attempts = max_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay_seconds = min_hedge_delay_seconds
+        self.hedge_concurrency = hedge_concurrency
+        self.on_event = on_event
+        self.breakers = {}
+        self.latencies = {}
+        self._hedge_executor = None
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, timeout=5, idempotent=None, hedge=None, headers=None, **kwargs):
+        method = method.upper()
+        endpoint = self._endpoint(url)
+        breaker = self._breaker(endpoint)
+        if idempotent is None:
+            idempotent = method in idempotent_methods
+        if hedge is None:
+            hedge = self.hedge and method == "GET"
+        attempts = self.max_attempts if idempotent else 1
+        headers = dict(headers or {})
+        for attempt in range(attempts):
+            remaining = remaining_seconds()
+            if remaining is not None and remaining <= 0:
+                self._event("HttpDeadlineExceeded", endpoint)
+                raise DeadlineExceeded(f"Deadline passed before {method} {url}")
+            if not breaker.allow():
+                self._event("HttpCircuitRejected", endpoint)
+                raise CircuitOpenError(f"Circuit to {endpoint} is open")
+            if remaining is not None:
+                headers[deadline_header] = str(int(remaining * 1000))
+            call_timeout = timeout if remaining is None else min(timeout, remaining)
+            response = None
+            try:
+                if hedge and idempotent:
+                    response = self._send_hedged(endpoint, method, url, call_timeout, headers, kwargs)
+                else:
+                    response = self._send(endpoint, method, url, call_timeout, headers, kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            else:
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if response.status_code not in retryable_statuses or attempt == attempts - 1:
+                    return response
+            delay = self._backoff(attempt, response)
+            remaining = remaining_seconds()
+            if remaining is not None and delay >= remaining:
+                # no time for another attempt, hand back what there is
+                if response is not None:
+                    return response
+                self._event("HttpDeadlineExceeded", endpoint)
+                raise DeadlineExceeded(f"Deadline passed retrying {method} {url}")
+            if response is not None:
+                response.close()
+            self._event("HttpRetries", endpoint)
+            time.sleep(delay)
+
+    def _backoff(self, attempt, response):
+        delay = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+        retry_after = response.headers.get("Retry-After", None) if response is not None else None
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    def _send(self, endpoint, method, url, timeout, headers, kwargs):
+        started = time.monotonic()
+        response = self.session.request(method, url, timeout=timeout, headers=headers, **kwargs)
+        if response.status_code < 500:
+            self.latencies[endpoint].add(time.monotonic() - started)
+        return response
+
+    def _send_hedged(self, endpoint, method, url, timeout, headers, kwargs):
+        hedge_after = self.latencies[endpoint].percentile(self.hedge_percentile)
+        if hedge_after is None:
+            return self._send(endpoint, method, url, timeout, headers, kwargs)
+        executor = self._executor()
+        first = executor.submit(copy_context().run, self._send, endpoint, method, url, timeout, headers, kwargs)
+        done, _ = wait([first], timeout=max(self.min_hedge_delay_seconds, hedge_after))
+        if done:
+            return first.result()
+        self._event("HttpHedges", endpoint)
+        second = executor.submit(copy_context().run, self._send, endpoint, method, url, timeout, headers, kwargs)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            good = [future for future in done if future.exception() is None and future.result().status_code < 500]
+            if good or not pending:
+                winner = good[0] if good else next(iter(done))
+                if winner is second:
+                    self._event("HttpHedgeWins", endpoint)
+                for other in {first, second} - {winner}:
+                    other.add_done_callback(_close_response)
+                return winner.result()
+
+    def _executor(self):
+        if self._hedge_executor is None:
+            with self._lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = ThreadPoolExecutor(max_workers=self.hedge_concurrency, thread_name_prefix="http-hedge")
+        return self._hedge_executor
+
+    def _endpoint(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _breaker(self, endpoint):
+        breaker = self.breakers.get(endpoint, None)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(endpoint, None)
+                if breaker is None:
+                    self.latencies[endpoint] = LatencyWindow()
+                    breaker = CircuitBreaker(
+                        self.failure_threshold,
+                        self.reset_timeout_seconds,
+                        on_state_change=lambda state: self._event(f"HttpCircuit{state.title().replace('_', '')}", endpoint),
+                    )
+                    self.breakers[endpoint] = breaker
+        return breaker
+
+    def _event(self, metric_name, endpoint):
+        if self.on_event is not None:
+            self.on_event(metric_name, endpoint)
+
+
+def _close_response(future):
+    # the losing call of a hedged GET
+    if future.exception() is None:
+        future.result().close()
@@ -0,0 +1,186 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# fields of the request or message being handled (tenantId, tenantTier,
+# traceId, ...), attached to every record logged while handling it
+current_log_context = ContextVar("current_log_context", default=None)
+
+
+@contextmanager
+def log_context(**fields):
+    token = current_log_context.set(fields)
+    try:
+        yield fields
+    finally:
+        current_log_context.reset(token)
+
+
+# Writes one JSON document per record. Runs on the listener thread, so this
+# is where the message is formatted from its arguments.
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service_name=None):
+        super().__init__()
+        self.service_name = service_name
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if self.service_name is not None:
+            entry["service"] = self.service_name
+        entry.update(getattr(record, "context", None) or {})
+        entry.update(getattr(record, "fields", None) or {})
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Attaches the current log context to each record and limits records below
+# WARNING to rate per second (burst) per tenant, after keeping a sample_rate
+# fraction of them. The first record let through after others were dropped
+# carries how many were. Warnings and errors always pass.
+class TenantLogSampler(logging.Filter):
+    def __init__(self, rate=20, burst=40, sample_rate=1.0, max_tenants=10000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_rate = sample_rate
+        self.max_tenants = max_tenants
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        context = current_log_context.get()
+        record.context = dict(context) if context else None
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        if self.rate <= 0:
+            return True
+        tenant_id = context.get("tenantId", None) if context else None
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(tenant_id, None)
+            if bucket is None:
+                bucket = [self.burst, now, 0]
+                self._buckets[tenant_id] = bucket
+                while len(self._buckets) > self.max_tenants:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(tenant_id)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class DrainingQueueListener(QueueListener):
+    # waits for room in a full queue instead of failing to stop
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+# Hands records to a QueueListener thread that formats and writes them, so a
+# request only pays for appending to a queue. Records are queued as they are,
+# their arguments are formatted by the listener. When the queue is full
+# records are dropped and counted rather than blocking the request. The
+# listener is restarted in forked processes.
+class BackgroundQueueHandler(QueueHandler):
+    def __init__(self, handler, max_queued=10000):
+        super().__init__(queue.Queue(maxsize=max_queued))
+        self.handler = handler
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._listener = DrainingQueueListener(self.queue, self.handler, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def flush(self):
+        # waits for the listener to write out everything queued so far
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+                self._listener = None
+                self._pid = None
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+def get_log_level():
+    level = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+_configured_handler = None
+
+
+# Sends every logger of the process through one BackgroundQueueHandler to
+# JSON lines on stream, at LOG_LEVEL (INFO by default). Records below WARNING
+# are limited per tenant to LOG_TENANT_RATE_LIMIT per second
+# (LOG_TENANT_BURST), 0 disables the limit, and sampled at LOG_SAMPLE_RATE.
+def configure_logging(service_name=None, stream=None):
+    global _configured_handler
+    if _configured_handler is not None:
+        return _configured_handler
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(JsonFormatter(service_name))
+    handler = BackgroundQueueHandler(stream_handler)
+    handler.addFilter(TenantLogSampler(
+        rate=float(os.environ.get("LOG_TENANT_RATE_LIMIT", "20")),
+        burst=float(os.environ.get("LOG_TENANT_BURST", "40")),
+        sample_rate=float(os.environ.get("LOG_SAMPLE_RATE", "1")),
+    ))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(get_log_level())
+    atexit.register(handler.flush)
+    _configured_handler = handler
+    return handler
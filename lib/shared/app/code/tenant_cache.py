@@ -0,0 +1,195 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+def default_cache_path(name):
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"{name}.db")
+
+
+# Opens an SQLite database that every worker process on the node can share,
+# creating the tables of schema if they do not exist yet.
+def connect_shared_database(path, schema):
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=OFF")
+    for statement in schema:
+        connection.execute(statement)
+    return connection
+
+
+# Read-through cache shared by every worker process on a node. Entries live in
+# an SQLite database on tmpfs (/dev/shm), so all gunicorn workers see the same
+# entries and an invalidation in one worker is visible to the others at once.
+# Entries are partitioned by tenant: each tenant has its own byte quota, and
+# evicting to make room (expired entries first, then least recently used)
+# only ever removes entries of the tenant that is writing. Hits and misses are
+# counted per process and added to the shared per-tenant stats periodically,
+# at which point report(tenant_id, hits, misses, evictions, bytes) is called
+# with the counts since the last flush and the tenant's current memory use.
+class SharedTenantCache():
+    access_time_resolution_seconds = 1.0
+    stats_flush_interval_seconds = 5.0
+
+    def __init__(self, path, ttl_seconds=60, tenant_quota_bytes=1048576, report=None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.tenant_quota_bytes = tenant_quota_bytes
+        self.report = report
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending_stats = {}
+        self._stats_flushed_at = time.monotonic()
+        self._pid = None
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        connection = connect_shared_database(self.path, [
+            "CREATE TABLE IF NOT EXISTS entries (tenant_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (tenant_id, key)) WITHOUT ROWID",
+            "CREATE TABLE IF NOT EXISTS tenant_stats (tenant_id TEXT PRIMARY KEY, hits INTEGER NOT NULL,"
+            " misses INTEGER NOT NULL, evictions INTEGER NOT NULL)",
+        ])
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def get(self, tenant_id, key):
+        return self.get_many(tenant_id, [key]).get(key, None)
+
+    def get_many(self, tenant_id, keys):
+        if not keys:
+            return {}
+        now = time.time()
+        connection = self._connection()
+        placeholders = ",".join("?" * len(keys))
+        rows = connection.execute(
+            f"SELECT key, value, expires_at, accessed_at FROM entries WHERE tenant_id = ? AND key IN ({placeholders})",
+            [tenant_id, *keys]).fetchall()
+        values = {}
+        stale_access = []
+        for key, value, expires_at, accessed_at in rows:
+            if expires_at <= now:
+                continue
+            values[key] = json.loads(value)
+            if accessed_at < now - self.access_time_resolution_seconds:
+                stale_access.append(key)
+        if stale_access:
+            connection.execute(
+                f"UPDATE entries SET accessed_at = ? WHERE tenant_id = ? AND key IN ({','.join('?' * len(stale_access))})",
+                [now, tenant_id, *stale_access])
+        self._count(tenant_id, hits=len(values), misses=len(keys) - len(values))
+        return values
+
+    def put(self, tenant_id, key, value):
+        self.put_many(tenant_id, {key: value})
+
+    def put_many(self, tenant_id, values):
+        now = time.time()
+        rows = []
+        for key, value in values.items():
+            encoded = json.dumps(value)
+            size = len(key) + len(encoded)
+            if size <= self.tenant_quota_bytes:
+                rows.append((tenant_id, key, encoded, size, now + self.ttl_seconds, now))
+        if not rows:
+            return
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            evictions = self._enforce_quota(connection, tenant_id, now)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        if evictions:
+            self._count(tenant_id, evictions=evictions)
+
+    def _enforce_quota(self, connection, tenant_id, now):
+        (used,) = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries WHERE tenant_id = ?", (tenant_id,)).fetchone()
+        if used <= self.tenant_quota_bytes:
+            return 0
+        evicted = []
+        for key, size in connection.execute(
+                "SELECT key, size FROM entries WHERE tenant_id = ? ORDER BY expires_at > ?, accessed_at",
+                (tenant_id, now)):
+            if used <= self.tenant_quota_bytes:
+                break
+            evicted.append((tenant_id, key))
+            used -= size
+        connection.executemany("DELETE FROM entries WHERE tenant_id = ? AND key = ?", evicted)
+        return len(evicted)
+
+    def invalidate(self, tenant_id, key):
+        self._connection().execute("DELETE FROM entries WHERE tenant_id = ? AND key = ?", (tenant_id, key))
+
+    def _count(self, tenant_id, hits=0, misses=0, evictions=0):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending_stats = {}
+            pending = self._pending_stats.setdefault(tenant_id, [0, 0, 0])
+            pending[0] += hits
+            pending[1] += misses
+            pending[2] += evictions
+            if time.monotonic() - self._stats_flushed_at < self.stats_flush_interval_seconds:
+                return
+            pending_stats, self._pending_stats = self._pending_stats, {}
+            self._stats_flushed_at = time.monotonic()
+        self._flush_stats(pending_stats)
+
+    def flush_stats(self):
+        with self._lock:
+            pending_stats, self._pending_stats = self._pending_stats, {}
+            self._stats_flushed_at = time.monotonic()
+        self._flush_stats(pending_stats)
+
+    def _flush_stats(self, pending_stats):
+        if not pending_stats:
+            return
+        connection = self._connection()
+        connection.executemany(
+            "INSERT INTO tenant_stats VALUES (?, ?, ?, ?) ON CONFLICT (tenant_id) DO UPDATE SET"
+            " hits = hits + excluded.hits, misses = misses + excluded.misses, evictions = evictions + excluded.evictions",
+            [(tenant_id, hits, misses, evictions) for tenant_id, (hits, misses, evictions) in pending_stats.items()])
+        if self.report is None:
+            return
+        for tenant_id, (hits, misses, evictions) in pending_stats.items():
+            (size,) = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            self.report(tenant_id, hits, misses, evictions, size)
+
+    def stats(self, tenant_id=None):
+        self.flush_stats()
+        connection = self._connection()
+        usage = {tenant: (entries, size) for tenant, entries, size in connection.execute(
+            "SELECT tenant_id, COUNT(*), SUM(size) FROM entries GROUP BY tenant_id")}
+        counters = {tenant: (hits, misses, evictions) for tenant, hits, misses, evictions in connection.execute(
+            "SELECT tenant_id, hits, misses, evictions FROM tenant_stats")}
+        stats = {}
+        for tenant in sorted(usage.keys() | counters.keys()):
+            if tenant_id is not None and tenant != tenant_id:
+                continue
+            entries, size = usage.get(tenant, (0, 0))
+            hits, misses, evictions = counters.get(tenant, (0, 0, 0))
+            stats[tenant] = {
+                "entries": entries,
+                "bytes": size,
+                "quota_bytes": self.tenant_quota_bytes,
+                "hits": hits,
+                "misses": misses,
+                "evictions": evictions,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            }
+        return stats
@@ -27,7 +27,9 @@ var verifiedPermissionsNamespace = "SaaSWorkshop"
 var authorizationMapString = `[
 	{"Pattern": "^POST \\/products\\/?$", "Action": "CreateProduct"},
 	{"Pattern": "^GET \\/products(?:\\/.*)?", "Action": "ViewProduct"},
+	{"Pattern": "^POST \\/products:batchGet$", "Action": "ViewProduct"},
 	{"Pattern": "^POST \\/orders\\/?$", "Action": "CreateOrder"},
+	{"Pattern": "^POST \\/orders:batch$", "Action": "CreateOrder"},
 	{"Pattern": "^GET \\/orders(?:\\/.*)?", "Action": "ViewOrder"}
 ]`
 var authMaps []AuthorizationMap
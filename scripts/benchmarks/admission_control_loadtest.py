@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Runs the product service under gunicorn against a local DynamoDB stub and
+# measures a premium tenant's latency alone and while a basic tenant floods
+# the service, with admission control off and on.
+#
+# usage: python scripts/benchmarks/admission_control_loadtest.py [premium_requests] [flood_concurrency] [latency_ms]
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import jwt
+import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from stub_services import StubDynamoDBHandler, free_port, make_shared_package_dir, percentile, repo_lib, start_stub_server, wait_until_ready
+
+premium_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+flood_concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+premium_concurrency = 4
+
+app_dir = os.path.join(repo_lib, "product/app/code")
+
+
+def authorization(tenant_id, tenant_tier):
+    return "Bearer " + jwt.encode(
+        {"custom:tenant_id": tenant_id, "custom:tenant_tier": tenant_tier, "exp": int(time.time()) + 3600},
+        "loadtest-secret", algorithm="HS256")
+
+
+premium = authorization("tenant-premium", "premium")
+basic = authorization("tenant-basic", "basic")
+
+
+def run_premium(session, base_url):
+    def timed_request(i):
+        start = time.perf_counter()
+        session.get(f"{base_url}/products/prod-{i}", headers={"Authorization": premium})
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=premium_concurrency) as executor:
+        return list(executor.map(timed_request, range(premium_requests)))
+
+
+def flood(base_url, stop, results):
+    # runs in its own process, so the flood does not slow down the premium client
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=flood_concurrency))
+    statuses = Counter()
+
+    def flood_thread(thread_id):
+        i = 0
+        while not stop.is_set():
+            i += 1
+            response = session.get(f"{base_url}/products/flood-{thread_id}-{i}", headers={"Authorization": basic})
+            statuses[response.status_code] += 1
+
+    threads = [threading.Thread(target=flood_thread, args=(thread_id,)) for thread_id in range(flood_concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(dict(statuses))
+
+
+def run(admission_control, dynamodb_endpoint, shared_dir, state_dir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        PYTHONPATH=shared_dir,
+        GUNICORN_WORKERS="4",
+        ADMISSION_CONTROL=admission_control,
+        ADMISSION_BUCKETS_PATH=os.path.join(state_dir, f"buckets-{admission_control}.db"),
+        PRODUCT_CACHE_PATH=os.path.join(state_dir, f"products-{admission_control}.db"),
+        TABLE_NAME="products",
+        SERVICE_NAME="product-loadtest",
+        AWS_EMF_ENVIRONMENT="Local",
+        AWS_DEFAULT_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="loadtest",
+        AWS_SECRET_ACCESS_KEY="loadtest",
+        AWS_ENDPOINT_URL_DYNAMODB=f"http://{dynamodb_endpoint}",
+    )
+    server = subprocess.Popen(["gunicorn", "--bind", f"127.0.0.1:{port}", "--log-level=warning"], cwd=app_dir, env=env,
+                              stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(f"{base_url}/products/health")
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=premium_concurrency))
+
+        run_premium(session, base_url)  # warm up every worker
+        alone = run_premium(session, base_url)
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        flooder = multiprocessing.Process(target=flood, args=(base_url, stop, results))
+        flooder.start()
+        time.sleep(1)
+        flooded = run_premium(session, base_url)
+        stop.set()
+        statuses = results.get()
+        flooder.join()
+
+        print(f"{admission_control:>9} {percentile(alone, 0.5):8.2f} {percentile(alone, 0.99):8.2f} "
+              f"{percentile(flooded, 0.5):8.2f} {percentile(flooded, 0.99):8.2f} "
+              f"{statuses.get(200, 0):>9} {statuses.get(429, 0):>9}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+shared_dir = make_shared_package_dir()
+stub, dynamodb_endpoint = start_stub_server(StubDynamoDBHandler, latency_seconds=latency_ms / 1000)
+print(f"{'admission':>9} {'premium alone':>17} {'premium flooded':>17} {'basic':>19}")
+print(f"{'control':>9} {'p50 ms':>8} {'p99 ms':>8} {'p50 ms':>8} {'p99 ms':>8} {'served':>9} {'throttled':>9}")
+with tempfile.TemporaryDirectory() as state_dir:
+    for admission_control in ("false", "true"):
+        run(admission_control, dynamodb_endpoint, shared_dir, state_dir)
+stub.shutdown()
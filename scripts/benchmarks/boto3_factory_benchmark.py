@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Compares the per-request cost of building a boto3 DynamoDB resource on every
+# request with reusing the shared per-process resource, issuing one Query per
+# request against a local DynamoDB stub.
+#
+# usage: python scripts/benchmarks/boto3_factory_benchmark.py [requests]
+import os
+import sys
+import time
+from stub_services import StubDynamoDBHandler, make_shared_package_dir, percentile, start_stub_server
+
+request_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+stub, dynamodb_endpoint = start_stub_server(StubDynamoDBHandler, latency_seconds=0)
+os.environ.update({
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_ENDPOINT_URL_DYNAMODB": f"http://{dynamodb_endpoint}",
+})
+sys.path.insert(0, make_shared_package_dir())
+import boto3  # noqa: E402
+from shared import helper_functions  # noqa: E402
+from boto3.dynamodb.conditions import Key  # noqa: E402
+
+
+def per_request_resource():
+    return boto3.resource("dynamodb")
+
+
+def shared_resource():
+    return helper_functions.get_shared_boto3_resource("dynamodb")
+
+
+print(f"{'resource':>12} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8}")
+for name, get_resource in (("per-request", per_request_resource), ("shared", shared_resource)):
+    samples = []
+    for i in range(request_count):
+        start = time.perf_counter()
+        get_resource().Table("products").query(KeyConditionExpression=Key("tenantId").eq("tenant-0"))
+        samples.append((time.perf_counter() - start) * 1000)
+    print(f"{name:>12} {sum(samples) / len(samples):8.2f} {percentile(samples, 0.5):8.2f} {percentile(samples, 0.99):8.2f}")
+
+stub.shutdown()
@@ -0,0 +1,370 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Runs the standalone EKS stack's Cloud9 custom resource Lambda against
+# stubbed IAM, Cloud9 and EC2 clients on a simulated clock, driving it the way
+# the CDK provider framework does: on_event, then is_complete every 10s until
+# it reports completion. Reports simulated wall-clock time, Lambda time and
+# status polls to create (with and without the IAM resources already there),
+# update and delete an environment. The sequential mode runs every step in turn
+# and polls every 30s within one invocation, like the handler did before it
+# used backoff. A stubbed Cloud9 environment is ready 90-180s after it is
+# created, its instance is running 30s before that, and it takes 30-90s to
+# delete. New IAM resources become visible after 5s and each call takes
+# 0.2-2s. Each run gives both modes the same environment timings. Exits
+# non-zero when a check fails.
+#
+# usage: python scripts/benchmarks/cloud9_custom_resource_harness.py [runs]
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+import botocore.session
+from botocore.exceptions import ClientError
+from botocore.waiter import NormalizedOperationMethod, Waiter
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+# real seconds per simulated second
+time_scale = 0.002
+query_interval_seconds = 10
+on_event_timeout_seconds = 14 * 60
+is_complete_timeout_seconds = 6 * 60
+iam_visible_after_seconds = 5
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+handler_path = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            "../../standalone-eks-stack/lib/lambda-custom-resource/index.py"))
+spec = importlib.util.spec_from_file_location("cloud9_custom_resource", handler_path)
+handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(handler)
+# the handler logs every response, which only matters in CloudWatch
+handler.print = lambda *args: None
+failures = []
+
+
+# Sleeps for the whole delay, as a fixed poll interval does.
+class NoJitter():
+    def uniform(self, low, high):
+        return high
+
+
+modes = {
+    "sequential": {"provisioning_workers": 1, "poll_initial_delay_seconds": 30, "poll_max_delay_seconds": 30,
+                   "wait_seconds": float("inf"), "random": NoJitter()},
+    "parallel": {},
+}
+defaults = {name: getattr(handler, name) for name in modes["sequential"]}
+
+
+# Simulated seconds pass time_scale times faster than real ones.
+class ScaledClock():
+    def __init__(self):
+        self._started = time.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self._started) / time_scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * time_scale)
+
+
+clock = ScaledClock()
+waiter_models = {service_name: botocore.session.get_session().get_waiter_model(service_name)
+                 for service_name in ("iam", "ec2")}
+handler.time = clock
+sys.modules["botocore.waiter"].time = clock
+
+
+class NoSuchEntityException(ClientError):
+    def __init__(self, operation_name):
+        super().__init__({"Error": {"Code": "NoSuchEntity", "Message": "not found"},
+                          "ResponseMetadata": {"HTTPStatusCode": 404}}, operation_name)
+
+
+class NotFoundException(ClientError):
+    def __init__(self, operation_name):
+        super().__init__({"Error": {"Code": "NotFoundException", "Message": "not found"},
+                          "ResponseMetadata": {"HTTPStatusCode": 404}}, operation_name)
+
+
+class ConflictException(ClientError):
+    pass
+
+
+class StubClient():
+    service_name = None
+    exceptions = type("Exceptions", (), {"NoSuchEntityException": NoSuchEntityException,
+                                         "NotFoundException": NotFoundException,
+                                         "ConflictException": ConflictException})
+
+    def __init__(self, account):
+        self.account = account
+
+    # the handler only waits on IAM and EC2, Cloud9 has no waiters
+    def get_waiter(self, waiter_name):
+        name = "".join(part.capitalize() for part in waiter_name.split("_"))
+        config = waiter_models[self.service_name].get_waiter(name)
+        operation_name = "".join("_" + c.lower() if c.isupper() else c for c in config.operation).lstrip("_")
+        return Waiter(name, config, NormalizedOperationMethod(getattr(self, operation_name)))
+
+    def _call(self, operation_name, latency_seconds, **response):
+        self.account.count(operation_name)
+        clock.sleep(latency_seconds)
+        return dict(response, ResponseMetadata={"HTTPStatusCode": 200})
+
+
+class StubIam(StubClient):
+    service_name = "iam"
+
+    def get_role(self, RoleName):
+        role = self._visible(self.account.roles, RoleName, "GetRole")
+        return self._call("GetRole", 0.2, Role={"RoleName": RoleName, **role})
+
+    def create_role(self, RoleName, AssumeRolePolicyDocument, Path):
+        self.account.roles[RoleName] = {"Path": Path, "created": clock.monotonic()}
+        return self._call("CreateRole", 0.5)
+
+    def list_attached_role_policies(self, RoleName):
+        policies = [{"PolicyArn": arn} for arn in self.account.attached_policies]
+        return self._call("ListAttachedRolePolicies", 0.2, AttachedPolicies=policies)
+
+    def attach_role_policy(self, RoleName, PolicyArn):
+        self.account.attached_policies.append(PolicyArn)
+        return self._call("AttachRolePolicy", 0.3)
+
+    def get_instance_profile(self, InstanceProfileName):
+        instance_profile = self._visible(self.account.instance_profiles, InstanceProfileName, "GetInstanceProfile")
+        return self._call("GetInstanceProfile", 0.2, InstanceProfile=instance_profile)
+
+    def create_instance_profile(self, InstanceProfileName, Path):
+        instance_profile = {"InstanceProfileName": InstanceProfileName, "Path": Path, "Roles": [],
+                            "created": clock.monotonic()}
+        self.account.instance_profiles[InstanceProfileName] = instance_profile
+        return self._call("CreateInstanceProfile", 0.5, InstanceProfile=instance_profile)
+
+    def add_role_to_instance_profile(self, InstanceProfileName, RoleName):
+        self._visible(self.account.roles, RoleName, "AddRoleToInstanceProfile")
+        self._visible(self.account.instance_profiles, InstanceProfileName, "AddRoleToInstanceProfile")
+        self.account.instance_profiles[InstanceProfileName]["Roles"].append({"RoleName": RoleName})
+        return self._call("AddRoleToInstanceProfile", 0.3)
+
+    def _visible(self, entities, name, operation_name):
+        entity = entities.get(name, None)
+        if entity is None or clock.monotonic() - entity["created"] < iam_visible_after_seconds:
+            self.account.count(operation_name)
+            clock.sleep(0.2)
+            raise NoSuchEntityException(operation_name)
+        return entity
+
+
+class StubCloud9(StubClient):
+    service_name = "cloud9"
+
+    def create_environment_ec2(self, **kwargs):
+        environment_id = f"env-{len(self.account.environments)}"
+        self.account.environments[environment_id] = {"created": clock.monotonic(), "deleted": None,
+                                                     "ready_after": self.account.ready_after or
+                                                     self.account.random.uniform(90, 180),
+                                                     "deleted_after": self.account.random.uniform(30, 90)}
+        return self._call("CreateEnvironmentEC2", 2, environmentId=environment_id)
+
+    def create_environment_membership(self, **kwargs):
+        return self._call("CreateEnvironmentMembership", 0.5)
+
+    def describe_environment_status(self, environmentId):
+        environment = self._environment(environmentId, "DescribeEnvironmentStatus")
+        if environment["deleted"] is not None:
+            status = "deleting"
+        elif clock.monotonic() - environment["created"] >= environment["ready_after"]:
+            status = "ready"
+        else:
+            status = "creating"
+        return self._call("DescribeEnvironmentStatus", 0.2, status=status)
+
+    def update_environment(self, environmentId, managedCredentialsAction):
+        self._environment(environmentId, "UpdateEnvironment")["managedCredentials"] = managedCredentialsAction
+        return self._call("UpdateEnvironment", 1)
+
+    def delete_environment(self, environmentId):
+        self._environment(environmentId, "DeleteEnvironment")["deleted"] = clock.monotonic()
+        return self._call("DeleteEnvironment", 0.5)
+
+    def _environment(self, environment_id, operation_name):
+        environment = self.account.environments.get(environment_id, None)
+        if environment is None or (environment["deleted"] is not None and
+                                   clock.monotonic() - environment["deleted"] >= environment["deleted_after"]):
+            self.account.count(operation_name)
+            clock.sleep(0.2)
+            raise NotFoundException(operation_name)
+        return environment
+
+
+class StubEc2(StubClient):
+    service_name = "ec2"
+
+    def describe_instances(self, Filters):
+        states = next(f["Values"] for f in Filters if f["Name"] == "instance-state-name")
+        instances = [{"InstanceId": f"i-{environment_id}", "State": {"Name": state}}
+                     for environment_id, state in self._instance_states() if state in states]
+        reservations = [{"Instances": instances}] if instances else []
+        return self._call("DescribeInstances", 0.5, Reservations=reservations)
+
+    def describe_iam_instance_profile_associations(self, Filters):
+        instance_id = Filters[0]["Values"][0]
+        profile_name = self.account.instance_profile_associations.get(instance_id, "cloud9-default")
+        associations = [{"AssociationId": f"assoc-{instance_id}",
+                         "IamInstanceProfile": {"Arn": f"arn:aws:iam::111122223333:instance-profile/{profile_name}"}}]
+        return self._call("DescribeIamInstanceProfileAssociations", 0.5, IamInstanceProfileAssociations=associations)
+
+    def replace_iam_instance_profile_association(self, AssociationId, IamInstanceProfile):
+        self.account.instance_profile_associations[AssociationId[len("assoc-"):]] = IamInstanceProfile["Name"]
+        return self._call("ReplaceIamInstanceProfileAssociation", 1)
+
+    def reboot_instances(self, InstanceIds):
+        return self._call("RebootInstances", 0.5)
+
+    def _instance_states(self):
+        now = clock.monotonic()
+        for environment_id, environment in self.account.environments.items():
+            if environment["deleted"] is not None:
+                yield environment_id, "terminated"
+            elif now - environment["created"] >= environment["ready_after"] - 30:
+                yield environment_id, "running"
+            else:
+                yield environment_id, "pending"
+
+
+class StubAccount():
+    def __init__(self, seed, iam_exists=False, ready_after=None):
+        self.random = random.Random(seed)
+        self.ready_after = ready_after
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.roles = {}
+        self.instance_profiles = {}
+        self.attached_policies = []
+        self.environments = {}
+        self.instance_profile_associations = {}
+        if iam_exists:
+            self.roles[handler.role_name] = {"created": -3600}
+            self.attached_policies.append(handler.policy_arn)
+            self.instance_profiles[handler.instance_profile_name] = {
+                "InstanceProfileName": handler.instance_profile_name, "created": -3600,
+                "Roles": [{"RoleName": handler.role_name}]}
+
+    def count(self, operation_name):
+        with self._lock:
+            self.calls[operation_name] += 1
+
+
+class LambdaContext():
+    def __init__(self, timeout_seconds):
+        self._deadline = clock.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self._deadline - clock.monotonic()) * 1000)
+
+
+# Invokes the handlers like the provider framework: is_complete is called right
+# after on_event and then every query_interval_seconds. Also returns the longest
+# is_complete invocation.
+def provide(event, account):
+    lambda_seconds = 0
+    longest_seconds = 0
+    started = clock.monotonic()
+    result = handler.on_event(event, LambdaContext(on_event_timeout_seconds))
+    lambda_seconds += clock.monotonic() - started
+    event = dict(event, **result)
+    invocations = 1
+    while True:
+        invoked = clock.monotonic()
+        is_complete_timeout = is_complete_timeout_seconds if handler.wait_seconds != float("inf") else on_event_timeout_seconds
+        completion = handler.is_complete(event, LambdaContext(is_complete_timeout))
+        lambda_seconds += clock.monotonic() - invoked
+        longest_seconds = max(longest_seconds, clock.monotonic() - invoked)
+        invocations += 1
+        if completion["IsComplete"]:
+            return dict(event, Data={**result.get("Data", {}), **completion.get("Data", {})}), \
+                clock.monotonic() - started, lambda_seconds, invocations, longest_seconds
+        clock.sleep(query_interval_seconds)
+
+
+def create_event(request_type, physical_id=None):
+    event = {"RequestType": request_type, "ResourceProperties": {
+        "name": "workshop-instance-test", "instanceProfileName": "workshop-cloud9-profile",
+        "instanceTagKey": "WORKSHOP", "instanceTagValue": "saas-microservices",
+        "instanceIdDataName": "/workshop/cloud9InstanceId", "envIdDataName": "/workshop/cloud9EnvironmentId",
+        "memberArn": "arn:aws:iam::111122223333:role/participant", "connectionType": "CONNECT_SSM",
+        "instanceTypes": ["t3.large", "m5.large"], "imageId": "amazonlinux-2023-x86_64"}}
+    if physical_id is not None:
+        event["PhysicalResourceId"] = physical_id
+    return event
+
+
+def use(account):
+    handler.iam_client = StubIam(account)
+    handler.cloud9_client = StubCloud9(account)
+    handler.ec2_client = StubEc2(account)
+
+
+def scenario(name, account):
+    use(account)
+    if name.startswith("create"):
+        return provide(create_event("Create"), account)
+    environment_id = StubCloud9(account).create_environment_ec2()["environmentId"]
+    account.environments[environment_id]["created"] -= 3600
+    account.calls.clear()
+    if name == "update":
+        return provide(create_event("Update", environment_id), account)
+    return provide(create_event("Delete", environment_id), account)
+
+
+def check(name, ok, detail):
+    print(f"  {'ok' if ok else 'FAILED':>6}  {name}: {detail}")
+    if not ok:
+        failures.append(name)
+
+
+scenarios = {"create": False, "create, IAM exists": True, "update": True, "delete": True}
+results = {}
+print(f"simulated seconds, median of {runs} runs")
+print(f"{'scenario':>18} {'mode':>10} {'wall s':>7} {'lambda s':>9} {'invokes':>8} {'polls':>6}")
+for scenario_name, iam_exists in scenarios.items():
+    for mode, settings in modes.items():
+        for name, value in dict(defaults, **settings).items():
+            setattr(handler, name, value)
+        samples = []
+        for run in range(runs):
+            account = StubAccount(run, iam_exists)
+            event, wall_seconds, lambda_seconds, invocations, _ = scenario(scenario_name, account)
+            samples.append((wall_seconds, lambda_seconds, invocations, account.calls["DescribeEnvironmentStatus"]))
+        results[scenario_name, mode] = (event, account, samples)
+        wall, lambda_seconds, invocations, polls = (statistics.median(sample[i] for sample in samples) for i in range(4))
+        print(f"{scenario_name:>18} {mode:>10} {wall:7.1f} {lambda_seconds:9.1f} {invocations:8.0f} {polls:6.0f}")
+
+for scenario_name in scenarios:
+    sequential = statistics.median(sample[0] for sample in results[scenario_name, "sequential"][2])
+    parallel = statistics.median(sample[0] for sample in results[scenario_name, "parallel"][2])
+    check(f"{scenario_name} is faster", parallel < sequential, f"{parallel:.1f}s against {sequential:.1f}s")
+for mode in modes:
+    event, account, _ = results["create", mode]
+    instance_id = event["Data"].get("/workshop/cloud9InstanceId")
+    check(f"{mode} create sets up the environment",
+          instance_id is not None and account.instance_profile_associations.get(instance_id) == "workshop-cloud9-profile"
+          and account.calls["RebootInstances"] == 1 and account.calls["UpdateEnvironment"] == 1
+          and account.instance_profiles[handler.instance_profile_name]["Roles"] == [{"RoleName": handler.role_name}],
+          f"{instance_id}, {account.calls['RebootInstances']} reboot")
+
+for name, value in defaults.items():
+    setattr(handler, name, value)
+account = StubAccount(0, ready_after=20 * 60)
+event, wall_seconds, _, invocations, longest_seconds = scenario("create", account)
+check("a 20 minute start is handed back", invocations > 2 and longest_seconds < is_complete_timeout_seconds,
+      f"ready after {wall_seconds:.0f}s in {invocations} invocations, the longest took {longest_seconds:.0f}s")
+
+if failures:
+    print(f"{len(failures)} checks failed")
+    sys.exit(1)
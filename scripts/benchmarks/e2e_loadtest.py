@@ -0,0 +1,374 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Runs the product, order and fulfillment services under gunicorn and the
+# invoice consumer locally, against moto (or DynamoDB Local and friends via
+# --aws-endpoint) for DynamoDB, EventBridge and SQS, a token vendor stub and a
+# local JWT issuer whose keys the services verify tokens with. Thousands of
+# synthetic tenants across the basic, advanced and premium tiers, more active
+# the higher their tier, each get a seeded product catalogue. Closed-loop
+# clients then drive a mix of product reads, order creation, order listing
+# and product creation, while the orders flow through the outbox, the
+# fulfillment service, EventBridge and SQS to the invoice consumer.
+#
+# Reports throughput and p50/p99/p999 latency per operation, how long orders
+# took to be invoiced, and per tier how evenly tenants were served (Jain's
+# index of each tenant's share of requests served). --save-baseline stores
+# the results; later runs with the same settings are compared against them
+# and exit non-zero when throughput or latency regressed by more than
+# --tolerance.
+#
+# usage: python scripts/benchmarks/e2e_loadtest.py [--tenants 2000] [--duration 30] [--concurrency 16] [--save-baseline]
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+import boto3
+import requests
+from stub_services import (LocalJwtIssuer, StubTokenVendorHandler, free_port, make_shared_package_dir, percentile,
+                           repo_lib, start_stub_server, wait_until_ready)
+
+tier_shares = {"basic": 0.7, "advanced": 0.2, "premium": 0.1}
+# requests a tenant of each tier sends relative to a basic tenant
+tier_activity = {"basic": 1, "advanced": 3, "premium": 10}
+operation_mix = {"product_read": 0.5, "order_create": 0.3, "order_list": 0.1, "product_create": 0.1}
+
+parser = argparse.ArgumentParser(description="End-to-end multi-tenant load test")
+parser.add_argument("--tenants", type=int, default=2000)
+parser.add_argument("--products-per-tenant", type=int, default=5)
+parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+parser.add_argument("--concurrency", type=int, default=16, help="closed-loop clients")
+parser.add_argument("--workers", type=int, default=2, help="gunicorn workers per service")
+parser.add_argument("--invoice-timeout", type=float, default=60, help="seconds to wait for the last invoices")
+parser.add_argument("--aws-endpoint", help="endpoint of running AWS stand-ins, moto is started when omitted")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines/e2e_loadtest.json"))
+parser.add_argument("--save-baseline", action="store_true")
+parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression against the baseline")
+args = parser.parse_args()
+
+state_dir = tempfile.mkdtemp(prefix="e2e-loadtest-")
+atexit.register(shutil.rmtree, state_dir, True)
+processes = []
+
+
+def stop_processes():
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+atexit.register(stop_processes)
+
+
+def start_process(name, command, cwd, env):
+    log = open(os.path.join(state_dir, f"{name}.log"), "w")
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    processes.append(process)
+    return process
+
+
+aws_endpoint = args.aws_endpoint
+if aws_endpoint is None:
+    moto_port = free_port()
+    start_process("moto", ["moto_server", "-H", "127.0.0.1", "-p", str(moto_port)], state_dir, os.environ)
+    aws_endpoint = f"http://127.0.0.1:{moto_port}"
+    wait_until_ready(f"{aws_endpoint}/moto-api/")
+
+aws_env = {
+    "AWS_ENDPOINT_URL": aws_endpoint,
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "e2e",
+    "AWS_SECRET_ACCESS_KEY": "e2e",
+}
+os.environ.update(aws_env)
+dynamodb = boto3.client("dynamodb")
+for table_name in ("e2e-products", "e2e-orders", "e2e-order-outbox"):
+    key = "productId" if table_name == "e2e-products" else "orderId"
+    attributes = [{"AttributeName": "tenantId", "AttributeType": "S"}, {"AttributeName": key, "AttributeType": "S"}]
+    indexes = {}
+    if table_name == "e2e-order-outbox":
+        # the index the outbox sweepers query, as in order-stack.ts
+        attributes += [{"AttributeName": "sweepBucket", "AttributeType": "N"},
+                       {"AttributeName": "claimedUntil", "AttributeType": "N"}]
+        indexes["GlobalSecondaryIndexes"] = [{
+            "IndexName": "sweep-index",
+            "KeySchema": [{"AttributeName": "sweepBucket", "KeyType": "HASH"},
+                          {"AttributeName": "claimedUntil", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "KEYS_ONLY"},
+        }]
+    dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{"AttributeName": "tenantId", "KeyType": "HASH"}, {"AttributeName": key, "KeyType": "RANGE"}],
+        AttributeDefinitions=attributes,
+        BillingMode="PAY_PER_REQUEST",
+        **indexes,
+    )
+events = boto3.client("events")
+sqs = boto3.client("sqs")
+events.create_event_bus(Name="e2e-bus")
+queue_url = sqs.create_queue(QueueName="e2e-invoices")["QueueUrl"]
+queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["QueueArn"])["Attributes"]["QueueArn"]
+events.put_rule(Name="e2e-invoices", EventBusName="e2e-bus",
+                EventPattern=json.dumps({"source": ["e2e.fulfillment"], "detail-type": ["Order Fulfilled"]}))
+events.put_targets(Rule="e2e-invoices", EventBusName="e2e-bus", Targets=[{"Id": "invoices", "Arn": queue_arn}])
+
+# tenants, their tokens and product catalogues
+issuer = LocalJwtIssuer()
+rng = random.Random(args.seed)
+tenants = []
+for i in range(args.tenants):
+    tier = rng.choices(list(tier_shares), weights=list(tier_shares.values()))[0]
+    tenant_id = f"tenant-{i:05d}"
+    tenants.append({
+        "id": tenant_id,
+        "tier": tier,
+        "authorization": "Bearer " + issuer.mint(tenant_id, tier, ttl_seconds=3600 * 4),
+        "products": [f"prod-{tenant_id}-{j}" for j in range(args.products_per_tenant)],
+    })
+seed_items = [{"PutRequest": {"Item": {
+    "tenantId": {"S": tenant["id"]}, "productId": {"S": product_id}, "name": {"S": product_id},
+    "description": {"S": "seeded product"}, "price": {"S": f"{rng.randint(100, 10000) / 100}"},
+}}} for tenant in tenants for product_id in tenant["products"]]
+for start in range(0, len(seed_items), 25):
+    request_items = {"e2e-products": seed_items[start:start + 25]}
+    while request_items:
+        request_items = dynamodb.batch_write_item(RequestItems=request_items).get("UnprocessedItems", {})
+tenant_weights = [tier_activity[tenant["tier"]] for tenant in tenants]
+
+# the services
+shared_dir = make_shared_package_dir()
+token_vendor_stub, token_vendor_endpoint = start_stub_server(StubTokenVendorHandler)
+ports = {service: free_port() for service in ("product", "order", "fulfillment")}
+service_env = dict(
+    os.environ,
+    PYTHONPATH=shared_dir,
+    GUNICORN_WORKERS=str(args.workers),
+    JWKS_URI=issuer.jwks_uri,
+    TOKEN_VENDOR_ENDPOINT_PORT=token_vendor_endpoint.split(":")[1],
+    PRODUCT_ENDPOINT=f"127.0.0.1:{ports['product']}",
+    FULFILLMENT_ENDPOINT=f"127.0.0.1:{ports['fulfillment']}",
+    AWS_EMF_ENVIRONMENT="Local",
+    LOG_LEVEL="WARNING",
+)
+service_envs = {
+    "product": {"TABLE_NAME": "e2e-products", "PRODUCT_CACHE_PATH": os.path.join(state_dir, "product-cache.db")},
+    "order": {"TABLE_NAME": "e2e-orders", "OUTBOX_TABLE_NAME": "e2e-order-outbox"},
+    "fulfillment": {"EVENT_BUS_NAME": "e2e-bus", "EVENT_SOURCE": "e2e.fulfillment", "EVENT_DETAIL_TYPE": "Order Fulfilled"},
+}
+for service, port in ports.items():
+    env = dict(service_env, SERVICE_NAME=f"{service}-e2e", ADMISSION_CONTROL="true",
+               ADMISSION_BUCKETS_PATH=os.path.join(state_dir, f"{service}-buckets.db"), **service_envs[service])
+    start_process(service, ["gunicorn", "--bind", f"127.0.0.1:{port}"], os.path.join(repo_lib, service, "app/code"), env)
+# invoices are logged at INFO and every one of them is needed to measure the lag
+start_process("invoice", [sys.executable, "app.py"], os.path.join(repo_lib, "invoice/app/code"), dict(
+    service_env, SERVICE_NAME="invoice-e2e", QUEUE_URL=queue_url, INVOICE_IDLE_EXIT_SECONDS="0",
+    LOG_LEVEL="INFO", LOG_TENANT_RATE_LIMIT="0"))
+for service, port in ports.items():
+    wait_until_ready(f"http://127.0.0.1:{port}/{service}s/health")
+
+product_url = f"http://127.0.0.1:{ports['product']}"
+order_url = f"http://127.0.0.1:{ports['order']}"
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+
+def product_read(tenant, thread_rng):
+    return session.get(f"{product_url}/products/{thread_rng.choice(tenant['products'])}",
+                       headers={"Authorization": tenant["authorization"]})
+
+
+def order_create(tenant, thread_rng):
+    products = thread_rng.sample(tenant["products"], thread_rng.randint(1, min(3, len(tenant["products"]))))
+    return session.post(f"{order_url}/orders", json={"name": "e2e order", "products": products},
+                        headers={"Authorization": tenant["authorization"]})
+
+
+def order_list(tenant, thread_rng):
+    return session.get(f"{order_url}/orders?limit=20", headers={"Authorization": tenant["authorization"]})
+
+
+def product_create(tenant, thread_rng):
+    response = session.post(f"{product_url}/products", json={
+        "name": "e2e product", "description": "created under load", "price": str(thread_rng.randint(100, 10000) / 100),
+    }, headers={"Authorization": tenant["authorization"]})
+    if response.status_code == 201:
+        tenant["products"].append(response.json()["product"]["product_id"])
+    return response
+
+
+operations = {"product_read": product_read, "order_create": order_create, "order_list": order_list,
+              "product_create": product_create}
+samples = []
+created_orders = {}
+measure_from = time.time() + args.warmup
+stop_at = measure_from + args.duration
+
+
+def client_loop(client_id):
+    thread_rng = random.Random(args.seed * 1000 + client_id)
+    while time.time() < stop_at:
+        tenant = thread_rng.choices(tenants, weights=tenant_weights)[0]
+        operation = thread_rng.choices(list(operation_mix), weights=list(operation_mix.values()))[0]
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            response = operations[operation](tenant, thread_rng)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 599
+        latency_ms = (time.perf_counter() - start) * 1000
+        if operation == "order_create" and status == 200:
+            created_orders[response.json()["order"]["order_id"]] = time.time()
+        if started >= measure_from:
+            samples.append((operation, tenant["id"], tenant["tier"], status, latency_ms))
+
+
+print(f"{args.tenants} tenants, {len(seed_items)} products, {args.concurrency} clients, "
+      f"{args.workers} workers per service, {args.duration:.0f}s after {args.warmup:.0f}s warm-up")
+threads = [threading.Thread(target=client_loop, args=(client_id,)) for client_id in range(args.concurrency)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+
+def read_invoices():
+    invoiced = {}
+    with open(os.path.join(state_dir, "invoice.log")) as log:
+        for line in log:
+            if "Invoice created for order" not in line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            invoiced[record["message"].split()[4]] = datetime.fromisoformat(record["timestamp"]).timestamp()
+    return invoiced
+
+
+invoice_deadline = time.time() + args.invoice_timeout
+invoiced = read_invoices()
+while time.time() < invoice_deadline and not created_orders.keys() <= invoiced.keys():
+    time.sleep(1)
+    invoiced = read_invoices()
+stop_processes()
+
+
+def latency_summary(latencies, served, total, seconds):
+    return {
+        "requests": total,
+        "rps": served / seconds,
+        "p50": percentile(latencies, 0.5) if latencies else None,
+        "p99": percentile(latencies, 0.99) if latencies else None,
+        "p999": percentile(latencies, 0.999) if latencies else None,
+        "error_rate": 1 - served / total if total else 0.0,
+    }
+
+
+def jain_index(values):
+    return sum(values) ** 2 / (len(values) * sum(value * value for value in values)) if values and any(values) else 1.0
+
+
+results = {"config": {name: getattr(args, name) for name in ("tenants", "products_per_tenant", "duration", "concurrency", "workers")},
+           "machine": {"platform": platform.platform(), "cpus": os.cpu_count()},
+           "operations": {}, "tiers": {}}
+by_operation = defaultdict(list)
+for sample in samples:
+    by_operation[sample[0]].append(sample)
+by_operation["all"] = samples
+for operation, operation_samples in by_operation.items():
+    served = [sample for sample in operation_samples if sample[3] < 400]
+    results["operations"][operation] = latency_summary(
+        [sample[4] for sample in served], len(served), len(operation_samples), args.duration)
+    results["operations"][operation]["statuses"] = dict(Counter(str(sample[3]) for sample in operation_samples))
+
+for tier in tier_shares:
+    tier_samples = [sample for sample in samples if sample[2] == tier]
+    per_tenant = defaultdict(lambda: [0, 0])
+    for sample in tier_samples:
+        per_tenant[sample[1]][0] += 1
+        per_tenant[sample[1]][1] += sample[3] < 400
+    served = [sample for sample in tier_samples if sample[3] < 400]
+    results["tiers"][tier] = dict(
+        latency_summary([sample[4] for sample in served], len(served), len(tier_samples), args.duration),
+        tenants=len(per_tenant),
+        throttled=sum(1 for sample in tier_samples if sample[3] == 429),
+        fairness=jain_index([served_count / sent for sent, served_count in per_tenant.values()]),
+    )
+
+lags = sorted((invoiced[order_id] - created_at) * 1000 for order_id, created_at in created_orders.items() if order_id in invoiced)
+results["invoices"] = {
+    "orders": len(created_orders),
+    "invoiced": len(lags),
+    "lag_p50": percentile(lags, 0.5) if lags else None,
+    "lag_p99": percentile(lags, 0.99) if lags else None,
+}
+
+
+def ms(value):
+    return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+
+
+print(f"{'operation':>15} {'requests':>9} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'errors':>7}")
+for operation, summary in results["operations"].items():
+    print(f"{operation:>15} {summary['requests']:>9} {summary['rps']:8.1f} {ms(summary['p50'])} {ms(summary['p99'])} "
+          f"{ms(summary['p999'])} {summary['error_rate']:7.1%}")
+print(f"{'tier':>15} {'tenants':>9} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'throttled':>9} {'fairness':>9}")
+for tier, summary in results["tiers"].items():
+    print(f"{tier:>15} {summary['tenants']:>9} {summary['rps']:8.1f} {ms(summary['p50'])} {ms(summary['p99'])} "
+          f"{summary['throttled']:>9} {summary['fairness']:9.3f}")
+invoices = results["invoices"]
+print(f"invoiced {invoices['invoiced']} of {invoices['orders']} orders, lag p50 {ms(invoices['lag_p50']).strip()}ms "
+      f"p99 {ms(invoices['lag_p99']).strip()}ms")
+
+
+def regressions(baseline):
+    found = []
+    for operation, summary in results["operations"].items():
+        base = baseline["operations"].get(operation, None)
+        if base is None:
+            continue
+        if summary["rps"] < base["rps"] * (1 - args.tolerance):
+            found.append(f"{operation} throughput {summary['rps']:.1f} req/s, baseline {base['rps']:.1f}")
+        if summary["p99"] is not None and base["p99"] is not None and summary["p99"] > base["p99"] * (1 + args.tolerance):
+            found.append(f"{operation} p99 {summary['p99']:.1f}ms, baseline {base['p99']:.1f}ms")
+        if summary["error_rate"] > base["error_rate"] + 0.01:
+            found.append(f"{operation} errors {summary['error_rate']:.1%}, baseline {base['error_rate']:.1%}")
+    if invoices["orders"] and invoices["invoiced"] < invoices["orders"]:
+        found.append(f"{invoices['orders'] - invoices['invoiced']} orders were not invoiced")
+    return found
+
+
+if args.save_baseline:
+    os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+    with open(args.baseline, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print(f"saved baseline to {args.baseline}")
+elif os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["config"] != results["config"]:
+        print(f"not comparing with {args.baseline}, it was recorded with {baseline['config']}")
+    else:
+        found = regressions(baseline)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
@@ -0,0 +1,112 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Injects faults into a local stub service and checks how the shared
+# resilient HTTP client copes, against a plain requests session:
+#   latency spikes  a few slow answers, hedged GETs cut the tail
+#   transient 503s  idempotent calls are retried, POSTs are sent once
+#   endpoint down   the circuit opens and calls fail fast, a probe closes it
+#                   again once the endpoint recovers
+#   hung endpoint   calls give up at the deadline, which is passed on
+# Exits non-zero when a check fails.
+#
+# usage: python scripts/benchmarks/http_fault_injection_harness.py [requests]
+import sys
+import time
+from collections import Counter
+import requests
+from stub_services import StubFaultyHandler, make_shared_package_dir, percentile, start_stub_server
+
+sys.path.insert(0, make_shared_package_dir())
+from shared.resilient_http import CircuitOpenError, ResilientHTTPClient, deadline  # noqa: E402
+
+request_count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+failures = []
+
+
+def check(name, ok, detail):
+    print(f"  {'ok' if ok else 'FAILED':>6}  {name}: {detail}")
+    if not ok:
+        failures.append(name)
+
+
+def start_faulty_stub(**faults):
+    handler = type("FaultyHandler", (StubFaultyHandler,), dict(faults, requests=[]))
+    server, endpoint = start_stub_server(handler)
+    return handler, f"http://{endpoint}/products"
+
+
+def new_client(events, **kwargs):
+    return ResilientHTTPClient(on_event=lambda metric_name, endpoint: events.update([metric_name]), **kwargs)
+
+
+def timed_calls(call, count):
+    samples, statuses = [], Counter()
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            statuses[call().status_code] += 1
+        except requests.RequestException as e:
+            statuses[type(e).__name__] += 1
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, statuses
+
+
+print("latency spikes, 3% of answers take 300ms")
+handler, url = start_faulty_stub(slow_rate=0.03, slow_seconds=0.3)
+session = requests.Session()
+plain, _ = timed_calls(lambda: session.get(url, timeout=5), request_count)
+events = Counter()
+client = new_client(events, hedge=True)
+hedged, _ = timed_calls(lambda: client.get(url, timeout=5), request_count)
+print(f"  {'client':>8} {'p50 ms':>8} {'p99 ms':>8}")
+for name, samples in (("plain", plain), ("hedged", hedged)):
+    print(f"  {name:>8} {percentile(samples, 0.5):8.2f} {percentile(samples, 0.99):8.2f}")
+check("hedging cuts p99", percentile(hedged, 0.99) < percentile(plain, 0.99) / 2,
+      f"{events['HttpHedges']} hedges, {events['HttpHedgeWins']} won")
+
+print("transient 503s on 30% of answers")
+handler, url = start_faulty_stub(error_rate=0.3)
+events = Counter()
+client = new_client(events, failure_threshold=20)
+_, statuses = timed_calls(lambda: client.get(url, timeout=5), request_count)
+check("GETs are retried", statuses[200] >= request_count * 0.95, f"{statuses[200]} of {request_count} succeeded, "
+      f"{events['HttpRetries']} retries")
+sent_before = len(handler.requests)
+_, statuses = timed_calls(lambda: client.post(url, json={}, timeout=5), request_count)
+check("POSTs are sent once", len(handler.requests) - sent_before == request_count,
+      f"{len(handler.requests) - sent_before} sent for {request_count} calls, {statuses[503]} answered 503")
+
+print("endpoint down, then recovering")
+handler, url = start_faulty_stub(error_rate=1.0)
+events = Counter()
+client = new_client(events, failure_threshold=5, reset_timeout_seconds=0.5, backoff_base_seconds=0.01)
+samples, statuses = timed_calls(lambda: client.get(url, timeout=5), request_count)
+check("the circuit opens", len(handler.requests) <= 10,
+      f"{len(handler.requests)} requests reached the endpoint, {statuses['CircuitOpenError']} calls rejected")
+check("rejected calls fail fast", percentile(samples, 0.5) < 1, f"p50 {percentile(samples, 0.5):.3f}ms")
+handler.error_rate = 0.0
+time.sleep(0.6)
+response = client.get(url, timeout=5)
+check("a probe closes the circuit", response.status_code == 200 and client.breakers[client._endpoint(url)].state == "closed",
+      f"{events['HttpCircuitOpen']} opened, {events['HttpCircuitHalfOpen']} probed, {events['HttpCircuitClosed']} closed")
+
+print("hung endpoint, 250ms deadline")
+handler, url = start_faulty_stub(slow_rate=1.0, slow_seconds=2)
+events = Counter()
+client = new_client(events)
+start = time.perf_counter()
+try:
+    with deadline(0.25):
+        client.get(url, timeout=5)
+    outcome = "answered"
+except (requests.Timeout, CircuitOpenError) as e:
+    outcome = type(e).__name__
+elapsed = time.perf_counter() - start
+check("calls stop at the deadline", outcome != "answered" and elapsed < 0.4, f"{outcome} after {elapsed * 1000:.0f}ms")
+propagated = [int(header) for _, header in handler.requests if header is not None]
+check("the deadline is passed on", bool(propagated) and max(propagated) <= 250,
+      f"X-Request-Deadline-Ms {propagated}")
+
+if failures:
+    print(f"{len(failures)} checks failed")
+    sys.exit(1)
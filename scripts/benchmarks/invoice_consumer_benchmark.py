@@ -0,0 +1,49 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Drains an in-memory SQS stand-in with the invoice consumer pipeline and
+# reports messages/sec as the worker count grows. Processing a message is
+# simulated with a fixed delay standing in for the product price lookup.
+#
+# usage: python scripts/benchmarks/invoice_consumer_benchmark.py [messages] [processing_ms]
+import os
+import sys
+import time
+from stub_services import LocalSqsQueue, add_service_to_path
+
+message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+processing_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+os.environ.update({
+    "PRODUCT_ENDPOINT": "127.0.0.1:1",
+    "SERVICE_NAME": "invoice-benchmark",
+    "QUEUE_URL": "http://localhost/queue",
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+    "INVOICE_VISIBILITY_TIMEOUT_SECONDS": "30",
+})
+add_service_to_path("invoice")
+import app as invoice  # noqa: E402
+
+invoice.wait_time_seconds = 0
+
+last_processed_at = 0
+
+
+def simulated_processing(message):
+    global last_processed_at
+    time.sleep(processing_ms / 1000)
+    last_processed_at = time.perf_counter()
+
+
+print(f"{'workers':>7} {'msgs/s':>10} {'receives':>9} {'deletes':>8}")
+for workers in (1, 2, 4, 8, 16, 32):
+    local_queue = LocalSqsQueue()
+    for _ in range(message_count):
+        local_queue.send({})
+    # every message belongs to the same unknown tenant, so process them in order
+    consumer = invoice.InvoiceConsumer(local_queue, "local", process=simulated_processing, workers=workers,
+                                       receive_loops=2, idle_exit_seconds=0.2, fair_scheduling=False,
+                                       on_queue_wait=lambda tenant_context, seconds: None)
+    start = time.perf_counter()
+    consumer.run()
+    elapsed = last_processed_at - start
+    print(f"{workers:>7} {consumer.processed / elapsed:10.1f} {local_queue.receive_calls:>9} {local_queue.delete_calls:>8}")
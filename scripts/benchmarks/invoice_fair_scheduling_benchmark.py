@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Puts a burst of orders from one basic tenant on an in-memory SQS stand-in
+# while premium and advanced tenants keep sending a few orders each, then
+# drains it with the invoice consumer in arrival order and with fair
+# scheduling. Reports invoice latency per tier (sent to processed), time
+# waited for a worker and how long the burst took to drain. Processing a
+# message is simulated with a fixed delay.
+#
+# usage: python scripts/benchmarks/invoice_fair_scheduling_benchmark.py [burst] [processing_ms]
+import os
+import sys
+import threading
+import time
+import json
+from collections import defaultdict
+from stub_services import LocalSqsQueue, add_service_to_path, percentile
+
+burst_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+processing_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+workers = 8
+steady_tenants = [("tenant-premium-1", "premium"), ("tenant-premium-2", "premium"), ("tenant-advanced-1", "advanced")]
+steady_interval_seconds = 0.05
+
+os.environ.update({
+    "PRODUCT_ENDPOINT": "127.0.0.1:1",
+    "SERVICE_NAME": "invoice-benchmark",
+    "QUEUE_URL": "http://localhost/queue",
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+    "INVOICE_VISIBILITY_TIMEOUT_SECONDS": "30",
+})
+add_service_to_path("invoice")
+import app as invoice  # noqa: E402
+
+invoice.wait_time_seconds = 0
+# deferrals are counted in EMF, which has nowhere to go here
+invoice.create_emf_log_with_tenant_context = lambda *args: None
+
+
+def run(fair_scheduling):
+    local_queue = LocalSqsQueue()
+    latencies = defaultdict(list)
+    queue_waits = defaultdict(list)
+    burst_done = []
+    lock = threading.Lock()
+
+    def process(message):
+        detail = json.loads(message["Body"])["detail"]
+        time.sleep(processing_ms / 1000)
+        now = time.monotonic()
+        with lock:
+            latencies[detail["tenantTier"]].append((now - detail["sentAt"]) * 1000)
+            if detail["tenantTier"] == "basic" and len(latencies["basic"]) == burst_size:
+                burst_done.append(now)
+
+    def record_queue_wait(tenant_context, seconds):
+        with lock:
+            queue_waits[tenant_context.tenant_tier].append(seconds * 1000)
+
+    def send_steady(until):
+        while time.monotonic() < until:
+            for tenant_id, tier in steady_tenants:
+                local_queue.send({"tenantId": tenant_id, "tenantTier": tier, "sentAt": time.monotonic()})
+            time.sleep(steady_interval_seconds)
+
+    start = time.monotonic()
+    for _ in range(burst_size):
+        local_queue.send({"tenantId": "tenant-burst", "tenantTier": "basic", "sentAt": start})
+    # the steady tenants keep sending for about as long as the burst takes in arrival order
+    sender = threading.Thread(target=send_steady, args=(start + burst_size * processing_ms / 1000 / workers,))
+    sender.start()
+    consumer = invoice.InvoiceConsumer(local_queue, "local", process=process, workers=workers, receive_loops=2,
+                                       idle_exit_seconds=0.3, fair_scheduling=fair_scheduling,
+                                       on_queue_wait=record_queue_wait)
+    consumer_thread = threading.Thread(target=consumer.run)
+    consumer_thread.start()
+    sender.join()
+    consumer_thread.join()
+    return latencies, queue_waits, burst_done[0] - start, consumer
+
+
+print(f"burst of {burst_size} basic orders, {len(steady_tenants)} tenants sending every {steady_interval_seconds * 1000:.0f}ms, "
+      f"{processing_ms:.0f}ms per message, {workers} workers")
+print(f"{'scheduling':>10} {'tier':>9} {'orders':>7} {'p50 ms':>8} {'p99 ms':>8} {'wait p99':>9} {'burst s':>8} {'deferred':>9}")
+for name, fair_scheduling in (("arrival", False), ("fair", True)):
+    latencies, queue_waits, burst_seconds, consumer = run(fair_scheduling)
+    for tier in ("premium", "advanced", "basic"):
+        samples = latencies[tier]
+        print(f"{name:>10} {tier:>9} {len(samples):>7} {percentile(samples, 0.5):8.1f} {percentile(samples, 0.99):8.1f} "
+              f"{percentile(queue_waits[tier], 0.99):9.1f} {burst_seconds:8.2f} {consumer.deferred:>9}")
@@ -0,0 +1,55 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Measures invoice calculate_order_total latency against a local stub product
+# service as the basket grows, comparing sequential bare requests.get calls
+# with the pooled products:batchGet lookup and with totalling the line items
+# snapshotted at order time.
+#
+# usage: python scripts/benchmarks/invoice_order_total_benchmark.py [rounds] [latency_ms]
+import os
+import sys
+import time
+import requests
+from stub_services import StubProductHandler, add_service_to_path, percentile, start_stub_server
+
+rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+server, endpoint = start_stub_server(StubProductHandler, latency_seconds=latency_ms / 1000)
+os.environ.update({
+    "PRODUCT_ENDPOINT": endpoint,
+    "SERVICE_NAME": "invoice-benchmark",
+    "QUEUE_URL": "http://localhost/queue",
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+})
+add_service_to_path("invoice")
+import app as invoice  # noqa: E402
+
+
+def sequential_order_total(product_ids, authorization):
+    total_price = 0
+    for product_id in product_ids:
+        response = requests.get(url=f"http://{endpoint}/products/{product_id}", headers={"Authorization": authorization})
+        total_price += float(response.json()["product"]["price"])
+    return total_price
+
+
+def snapshot_order_total(product_ids, authorization):
+    return invoice.calculate_line_items_total(line_items)
+
+
+print(f"{'basket':>6} {'implementation':>16} {'p50 ms':>8} {'p99 ms':>8}")
+for basket_size in (1, 5, 10, 25, 50):
+    # every fifth product is a repeat to exercise de-duplication
+    product_ids = [f"prod-{i - i % 5 if i % 5 == 4 else i}" for i in range(basket_size)]
+    line_items = [{"product_id": product_id, "unit_price": "10.0", "quantity": 1} for product_id in product_ids]
+    for name, fn in (("sequential", sequential_order_total), ("batched", invoice.calculate_order_total),
+                     ("snapshot", snapshot_order_total)):
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fn(product_ids, "Bearer benchmark")
+            samples.append((time.perf_counter() - start) * 1000)
+        print(f"{basket_size:>6} {name:>16} {percentile(samples, 0.5):8.2f} {percentile(samples, 0.99):8.2f}")
+
+server.shutdown()
@@ -0,0 +1,101 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Measures the latency of a Flask handler that logs a few debug and info
+# lines per request, writing to a sink that takes write_latency_ms per write
+# like a busy container log pipe. Compares logging off, the previous setup
+# (DEBUG through Flask's synchronous handler, f-string messages) and the
+# shared JSON logging through a background queue, with and without the
+# per-tenant rate limit. Lines the queue had no room for are dropped. Each
+# setup runs in its own process.
+#
+# usage: python scripts/benchmarks/logging_benchmark.py [requests] [write_latency_ms]
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import jwt
+from stub_services import make_shared_package_dir, percentile
+
+request_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+write_latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+log_lines_per_request = 5
+
+setups = {
+    "off": {"LOG_LEVEL": "WARNING"},
+    "sync": {},
+    "queued": {"LOG_LEVEL": "DEBUG", "LOG_TENANT_RATE_LIMIT": "0"},
+    "queued, sampled": {"LOG_LEVEL": "DEBUG"},
+}
+
+
+class SlowSink():
+    def __init__(self):
+        self.writes = 0
+        self.devnull = open(os.devnull, "w")
+
+    def write(self, text):
+        time.sleep(write_latency_ms / 1000)
+        self.writes += 1
+        return self.devnull.write(text)
+
+    def flush(self):
+        self.devnull.flush()
+
+
+def run(setup, env, results):
+    os.environ.update(env)
+    sys.path.insert(0, make_shared_package_dir())
+    from flask import Flask, request
+    from shared.helper_functions import get_tenant_context, init_logging
+    from shared.structured_logging import configure_logging
+
+    sink = SlowSink()
+    app = Flask(__name__)
+    if setup == "sync":
+        from flask.logging import default_handler
+        default_handler.setStream(sink)
+        app.logger.setLevel(logging.DEBUG)
+    else:
+        handler = configure_logging("logging-benchmark", stream=sink)
+        init_logging(app, "logging-benchmark")
+
+    @app.route("/work/<item_id>")
+    def work(item_id):
+        tenant_context = get_tenant_context(request.headers.get("Authorization", None))
+        if setup == "sync":
+            for step in range(log_lines_per_request):
+                app.logger.debug(f"Step {step} of {item_id}, tenant: {tenant_context.tenant_id}")
+            app.logger.info(f"Finished {item_id}, tenant: {tenant_context.tenant_id}")
+        else:
+            for step in range(log_lines_per_request):
+                app.logger.debug("Step %s of %s", step, item_id)
+            app.logger.info("Finished %s", item_id)
+        return {"msg": "ok"}, 200
+
+    authorization = "Bearer " + jwt.encode(
+        {"custom:tenant_id": "tenant-1", "custom:tenant_tier": "basic", "exp": int(time.time()) + 3600},
+        "logging-benchmark-secret-of-32-bytes", algorithm="HS256")
+    client = app.test_client()
+    samples = []
+    for i in range(request_count):
+        start = time.perf_counter()
+        client.get(f"/work/item-{i}", headers={"Authorization": authorization, "X-B3-TraceId": f"{i:032x}"})
+        samples.append((time.perf_counter() - start) * 1000)
+    dropped = 0
+    if setup != "sync":
+        handler.flush()
+        dropped = handler.dropped
+    results.put((percentile(samples, 0.5), percentile(samples, 0.99), sink.writes, dropped))
+
+
+print(f"{'setup':>16} {'p50 ms':>8} {'p99 ms':>8} {'lines':>8} {'dropped':>8}")
+for setup, env in setups.items():
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run, args=(setup, env, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception(f"{setup} run failed with exit code {process.exitcode}")
+    p50, p99, writes, dropped = results.get()
+    print(f"{setup:>16} {p50:8.3f} {p99:8.3f} {writes:>8} {dropped:>8}")
@@ -0,0 +1,88 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Runs the order service under gunicorn against local DynamoDB, product,
+# token vendor and fulfillment stubs and imports orders the way a tenant's
+# import job would, one POST /orders at a time and through POST /orders:batch.
+# The DynamoDB stub leaves unprocessed_rate of each BatchWriteItem
+# unprocessed, so the batches exercise the retries.
+#
+# usage: python scripts/benchmarks/order_import_benchmark.py [orders] [batch_size] [latency_ms] [unprocessed_rate]
+import os
+import subprocess
+import sys
+import time
+import jwt
+import requests
+from stub_services import (StubDynamoDBHandler, StubFulfillmentHandler, StubProductHandler, StubTokenVendorHandler,
+                           free_port, make_shared_package_dir, repo_lib, start_stub_server, wait_until_ready)
+
+order_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+unprocessed_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+
+dynamodb_handler = type("FlakyDynamoDBHandler", (StubDynamoDBHandler,), {"unprocessed_rate": unprocessed_rate})
+dynamodb_stub, dynamodb_endpoint = start_stub_server(dynamodb_handler, latency_seconds=latency_ms / 1000)
+product_stub, product_endpoint = start_stub_server(StubProductHandler, latency_seconds=latency_ms / 1000)
+token_vendor_stub, token_vendor_endpoint = start_stub_server(StubTokenVendorHandler, latency_seconds=latency_ms / 1000)
+fulfillment_stub, fulfillment_endpoint = start_stub_server(StubFulfillmentHandler, latency_seconds=latency_ms / 1000)
+
+authorization = "Bearer " + jwt.encode(
+    {"custom:tenant_id": "tenant-import", "custom:tenant_tier": "premium", "exp": int(time.time()) + 3600},
+    "order-import-benchmark-secret-32-bytes", algorithm="HS256")
+orders = [{"name": f"imported-{i}", "products": [f"prod-{i % 20}", f"prod-{i % 7}"]} for i in range(order_count)]
+
+
+def import_one_by_one(session, base_url):
+    created = 0
+    for order in orders:
+        response = session.post(f"{base_url}/orders", json=order, headers={"Authorization": authorization})
+        created += response.status_code == 200
+    return created
+
+
+def import_in_batches(session, base_url):
+    created = 0
+    for start in range(0, len(orders), batch_size):
+        response = session.post(f"{base_url}/orders:batch", json={"orders": orders[start:start + batch_size]},
+                                headers={"Authorization": authorization})
+        response.raise_for_status()
+        created += sum(1 for result in response.json()["results"] if result["status"] == "created")
+    return created
+
+
+port = free_port()
+env = dict(
+    os.environ,
+    PYTHONPATH=make_shared_package_dir(),
+    GUNICORN_WORKERS="1",
+    ADMISSION_CONTROL="false",
+    LOG_LEVEL="WARNING",
+    TABLE_NAME="orders",
+    OUTBOX_TABLE_NAME="order-outbox",
+    FULFILLMENT_ENDPOINT=fulfillment_endpoint,
+    PRODUCT_ENDPOINT=product_endpoint,
+    TOKEN_VENDOR_ENDPOINT_PORT=token_vendor_endpoint.split(":")[1],
+    SERVICE_NAME="order-import-benchmark",
+    AWS_EMF_ENVIRONMENT="Local",
+    AWS_DEFAULT_REGION="us-east-1",
+    AWS_ACCESS_KEY_ID="benchmark",
+    AWS_SECRET_ACCESS_KEY="benchmark",
+    AWS_ENDPOINT_URL_DYNAMODB=f"http://{dynamodb_endpoint}",
+)
+server = subprocess.Popen(["gunicorn", "--bind", f"127.0.0.1:{port}"], cwd=os.path.join(repo_lib, "order/app/code"),
+                          env=env, stdout=subprocess.DEVNULL)
+base_url = f"http://127.0.0.1:{port}"
+try:
+    wait_until_ready(f"{base_url}/orders/health")
+    session = requests.Session()
+    print(f"{order_count} orders, stub latency {latency_ms:.0f}ms, {unprocessed_rate:.0%} of batch writes unprocessed")
+    print(f"{'import':>12} {'created':>8} {'seconds':>8} {'orders/s':>9}")
+    for name, fn in (("one by one", import_one_by_one), (f"batch of {batch_size}", import_in_batches)):
+        start = time.perf_counter()
+        created = fn(session, base_url)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>12} {created:>8} {elapsed:8.2f} {created / elapsed:9.0f}")
+finally:
+    server.terminate()
+    server.wait()
@@ -0,0 +1,173 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Creates orders through the order service's POST /orders and
+# POST /orders:batch against a local DynamoDB (moto, or DynamoDB Local via
+# AWS_ENDPOINT_URL_DYNAMODB), a product stub that fails a share of the price
+# lookups and a fulfillment stub that rejects a share of the requests and
+# orders. Reports POST /orders latency, reads the orders back through
+# GET /orders, then waits for the outbox dispatcher to drain the outbox and
+# checks that every order was fulfilled, and that none reached the sweeper
+# without the line items that spare the invoice a price lookup.
+#
+# usage: python scripts/benchmarks/order_outbox_harness.py [orders] [request_failure_rate] [order_failure_rate]
+import logging
+import os
+import sys
+import time
+import jwt
+from concurrent.futures import ThreadPoolExecutor
+from stub_services import StubFulfillmentHandler, StubProductHandler, StubTokenVendorHandler, add_service_to_path, percentile, start_stub_server
+
+order_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+request_failure_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+order_failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+tenant_count = 10
+product_failure_rate = 0.3
+
+if "AWS_ENDPOINT_URL_DYNAMODB" not in os.environ:
+    from moto.server import ThreadedMotoServer
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    moto_server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    moto_server.start()
+    host, port = moto_server.get_host_and_port()
+    os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = f"http://{host}:{port}"
+
+fulfillment_handler = type("FlakyFulfillmentHandler", (StubFulfillmentHandler,), {
+    "failure_rate": request_failure_rate,
+    "item_failure_rate": order_failure_rate,
+    "fulfilled": [],
+    "swept": [],
+    "unpriced": [],
+})
+fulfillment_stub, fulfillment_endpoint = start_stub_server(fulfillment_handler)
+token_vendor_stub, token_vendor_endpoint = start_stub_server(StubTokenVendorHandler)
+product_handler = type("FlakyProductHandler", (StubProductHandler,), {"failure_rate": product_failure_rate})
+product_stub, product_endpoint = start_stub_server(product_handler)
+os.environ.update({
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+    "AWS_ACCESS_KEY_ID": "harness",
+    "AWS_SECRET_ACCESS_KEY": "harness",
+    "TOKEN_VENDOR_ENDPOINT_PORT": token_vendor_endpoint.split(":")[1],
+    "TABLE_NAME": "harness-orders",
+    "OUTBOX_TABLE_NAME": "harness-order-outbox",
+    "FULFILLMENT_ENDPOINT": fulfillment_endpoint,
+    "PRODUCT_ENDPOINT": product_endpoint,
+    "SERVICE_NAME": "order-harness",
+    "OUTBOX_LEASE_SECONDS": "5",
+    "OUTBOX_SWEEP_INTERVAL_SECONDS": "1",
+    "AWS_EMF_ENVIRONMENT": "Local",
+})
+
+import boto3  # noqa: E402
+dynamodb = boto3.resource("dynamodb")
+key_schema = {
+    "KeySchema": [{"AttributeName": "tenantId", "KeyType": "HASH"}, {"AttributeName": "orderId", "KeyType": "RANGE"}],
+    "AttributeDefinitions": [{"AttributeName": "tenantId", "AttributeType": "S"},
+                             {"AttributeName": "orderId", "AttributeType": "S"}],
+}
+dynamodb.create_table(TableName=os.environ["TABLE_NAME"], BillingMode="PAY_PER_REQUEST", **key_schema)
+# the outbox also has the index its sweepers query, as in order-stack.ts
+dynamodb.create_table(
+    TableName=os.environ["OUTBOX_TABLE_NAME"],
+    BillingMode="PAY_PER_REQUEST",
+    KeySchema=key_schema["KeySchema"],
+    AttributeDefinitions=key_schema["AttributeDefinitions"] + [{"AttributeName": "sweepBucket", "AttributeType": "N"},
+                                                               {"AttributeName": "claimedUntil", "AttributeType": "N"}],
+    GlobalSecondaryIndexes=[{
+        "IndexName": "sweep-index",
+        "KeySchema": [{"AttributeName": "sweepBucket", "KeyType": "HASH"},
+                      {"AttributeName": "claimedUntil", "KeyType": "RANGE"}],
+        "Projection": {"ProjectionType": "KEYS_ONLY"},
+    }],
+)
+
+add_service_to_path("order")
+from app import app, outbox_dispatcher  # noqa: E402
+app.logger.setLevel(logging.INFO)
+logging.getLogger("outbox").setLevel(logging.ERROR)
+
+authorizations = ["Bearer " + jwt.encode(
+    {"custom:tenant_id": f"tenant-{i}", "custom:tenant_tier": "basic", "exp": int(time.time()) + 3600},
+    "harness-secret", algorithm="HS256") for i in range(tenant_count)]
+
+
+def post_order(i):
+    client = app.test_client()
+    start = time.perf_counter()
+    response = client.post("/orders", json={"name": f"order-{i}", "products": ["prod-0"]},
+                           headers={"Authorization": authorizations[i % tenant_count]})
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if response.status_code == 503:
+        # the prices could not be looked up, the order was not taken
+        return None, elapsed_ms
+    if response.status_code != 200:
+        raise Exception(f"POST /orders returned {response.status_code}: {response.get_json()}")
+    return response.get_json()["order"]["order_id"], elapsed_ms
+
+
+with ThreadPoolExecutor(max_workers=16) as executor:
+    results = list(executor.map(post_order, range(order_count)))
+order_ids = {order_id for order_id, _ in results if order_id is not None}
+samples = [elapsed_ms for _, elapsed_ms in results]
+print(f"POST /orders: {order_count} orders, {order_count - len(order_ids)} rejected unpriced, "
+      f"p50 {percentile(samples, 0.5):.2f}ms, p99 {percentile(samples, 0.99):.2f}ms, fulfillment stub latency "
+      f"{fulfillment_handler.latency_seconds * 1000:.0f}ms")
+
+
+def post_order_batch(tenant):
+    client = app.test_client()
+    orders = [{"name": f"batch-order-{tenant}-{i}", "products": ["prod-0", "prod-1", "prod-0"]}
+              for i in range(order_count // tenant_count)]
+    response = client.post("/orders:batch", json={"orders": orders}, headers={"Authorization": authorizations[tenant]})
+    if response.status_code == 503:
+        return [], len(orders)
+    if response.status_code != 200:
+        raise Exception(f"POST /orders:batch returned {response.status_code}: {response.get_json()}")
+    results = response.get_json()["results"]
+    return [result["order"]["order_id"] for result in results if result["status"] == "created"], len(results)
+
+
+start = time.perf_counter()
+with ThreadPoolExecutor(max_workers=tenant_count) as executor:
+    batches = list(executor.map(post_order_batch, range(tenant_count)))
+batch_order_ids = {order_id for created, _ in batches for order_id in created}
+order_ids |= batch_order_ids
+print(f"POST /orders:batch: created {len(batch_order_ids)} of {sum(count for _, count in batches)} orders "
+      f"in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+
+def list_orders(authorization):
+    # reads a tenant's orders back page by page
+    client = app.test_client()
+    order_ids = []
+    cursor = None
+    while True:
+        query = {"limit": 7, **({"next": cursor} if cursor else {})}
+        response = client.get("/orders", query_string=query, headers={"Authorization": authorization})
+        if response.status_code != 200:
+            raise Exception(f"GET /orders returned {response.status_code}: {response.get_data(as_text=True)}")
+        body = response.get_json()
+        order_ids.extend(order["order_id"] for order in body["orders"])
+        cursor = body["next"]
+        if cursor is None:
+            return order_ids
+
+
+listed = [order_id for authorization in authorizations for order_id in list_orders(authorization)]
+print(f"GET /orders: listed {len(listed)} orders, missing {len(order_ids - set(listed))}")
+
+outbox_table = dynamodb.Table(os.environ["OUTBOX_TABLE_NAME"])
+start = time.perf_counter()
+while True:
+    pending = outbox_table.scan(Select="COUNT")["Count"]
+    if pending == 0 or time.perf_counter() - start > 120:
+        break
+    time.sleep(0.5)
+missing = order_ids - set(fulfillment_handler.fulfilled)
+print(f"outbox drained in {time.perf_counter() - start:.1f}s, pending {pending}, "
+      f"dispatched {outbox_dispatcher.dispatched}, failed attempts {outbox_dispatcher.failed}, "
+      f"duplicates {len(fulfillment_handler.fulfilled) - len(set(fulfillment_handler.fulfilled))}, "
+      f"unfulfilled {len(missing)}, swept {len(set(fulfillment_handler.swept))}, "
+      f"swept without line items {len(fulfillment_handler.unpriced)}")
+sys.exit(1 if missing or pending or set(listed) != order_ids or fulfillment_handler.unpriced
+         or not fulfillment_handler.swept else 0)
@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Measures the CPU time GET /orders spends turning DynamoDB query pages into
+# a 1 MB response: the previous path (boto3 resource deserialization, a copy
+# per item, Flask's default JSON provider) against the low-level client items
+# converted straight to the response shape and serialized by the fast JSON
+# provider, buffered and in streamed chunks, with orjson and with the stdlib
+# json fallback.
+#
+# usage: python scripts/benchmarks/order_serialization_benchmark.py [rounds] [response_kb]
+import os
+import sys
+import time
+from stub_services import add_service_to_path
+
+rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+response_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+page_size = 1000
+
+os.environ.update({
+    "TABLE_NAME": "orders",
+    "OUTBOX_TABLE_NAME": "order-outbox",
+    "FULFILLMENT_ENDPOINT": "localhost:1",
+    "PRODUCT_ENDPOINT": "localhost:1",
+    "SERVICE_NAME": "order-benchmark",
+    "ADMISSION_CONTROL": "false",
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+})
+add_service_to_path("order")
+from boto3.dynamodb.types import TypeDeserializer  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+from shared import fast_json  # noqa: E402
+import app as order_service  # noqa: E402
+
+app = order_service.app
+deserializer = TypeDeserializer()
+
+
+def raw_order(i):
+    return {
+        "orderId": {"S": f"ord-{i:026d}"},
+        "name": {"S": f"order {i}"},
+        "description": {"S": "a benchmark order with a few products"},
+        "products": {"L": [{"S": f"prod-{i % 50}"}, {"S": f"prod-{i % 7}"}, {"S": "prod-1"}]},
+        "lineItems": {"L": [{"M": {"productId": {"S": f"prod-{j}"}, "unitPrice": {"S": "12.5"},
+                                   "quantity": {"N": "2"}}} for j in range(3)]},
+    }
+
+
+def make_pages():
+    # grow the result until the serialized response reaches response_kb
+    items = []
+    while True:
+        items.extend(raw_order(len(items) + i) for i in range(100))
+        size = len(fast_json.dumps_bytes([order_service.order_from_attributes(item) for item in items]))
+        if size >= response_kb * 1024:
+            break
+    return [(items[start:start + page_size], None) for start in range(0, len(items), page_size)], size
+
+
+def previous(pages):
+    default_provider = DefaultJSONProvider(app)
+    orders = []
+    for items, _ in pages:
+        for item in items:
+            resource_item = {name: deserializer.deserialize(value) for name, value in item.items()}
+            orders.append(order_service.to_order_dict(resource_item))
+    return default_provider.response({"msg": "GET successful!", "orders": orders, "next": None}).get_data()
+
+
+def buffered(pages):
+    orders = [order_service.order_from_attributes(item) for items, _ in pages for item in items]
+    return app.json.response({"msg": "GET successful!", "orders": orders, "next": None}).get_data()
+
+
+def streamed(pages):
+    first_items, _ = pages[0]
+    orders = [order_service.order_from_attributes(item) for item in first_items]
+    return b"".join(order_service.stream_orders_document(orders, iter(pages[1:])))
+
+
+pages, size = make_pages()
+order_count = sum(len(items) for items, _ in pages)
+print(f"{order_count} orders, {size / 1024:.0f} KB response, orjson "
+      f"{'installed' if fast_json.orjson is not None else 'not installed'}")
+print(f"{'implementation':>24} {'cpu ms per MB':>14}")
+orjson = fast_json.orjson
+with app.app_context():
+    for name, fn, use_orjson in (("previous", previous, False), ("fast, stdlib json", buffered, False),
+                                 ("fast, orjson", buffered, True), ("streamed, orjson", streamed, True)):
+        if use_orjson and orjson is None:
+            continue
+        fast_json.orjson = orjson if use_orjson else None
+        fn(pages)
+        start = time.process_time()
+        for _ in range(rounds):
+            body = fn(pages)
+        elapsed = (time.process_time() - start) / rounds
+        print(f"{name:>24} {elapsed * 1000 / (len(body) / 1048576):14.2f}")
@@ -0,0 +1,126 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Starts the product and order services under gunicorn against local
+# stand-ins and reports how long they take to become useful: time until the
+# health check answers (ready), then until one tenant request per worker,
+# sent at once, has been answered (first) and the sum of both. Services are
+# started preloaded and warmed up, the default, and with GUNICORN_PRELOAD=false
+# WARM_UP=false. Also lists the imports that dominate
+# `python -X importtime -c "import app"`.
+#
+# usage: python scripts/benchmarks/startup_benchmark.py [runs] [workers]
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import jwt
+import requests
+from stub_services import (StubDynamoDBHandler, StubHandler, StubTokenVendorHandler, free_port, make_shared_package_dir,
+                           repo_lib, start_stub_server)
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+authorization = "Bearer " + jwt.encode(
+    {"custom:tenant_id": "tenant-0", "custom:tenant_tier": "basic", "exp": int(time.time()) + 3600},
+    "startup-benchmark-secret-of-32-bytes", algorithm="HS256")
+modes = {
+    "preloaded": {"GUNICORN_PRELOAD": "true", "WARM_UP": "true"},
+    "per-worker": {"GUNICORN_PRELOAD": "false", "WARM_UP": "false"},
+}
+
+shared_dir = make_shared_package_dir()
+_, dynamodb_endpoint = start_stub_server(StubDynamoDBHandler, latency_seconds=0.002)
+_, token_vendor_endpoint = start_stub_server(StubTokenVendorHandler)
+_, other_endpoint = start_stub_server(StubHandler)
+base_env = dict(
+    os.environ,
+    PYTHONPATH=shared_dir,
+    GUNICORN_WORKERS=str(workers),
+    AWS_DEFAULT_REGION="us-east-1",
+    AWS_ACCESS_KEY_ID="startup",
+    AWS_SECRET_ACCESS_KEY="startup",
+    AWS_ENDPOINT_URL_DYNAMODB=f"http://{dynamodb_endpoint}",
+    TOKEN_VENDOR_ENDPOINT_PORT=token_vendor_endpoint.split(":")[1],
+    METRICS_FLUSH_INTERVAL_SECONDS="3600",
+    LOG_LEVEL="warning",
+)
+services = {
+    "product": ({"TABLE_NAME": "products", "SERVICE_NAME": "product-startup"}, "/products/health", "/products/prod-0"),
+    "order": ({"TABLE_NAME": "orders", "OUTBOX_TABLE_NAME": "order-outbox", "SERVICE_NAME": "order-startup",
+               "PRODUCT_ENDPOINT": other_endpoint, "FULFILLMENT_ENDPOINT": other_endpoint},
+              "/orders/health", "/orders/ord-0"),
+}
+
+
+def first_request(url):
+    status = requests.get(url, headers={"Authorization": authorization}, timeout=10).status_code
+    if status >= 500:
+        raise Exception(f"{url} failed with {status}")
+
+
+def start_once(app_dir, env, health_path, first_path):
+    port = free_port()
+    # caches and token buckets start empty, as in a new pod
+    state_dir = tempfile.TemporaryDirectory()
+    env = dict(env, PRODUCT_CACHE_PATH=os.path.join(state_dir.name, "product-cache.db"),
+               ADMISSION_BUCKETS_PATH=os.path.join(state_dir.name, "admission-buckets.db"))
+    started = time.perf_counter()
+    server = subprocess.Popen(["gunicorn", "--bind", f"127.0.0.1:{port}"], cwd=app_dir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}{health_path}", timeout=5).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                pass
+            if server.poll() is not None or time.perf_counter() - started > 60:
+                raise Exception(f"{app_dir} did not become ready")
+            time.sleep(0.01)
+        ready = time.perf_counter() - started
+        first_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(first_request, [f"http://127.0.0.1:{port}{first_path}"] * workers))
+        return ready * 1000, (time.perf_counter() - first_started) * 1000
+    finally:
+        server.terminate()
+        server.wait()
+        state_dir.cleanup()
+
+
+def top_imports(app_dir, env, count=8):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=app_dir, env=env,
+                            capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # the imports of app itself are indented by one level
+        if name.startswith("   ") and not name.startswith("    "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+        elif name.strip() == "app":
+            total = int(cumulative) / 1000
+    return total, sorted(imports, reverse=True)[:count]
+
+
+print(f"{workers} workers, median of {runs} starts")
+print(f"{'service':>8} {'mode':>10} {'ready ms':>9} {'first ms':>9} {'total ms':>9}")
+for service, (service_env, health_path, first_path) in services.items():
+    app_dir = os.path.join(repo_lib, service, "app/code")
+    for mode, mode_env in modes.items():
+        env = dict(base_env, **service_env, **mode_env)
+        samples = [start_once(app_dir, env, health_path, first_path) for _ in range(runs)]
+        ready = statistics.median(sample[0] for sample in samples)
+        first = statistics.median(sample[1] for sample in samples)
+        total = statistics.median(sum(sample) for sample in samples)
+        print(f"{service:>8} {mode:>10} {ready:9.0f} {first:9.0f} {total:9.0f}")
+
+for service, (service_env, _, _) in services.items():
+    total, imports = top_imports(os.path.join(repo_lib, service, "app/code"), dict(base_env, **service_env, WARM_UP="false"))
+    print(f"{service}: import app {total:.0f}ms, slowest imports")
+    for cumulative, name in imports:
+        print(f"  {cumulative:8.1f}ms {name}")
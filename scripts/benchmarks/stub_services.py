@@ -0,0 +1,306 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Local stand-ins for the workshop services, used by the benchmarks in this folder.
+import atexit
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import jwt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+
+repo_lib = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../lib"))
+
+
+def make_shared_package_dir():
+    # the services import the shared helpers as the "shared" package
+    shared_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, shared_dir, True)
+    os.symlink(os.path.join(repo_lib, "shared/app/code"), os.path.join(shared_dir, "shared"))
+    return shared_dir
+
+
+def add_service_to_path(service):
+    sys.path.insert(0, make_shared_package_dir())
+    sys.path.insert(0, os.path.join(repo_lib, service, "app/code"))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not let Nagle hold back the body
+    disable_nagle_algorithm = True
+    latency_seconds = 0
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProductHandler(StubHandler):
+    # answers products:batchGet with a 503 for failure_rate of the requests
+    latency_seconds = 0.005
+    failure_rate = 0.0
+    random = random.Random(0)
+
+    def do_GET(self):
+        time.sleep(self.latency_seconds)
+        product_id = self.path.rstrip("/").split("/")[-1]
+        self.send_json(200, {
+            "msg": "GET successful!",
+            "product": {"productId": product_id, "name": product_id, "description": "", "price": "10.0"},
+        })
+
+    def do_POST(self):
+        time.sleep(self.latency_seconds)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.random.random() < self.failure_rate:
+            self.send_json(503, {"msg": "unavailable"})
+            return
+        products = {product_id: {"productId": product_id, "name": product_id, "description": "", "price": "10.0"}
+                    for product_id in body.get("productIds", [])}
+        self.send_json(200, {"msg": "GET successful!", "products": products, "missing": []})
+
+
+class StubDynamoDBHandler(BaseHTTPRequestHandler):
+    # answers the DynamoDB JSON protocol with a single canned item per call,
+    # leaving unprocessed_rate of the writes of a BatchWriteItem unprocessed
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency_seconds = 0.005
+    unprocessed_rate = 0.0
+
+    def do_POST(self):
+        time.sleep(self.latency_seconds)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        operation = self.headers.get("X-Amz-Target", "").split(".")[-1]
+        item = {
+            "tenantId": {"S": "tenant-0"},
+            "productId": {"S": "prod-0"},
+            "orderId": {"S": "ord-0"},
+            "name": {"S": "stub"},
+            "description": {"S": "stub item"},
+            "price": {"S": "10.0"},
+            "products": {"L": [{"S": "prod-0"}]},
+        }
+        if operation in ("Query", "Scan"):
+            response = {"Items": [item], "Count": 1, "ScannedCount": 1}
+        elif operation == "BatchGetItem":
+            response = {"Responses": {table: [item] for table in body.get("RequestItems", {})}, "UnprocessedKeys": {}}
+        elif operation == "BatchWriteItem":
+            unprocessed = {table: [write for write in writes if random.random() < self.unprocessed_rate]
+                           for table, writes in body.get("RequestItems", {}).items()}
+            response = {"UnprocessedItems": {table: writes for table, writes in unprocessed.items() if writes}}
+        else:
+            response = {}
+        payload = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-amz-json-1.0")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTokenVendorHandler(StubHandler):
+    # vends static credentials, enough for local DynamoDB stand-ins
+    def do_GET(self):
+        time.sleep(self.latency_seconds)
+        self.send_json(200, {"Credentials": {
+            "AccessKeyId": "stub",
+            "SecretAccessKey": "stub",
+            "SessionToken": "stub",
+            "Expiration": "2099-01-01T00:00:00+00:00",
+        }})
+
+
+class StubFulfillmentHandler(StubHandler):
+    # answers POST /fulfillments:batch, failing failure_rate of the requests
+    # with a 503 and item_failure_rate of the orders of the others. Orders
+    # sent without a token, as the outbox sweeper sends them, are recorded in
+    # swept, those of them without line items in unpriced
+    latency_seconds = 0.02
+    failure_rate = 0.0
+    item_failure_rate = 0.0
+    fulfilled = []
+    swept = []
+    unpriced = []
+    random = random.Random(0)
+
+    def do_POST(self):
+        time.sleep(self.latency_seconds)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.random.random() < self.failure_rate:
+            self.send_json(503, {"msg": "unavailable"})
+            return
+        results = []
+        for order in body.get("orders", []):
+            if self.headers.get("Authorization", None) is None:
+                self.swept.append(order["order_id"])
+                if order.get("line_items", None) is None:
+                    self.unpriced.append(order["order_id"])
+            status = "failed" if self.random.random() < self.item_failure_rate else "fulfilled"
+            if status == "fulfilled":
+                self.fulfilled.append(order["order_id"])
+            results.append({"order_id": order["order_id"], "status": status})
+        self.send_json(200, {"msg": "Fulfillment batch processed", "results": results})
+
+
+class StubFaultyHandler(StubHandler):
+    # answers any GET or POST after latency_seconds, slow_rate of them after
+    # slow_seconds instead and error_rate of them with a 503. Each request is
+    # logged in requests as (method, X-Request-Deadline-Ms header).
+    latency_seconds = 0.002
+    slow_rate = 0.0
+    slow_seconds = 0.3
+    error_rate = 0.0
+    requests = []
+    random = random.Random(0)
+
+    def do_GET(self):
+        self.answer("GET")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.answer("POST")
+
+    def answer(self, method):
+        self.requests.append((method, self.headers.get("X-Request-Deadline-Ms", None)))
+        slow = self.random.random() < self.slow_rate
+        failed = self.random.random() < self.error_rate
+        time.sleep(self.slow_seconds if slow else self.latency_seconds)
+        if failed:
+            self.send_json(503, {"msg": "unavailable"})
+        else:
+            self.send_json(200, {"msg": "ok"})
+
+
+class LocalJwtIssuer():
+    # stands in for the Cognito user pool: mints RS256 tokens with the claims
+    # the services read and serves the public key as a JWKS for JWKS_URI
+    def __init__(self, kid="local-issuer"):
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        self.kid = kid
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        public_jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        key_set = {"keys": [dict(public_jwk, kid=kid, alg="RS256", use="sig")]}
+        handler = type("StubJwksHandler", (StubHandler,), {"do_GET": lambda self: self.send_json(200, key_set)})
+        self.server, endpoint = start_stub_server(handler)
+        self.jwks_uri = f"http://{endpoint}/.well-known/jwks.json"
+
+    def mint(self, tenant_id, tenant_tier, ttl_seconds=3600):
+        claims = {
+            "sub": f"user-{tenant_id}",
+            "custom:tenant_id": tenant_id,
+            "custom:tenant_tier": tenant_tier,
+            "token_use": "id",
+            "exp": int(time.time()) + ttl_seconds,
+        }
+        return jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": self.kid})
+
+
+class LocalSqsQueue():
+    # implements the subset of the SQS client used by InvoiceConsumer: received
+    # messages stay hidden for their visibility timeout and, unless deleted,
+    # come back in their place in the queue
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.sent = 0
+        self.receipts = 0
+        self.receive_calls = 0
+        self.delete_calls = 0
+
+    def send(self, detail):
+        with self.lock:
+            message_id = str(self.sent)
+            self.sent += 1
+            self.messages[message_id] = {"MessageId": message_id, "Body": json.dumps({"detail": detail}),
+                                         "ReceiptHandle": None, "visible_at": 0}
+        return message_id
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, VisibilityTimeout=30, **kwargs):
+        batch = []
+        with self.lock:
+            self.receive_calls += 1
+            now = time.monotonic()
+            for message in self.messages.values():
+                if len(batch) == MaxNumberOfMessages:
+                    break
+                if message["visible_at"] <= now:
+                    self.receipts += 1
+                    message["ReceiptHandle"] = f"{message['MessageId']}/{self.receipts}"
+                    message["visible_at"] = now + VisibilityTimeout
+                    batch.append({key: message[key] for key in ("MessageId", "ReceiptHandle", "Body")})
+        if not batch:
+            time.sleep(0.05)
+        return {"Messages": batch}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self.lock:
+            self.delete_calls += 1
+            for entry in Entries:
+                message = self._received(entry["ReceiptHandle"])
+                if message is not None:
+                    del self.messages[message["MessageId"]]
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        with self.lock:
+            now = time.monotonic()
+            for entry in Entries:
+                message = self._received(entry["ReceiptHandle"])
+                if message is not None:
+                    message["visible_at"] = now + entry["VisibilityTimeout"]
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def _received(self, receipt_handle):
+        message = self.messages.get(receipt_handle.split("/")[0], None)
+        return message if message is not None and message["ReceiptHandle"] == receipt_handle else None
+
+
+def start_stub_server(handler_class, latency_seconds=None):
+    if latency_seconds is not None:
+        handler_class = type(handler_class.__name__, (handler_class,), {"latency_seconds": latency_seconds})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"127.0.0.1:{server.server_address[1]}"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, timeout_seconds=30):
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        try:
+            with urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise Exception(f"{url} did not become ready")
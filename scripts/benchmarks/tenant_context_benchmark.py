@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Compares the per-request cost of decoding the bearer token with PyJWT against
+# the cached get_tenant_context fast path in the shared helpers.
+#
+# usage: python scripts/benchmarks/tenant_context_benchmark.py [iterations] [tenants]
+import sys
+import time
+import timeit
+import jwt
+from stub_services import make_shared_package_dir
+
+sys.path.insert(0, make_shared_package_dir())
+from shared import helper_functions  # noqa: E402
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+tenant_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+authorizations = []
+for i in range(tenant_count):
+    token = jwt.encode({
+        "sub": f"user-{i}",
+        "custom:tenant_id": f"tenant-{i}",
+        "custom:tenant_tier": "premium" if i % 2 else "basic",
+        "exp": int(time.time()) + 3600,
+    }, "benchmark-secret", algorithm="HS256")
+    authorizations.append(f"Bearer {token}")
+
+
+def uncached():
+    for authorization in authorizations:
+        claims = jwt.decode(authorization.replace("Bearer ", ""), options={"verify_signature": False})
+        helper_functions.TenantContext(claims.get("custom:tenant_id"), claims.get("custom:tenant_tier"))
+
+
+def cached():
+    for authorization in authorizations:
+        helper_functions.get_tenant_context(authorization)
+
+
+rounds = max(1, iterations // tenant_count)
+for name, fn in (("jwt.decode", uncached), ("get_tenant_context", cached)):
+    seconds = timeit.timeit(fn, number=rounds)
+    print(f"{name:>20}: {seconds / (rounds * tenant_count) * 1e6:8.2f} us/request")
+print(f"cache stats: {helper_functions.tenant_context_cache.stats()}")
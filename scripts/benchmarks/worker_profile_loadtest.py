@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Runs the product service under gunicorn with the sync and the async
+# (uvicorn) worker profiles against a local DynamoDB stub and reports
+# requests/sec and tail latency for each.
+#
+# usage: python scripts/benchmarks/worker_profile_loadtest.py [requests] [concurrency] [latency_ms]
+import os
+import subprocess
+import sys
+import time
+import jwt
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from stub_services import StubDynamoDBHandler, free_port, make_shared_package_dir, percentile, repo_lib, start_stub_server, wait_until_ready
+
+total_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+app_dir = os.path.join(repo_lib, "product/app/code")
+authorization = "Bearer " + jwt.encode(
+    {"custom:tenant_id": "tenant-0", "custom:tenant_tier": "basic", "exp": int(time.time()) + 3600},
+    "loadtest-secret", algorithm="HS256")
+
+
+def run_profile(profile, dynamodb_endpoint, shared_dir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        GUNICORN_WORKER_PROFILE=profile,
+        PYTHONPATH=shared_dir,
+        TABLE_NAME="products",
+        SERVICE_NAME="product-loadtest",
+        AWS_DEFAULT_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="loadtest",
+        AWS_SECRET_ACCESS_KEY="loadtest",
+        AWS_ENDPOINT_URL_DYNAMODB=f"http://{dynamodb_endpoint}",
+    )
+    server = subprocess.Popen(["gunicorn", "--bind", f"127.0.0.1:{port}", "--log-level=warning"], cwd=app_dir, env=env)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{port}/products/health")
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+        def timed_request(i):
+            start = time.perf_counter()
+            session.get(f"http://127.0.0.1:{port}/products/prod-{i % 100}", headers={"Authorization": authorization})
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(timed_request, range(total_requests)))
+        elapsed = time.perf_counter() - start
+        print(f"{profile:>6} {total_requests / elapsed:10.1f} {percentile(samples, 0.5):8.2f} "
+              f"{percentile(samples, 0.99):8.2f} {percentile(samples, 0.999):8.2f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+shared_dir = make_shared_package_dir()
+stub, dynamodb_endpoint = start_stub_server(StubDynamoDBHandler, latency_seconds=latency_ms / 1000)
+print(f"{'worker':>6} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}")
+for profile in ("sync", "async"):
+    run_profile(profile, dynamodb_endpoint, shared_dir)
+stub.shutdown()
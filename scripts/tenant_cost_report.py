@@ -0,0 +1,123 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# Rolls the DynamoDB consumption the services meter per tenant (the EMF
+# documents of shared/consumption_metering.py) up into a cost report per
+# tenant: requests, capacity units, payload bytes and throttles, what they
+# cost at on-demand prices and each tenant's share. Tenants using at least
+# --hot-share of a table's capacity, or that were throttled, are flagged as
+# hot. Reads the documents from a CloudWatch log group with Logs Insights, or
+# from a file of EMF JSON lines.
+#
+# usage: python scripts/tenant_cost_report.py --log-group <cloudwatch agent log group> [--hours 24]
+#        python scripts/tenant_cost_report.py --file emf.log
+import argparse
+import json
+import sys
+import time
+
+metric_names = ["DynamoDBRequests", "DynamoDBReadCapacityUnits", "DynamoDBWriteCapacityUnits",
+                "DynamoDBRequestBytes", "DynamoDBResponseBytes", "DynamoDBThrottles"]
+query = ("filter ispresent(Tenant) and ispresent(Table) | stats "
+         + ", ".join(f"sum({name}) as {name}" for name in metric_names)
+         + " by Tenant, TenantTier, Table")
+
+
+def query_log_group(log_group, hours):
+    import boto3
+
+    logs = boto3.client("logs")
+    end = int(time.time())
+    query_id = logs.start_query(logGroupName=log_group, startTime=end - int(hours * 3600), endTime=end,
+                                queryString=query, limit=10000)["queryId"]
+    while True:
+        response = logs.get_query_results(queryId=query_id)
+        if response["status"] not in ("Scheduled", "Running"):
+            break
+        time.sleep(1)
+    if response["status"] != "Complete":
+        raise Exception(f"Query {query_id} ended {response['status']}")
+    return [{field["field"]: field["value"] for field in row} for row in response["results"]]
+
+
+def read_file(path):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                document = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(document, dict) and "Tenant" in document and "Table" in document:
+                rows.append(document)
+    return rows
+
+
+def build_report(rows, read_price, write_price, hot_share):
+    tenants = {}
+    table_units = {}
+    for row in rows:
+        tenant = tenants.setdefault(row["Tenant"], dict({name: 0.0 for name in metric_names}, tier=row.get("TenantTier"), tables={}))
+        units = 0.0
+        for name in metric_names:
+            value = float(row.get(name) or 0)
+            tenant[name] += value
+            if name in ("DynamoDBReadCapacityUnits", "DynamoDBWriteCapacityUnits"):
+                units += value
+        tenant["tables"][row["Table"]] = tenant["tables"].get(row["Table"], 0.0) + units
+        table_units[row["Table"]] = table_units.get(row["Table"], 0.0) + units
+
+    total_cost = 0.0
+    for tenant in tenants.values():
+        tenant["cost"] = (tenant["DynamoDBReadCapacityUnits"] * read_price
+                          + tenant["DynamoDBWriteCapacityUnits"] * write_price) / 1000000
+        total_cost += tenant["cost"]
+    report = []
+    for tenant_id, tenant in tenants.items():
+        table_shares = {table: units / table_units[table] for table, units in tenant["tables"].items() if table_units[table]}
+        top_table = max(tenant["tables"], key=tenant["tables"].get) if tenant["tables"] else None
+        hot_tables = sorted(table for table, share in table_shares.items() if share >= hot_share)
+        report.append({
+            "tenant": tenant_id,
+            "tier": tenant["tier"],
+            "requests": int(tenant["DynamoDBRequests"]),
+            "read_units": tenant["DynamoDBReadCapacityUnits"],
+            "write_units": tenant["DynamoDBWriteCapacityUnits"],
+            "bytes": int(tenant["DynamoDBRequestBytes"] + tenant["DynamoDBResponseBytes"]),
+            "throttles": int(tenant["DynamoDBThrottles"]),
+            "cost": tenant["cost"],
+            "share": tenant["cost"] / total_cost if total_cost else 0.0,
+            "top_table": top_table,
+            "hot_tables": hot_tables,
+            "hot": bool(hot_tables) or tenant["DynamoDBThrottles"] > 0,
+        })
+    return sorted(report, key=lambda entry: entry["cost"], reverse=True)
+
+
+def print_report(report):
+    print(f"{'tenant':<24} {'tier':<10} {'requests':>9} {'RCU':>10} {'WCU':>10} {'MB':>8} "
+          f"{'throttles':>9} {'cost $':>10} {'share':>6}  top table")
+    for entry in report:
+        print(f"{entry['tenant']:<24} {entry['tier'] or '':<10} {entry['requests']:>9} {entry['read_units']:>10.1f} "
+              f"{entry['write_units']:>10.1f} {entry['bytes'] / 1048576:>8.2f} {entry['throttles']:>9} "
+              f"{entry['cost']:>10.4f} {entry['share']:>6.1%}  {entry['top_table'] or ''}"
+              + ("  HOT " + ",".join(entry["hot_tables"]) if entry["hot"] else ""))
+
+
+parser = argparse.ArgumentParser(description="Per-tenant DynamoDB consumption and cost")
+source = parser.add_mutually_exclusive_group(required=True)
+source.add_argument("--log-group", help="log group the services write EMF to")
+source.add_argument("--file", help="file of EMF JSON lines")
+parser.add_argument("--hours", type=float, default=24, help="how far back to query the log group")
+parser.add_argument("--read-price", type=float, default=0.125, help="dollars per million read request units")
+parser.add_argument("--write-price", type=float, default=0.625, help="dollars per million write request units")
+parser.add_argument("--hot-share", type=float, default=0.5, help="share of a table's capacity that makes a tenant hot")
+parser.add_argument("--json", action="store_true", help="print the report as JSON")
+args = parser.parse_args()
+
+rows = query_log_group(args.log_group, args.hours) if args.log_group else read_file(args.file)
+report = build_report(rows, args.read_price, args.write_price, args.hot_share)
+if args.json:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+else:
+    print_report(report)
@@ -128,11 +128,30 @@ export class Cloud9Resources extends Construct {
         iam.ManagedPolicy.fromAwsManagedPolicyName("AWSCloud9Administrator")
       );
 
+      // waits for the environment in short calls, the provider calls it
+      // again until it reports the environment complete
+      const isCompleteLambdaCloud9InstanceUpdater = new aws_lambda.Function(
+        this,
+        "isCompleteLambdaCloud9InstanceUpdater",
+        {
+          runtime: aws_lambda.Runtime.PYTHON_3_11,
+          handler: "index.is_complete",
+          code: aws_lambda.Code.fromAsset(
+            path.join(__dirname, "lambda-custom-resource/")
+          ),
+          timeout: cdk.Duration.minutes(6), // WAIT_SECONDS plus its margin
+          role: onEventLambdaCloud9InstanceUpdater.role,
+        }
+      );
+
       const customResourceProvider = new cr.Provider(
         this,
         "cloud9InstanceUpdater",
         {
           onEventHandler: onEventLambdaCloud9InstanceUpdater,
+          isCompleteHandler: isCompleteLambdaCloud9InstanceUpdater,
+          queryInterval: cdk.Duration.seconds(10),
+          totalTimeout: cdk.Duration.hours(1),
           logRetention: logs.RetentionDays.ONE_DAY,
         }
       );
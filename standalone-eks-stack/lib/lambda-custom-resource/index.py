@@ -2,12 +2,69 @@
 # SPDX-License-Identifier: MIT-0
 import boto3
 import json
+import os
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import WaiterError
 
 ec2_client = boto3.client("ec2")
 cloud9_client = boto3.client("cloud9")
 iam_client = boto3.client("iam")
 
+# Waits poll with exponential backoff and jitter, from poll_initial_delay_seconds
+# up to poll_max_delay_seconds between attempts. on_event waits at most until
+# deadline_margin_seconds before the Lambda timeout. is_complete also gives up
+# after wait_seconds and hands the rest of the wait back to the custom resource
+# framework, which calls it again after its query interval.
+poll_initial_delay_seconds = float(os.environ.get("POLL_INITIAL_DELAY_SECONDS", "1"))
+poll_max_delay_seconds = float(os.environ.get("POLL_MAX_DELAY_SECONDS", "10"))
+wait_seconds = float(os.environ.get("WAIT_SECONDS", "300"))
+deadline_margin_seconds = float(os.environ.get("DEADLINE_MARGIN_SECONDS", "30"))
+# independent IAM and EC2 steps run at the same time, 1 runs them in turn
+provisioning_workers = int(os.environ.get("PROVISIONING_WORKERS", "4"))
+
+role_name = "AWSCloud9SSMAccessRole"
+policy_arn = "arn:aws:iam::aws:policy/AWSCloud9SSMInstanceProfile"
+instance_profile_name = "AWSCloud9SSMInstanceProfile"
+instance_profile_path = "/cloud9/"
+
+
+def _deadline(context, seconds=float("inf")):
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000 - deadline_margin_seconds
+    return time.monotonic() + min(seconds, remaining_seconds)
+
+
+# Calls check until it returns something other than None and returns that.
+# Checks a last time at deadline and returns None if that fails too.
+def _poll(check, deadline):
+    delay = poll_initial_delay_seconds
+    while True:
+        result = check()
+        if result is not None:
+            return result
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            return None
+        time.sleep(min(random.uniform(delay / 2, delay), remaining_seconds))
+        delay = min(delay * 2, poll_max_delay_seconds)
+
+
+# Runs a botocore waiter at its own delay until deadline, raising WaiterError
+# once it passes.
+def _wait(client, waiter_name, deadline, **kwargs):
+    waiter = client.get_waiter(waiter_name)
+    max_attempts = max(1, int((deadline - time.monotonic()) / waiter.config.delay))
+    waiter.wait(WaiterConfig={"MaxAttempts": max_attempts}, **kwargs)
+
+
+# Runs steps that do not depend on each other at the same time and returns
+# their results in order. Raises the error of the first step that failed.
+def _run_concurrently(*steps):
+    with ThreadPoolExecutor(max_workers=provisioning_workers) as executor:
+        futures = [executor.submit(step) for step in steps]
+        return [future.result() for future in futures]
+
 
 def _create_cloud9_ssm_role(role_name):
     role_path = "/service-role/"
@@ -32,18 +89,16 @@ def _create_cloud9_ssm_role(role_name):
     )
 
 
-def _create_cloud9_iam_resources_if_necessary():
+def _create_cloud9_ssm_role_if_necessary(deadline):
     # Check if the IAM role already exists
-    role_name = "AWSCloud9SSMAccessRole"
     try:
         iam_client.get_role(RoleName=role_name)
         print(f"{role_name} role already exists")
     except iam_client.exceptions.NoSuchEntityException:
         print(f"{role_name} does not exist. Creating...")
         _create_cloud9_ssm_role(role_name)
-
-    # Define the policy ARN
-    policy_arn = "arn:aws:iam::aws:policy/AWSCloud9SSMInstanceProfile"
+        # IAM is eventually consistent, a new role is not visible everywhere at once
+        _wait(iam_client, "role_exists", deadline, RoleName=role_name)
 
     # Check if the policy is already attached to the IAM role
     attached_policies = iam_client.list_attached_role_policies(
@@ -57,29 +112,34 @@ def _create_cloud9_iam_resources_if_necessary():
             PolicyArn=policy_arn
         )
 
-    # Define the instance profile name and path
-    instance_profile_name = "AWSCloud9SSMInstanceProfile"
-    instance_profile_path = "/cloud9/"
 
+def _create_cloud9_instance_profile_if_necessary(deadline):
     # Check if the instance profile already exists
     try:
-        iam_client.get_instance_profile(
+        instance_profile = iam_client.get_instance_profile(
             InstanceProfileName=instance_profile_name)
         print(f"{instance_profile_name} instance profile already exists")
     except iam_client.exceptions.NoSuchEntityException:
         print(f"{instance_profile_name} does not exist. Creating...")
         # The instance profile does not exist, so create it
-        iam_client.create_instance_profile(
+        instance_profile = iam_client.create_instance_profile(
             InstanceProfileName=instance_profile_name,
             Path=instance_profile_path
         )
+        _wait(iam_client, "instance_profile_exists", deadline, InstanceProfileName=instance_profile_name)
+    return instance_profile["InstanceProfile"]
+
+
+def _create_cloud9_iam_resources_if_necessary(deadline):
+    # the role and the instance profile are set up at the same time
+    _, instance_profile = _run_concurrently(
+        lambda: _create_cloud9_ssm_role_if_necessary(deadline),
+        lambda: _create_cloud9_instance_profile_if_necessary(deadline),
+    )
 
     # Check if the IAM role is already added to the instance profile
-    instance_profile = iam_client.get_instance_profile(
-        InstanceProfileName=instance_profile_name)
-    instance_profile_roles = instance_profile["InstanceProfile"]["Roles"]
     instance_profile_role_names = [role["RoleName"]
-                                   for role in instance_profile_roles]
+                                   for role in instance_profile["Roles"]]
     if role_name not in instance_profile_role_names:
         print(f"{role_name} is not added to {instance_profile_name}. Adding...")
         # The IAM role is not added to the instance profile, so add it
@@ -91,33 +151,134 @@ def _create_cloud9_iam_resources_if_necessary():
         print(f"{role_name} is already added to {instance_profile_name}")
 
 
+def _environment_status(environment_id):
+    describe_environment_status_response = cloud9_client.describe_environment_status(
+        environmentId=environment_id
+    )
+    print(describe_environment_status_response)
+    return describe_environment_status_response.get("status")
+
+
+def _environment_ready(environment_id):
+    status = _environment_status(environment_id)
+    if status == "error":
+        raise Exception(f"environmentId: {environment_id} failed to start.")
+    return True if status == "ready" else None
+
+
+def _environment_deleted(environment_id):
+    try:
+        return None if _environment_status(environment_id) == "deleting" else True
+    except cloud9_client.exceptions.NotFoundException as e:
+        print(f"caught error: {e}")
+        print(f"environmentId: {environment_id} not found.")
+        return True
+
+
+def _disable_managed_credentials(environment_id):
+    cloud9_update_env_response = cloud9_client.update_environment(
+        environmentId=environment_id,
+        managedCredentialsAction="DISABLE"
+    )
+    print(cloud9_update_env_response)
+
+
+# Swaps the instance profile of the environment's instance for
+# new_instance_profile_name and reboots it. Skips both when an earlier call
+# already did. Returns the instance id, or None if the instance is not running
+# by deadline.
+def _replace_instance_profile(instance_tag_key, instance_tag_value, new_instance_profile_name, deadline):
+    filters = [
+        {
+            "Name": f"tag:{instance_tag_key}",
+            "Values": [instance_tag_value],
+        },
+        {
+            "Name": "instance-state-name",
+            "Values": ["pending", "running"],
+        },
+    ]
+    try:
+        _wait(ec2_client, "instance_running", deadline, Filters=filters)
+    except WaiterError as e:
+        print(f"caught error: {e}")
+        return None
+    response = ec2_client.describe_instances(Filters=filters)
+
+    if "Reservations" in response and len(response["Reservations"]) > 0:
+        for instance in response["Reservations"][0]["Instances"]:
+            instance_id = instance["InstanceId"]
+            print(f"updating instance: {instance_id}")
+            response = ec2_client.describe_iam_instance_profile_associations(
+                Filters=[
+                    {
+                        "Name": "instance-id",
+                        "Values": [instance_id],
+                    },
+                ],
+            )
+
+            if "IamInstanceProfileAssociations" in response and len(response["IamInstanceProfileAssociations"]) > 0:
+                current_association = response["IamInstanceProfileAssociations"][0]
+                if current_association["IamInstanceProfile"]["Arn"].endswith(f"/{new_instance_profile_name}"):
+                    print(f"instance: {instance_id} already uses profile: {new_instance_profile_name}")
+                    return instance_id
+
+                print(
+                    f"updating instance: {instance_id} with profile: {new_instance_profile_name}")
+                ec2_client.replace_iam_instance_profile_association(
+                    AssociationId=current_association["AssociationId"],
+                    IamInstanceProfile={
+                        "Name": new_instance_profile_name,
+                    },
+                )
+
+                print("Rebooting the instance...")
+                ec2_client.reboot_instances(InstanceIds=[instance_id])
+                return instance_id
+            else:
+                raise Exception(
+                    "Instance profile association not found for the instance")
+    else:
+        raise Exception("Instance not found with the specified tag")
+
+
 def on_event(event, context):
     print(event)
     request_type = event["RequestType"]
     if request_type == "Create":
-        return on_create(event)
+        return on_create(event, context)
     if request_type == "Update":
-        return on_update(event)
+        return on_update(event, context)
+    if request_type == "Delete":
+        return on_delete(event, context)
+    raise Exception("Invalid request type: %s" % request_type)
+
+
+# Called by the custom resource framework after on_event, and again after its
+# query interval for as long as it returns IsComplete false.
+def is_complete(event, context):
+    print(event)
+    request_type = event["RequestType"]
+    if request_type in ("Create", "Update"):
+        return is_create_complete(event, context)
     if request_type == "Delete":
-        return on_delete(event)
+        return is_delete_complete(event, context)
     raise Exception("Invalid request type: %s" % request_type)
 
 
-def on_create(event):
+def on_create(event, context):
     props = event["ResourceProperties"]
     c9_name = props["name"]
-    new_instance_profile_name = props["instanceProfileName"]
-    instance_tag_key = props["instanceTagKey"]
-    instance_tag_value = props["instanceTagValue"]
-    instance_id_data_name = props["instanceIdDataName"]
-    env_id_data_name = props["envIdDataName"]
     member_arn = props.get("memberArn")
     connection_type = props.get("connectionType")
     instance_types = props.get("instanceTypes")
     image_id = props.get("imageId")
+    instance_tag_key = props["instanceTagKey"]
+    instance_tag_value = props["instanceTagValue"]
 
     # create AWSCloud9SSMAccessRole and resources if necessary
-    _create_cloud9_iam_resources_if_necessary()
+    _create_cloud9_iam_resources_if_necessary(_deadline(context))
 
     c9_created = False
     for instance_type in instance_types:
@@ -161,86 +322,57 @@ def on_create(event):
     else:
         print("memberArn not set. Skipping add cloud9 member.")
 
-    while True:
-        time.sleep(30)
-        describe_environment_status_response = cloud9_client.describe_environment_status(
-            environmentId=cloud9_environment_id
-        )
-        print(describe_environment_status_response)
-        if describe_environment_status_response.get("status") == "ready":
-            break
-
-    cloud9_update_env_response = cloud9_client.update_environment(
-        environmentId=cloud9_environment_id,
-        managedCredentialsAction="DISABLE"
-    )
-    print(cloud9_update_env_response)
-
-    response = ec2_client.describe_instances(
-        Filters=[
-            {
-                "Name": f"tag:{instance_tag_key}",
-                "Values": [instance_tag_value],
-            },
-            {
-                "Name": "instance-state-name",
-                "Values": ["running"],
-            },
-        ],
-    )
-
-    if "Reservations" in response and len(response["Reservations"]) > 0:
-        for instance in response["Reservations"][0]["Instances"]:
-            instance_id = instance["InstanceId"]
-            print(f"updating instance: {instance_id}")
-            response = ec2_client.describe_iam_instance_profile_associations(
-                Filters=[
-                    {
-                        "Name": "instance-id",
-                        "Values": [instance_id],
-                    },
-                ],
-            )
+    # is_complete waits for the environment and updates its instance
+    return {
+        "PhysicalResourceId": cloud9_environment_id,
+        "Data": {
+            "status": f"creating physical_id: {cloud9_environment_id}",
+        }
+    }
 
-            if "IamInstanceProfileAssociations" in response and len(response["IamInstanceProfileAssociations"]) > 0:
-                current_association_id = response["IamInstanceProfileAssociations"][0]["AssociationId"]
 
-                print(
-                    f"updating instance: {instance_id} with profile: {new_instance_profile_name}")
-                ec2_client.replace_iam_instance_profile_association(
-                    AssociationId=current_association_id,
-                    IamInstanceProfile={
-                        "Name": new_instance_profile_name,
-                    },
-                )
+def is_create_complete(event, context):
+    props = event["ResourceProperties"]
+    cloud9_environment_id = event["PhysicalResourceId"]
+    instance_id_data_name = props["instanceIdDataName"]
+    env_id_data_name = props["envIdDataName"]
+    deadline = _deadline(context, wait_seconds)
 
-                print("Rebooting the instance...")
-                ec2_client.reboot_instances(InstanceIds=[instance_id])
+    if _poll(lambda: _environment_ready(cloud9_environment_id), deadline) is None:
+        print(f"environmentId: {cloud9_environment_id} is not ready yet.")
+        return {"IsComplete": False}
 
-            return {
-                "PhysicalResourceId": cloud9_environment_id,
-                "Data": {
-                    "status": f"successfully deployed physical_id: {cloud9_environment_id}",
-                    instance_id_data_name: instance_id,
-                    env_id_data_name: cloud9_environment_id,
-                }
-            }
-        else:
-            raise Exception(
-                "Instance profile association not found for the instance")
-    else:
-        raise Exception("Instance not found with the specified tag")
+    # the instance's profile is replaced while Cloud9 disables managed credentials
+    instance_id, _ = _run_concurrently(
+        lambda: _replace_instance_profile(props["instanceTagKey"], props["instanceTagValue"],
+                                          props["instanceProfileName"], deadline),
+        lambda: _disable_managed_credentials(cloud9_environment_id),
+    )
+    if instance_id is None:
+        print(f"instance of environmentId: {cloud9_environment_id} is not running yet.")
+        return {"IsComplete": False}
+
+    return {
+        "IsComplete": True,
+        "Data": {
+            "status": f"successfully deployed physical_id: {cloud9_environment_id}",
+            instance_id_data_name: instance_id,
+            env_id_data_name: cloud9_environment_id,
+        }
+    }
 
 
-def on_update(event):
+def on_update(event, context):
     physical_id = event["PhysicalResourceId"]
     print("update resource %s" % (physical_id))
     # for updates, we delete and rebuild to avoid resource conflicts
-    on_delete(event)
-    return on_create(event)
+    on_delete(event, context)
+    if _poll(lambda: _environment_deleted(physical_id), _deadline(context)) is None:
+        raise Exception(f"environmentId: {physical_id} is still deleting.")
+    return on_create(event, context)
 
 
-def on_delete(event):
+def on_delete(event, context):
     physical_id = event["PhysicalResourceId"]
     try:
         cloud9_client.delete_environment(
@@ -250,17 +382,13 @@ def on_delete(event):
     except cloud9_client.exceptions.NotFoundException as e:
         print(f"caught error: {e}")
         return {"Data": {"status": f"physical_id: {physical_id} not found."}}
+    # is_complete waits for the environment to be deleted
+    return {"Data": {"status": f"deleting physical_id: {physical_id}"}}
 
-    try:
-        while True:
-            time.sleep(30)
-            describe_environment_status_response = cloud9_client.describe_environment_status(
-                environmentId=physical_id
-            )
-            print(describe_environment_status_response)
-            if describe_environment_status_response.get("status") != "deleting":
-                break
-    except cloud9_client.exceptions.NotFoundException as e:
-        print(f"caught error: {e}")
-        print(f"environmentId: {physical_id} not found.")
-    return {"Data": {"status": f"successfully deleted physical_id: {physical_id}"}}
+
+def is_delete_complete(event, context):
+    physical_id = event["PhysicalResourceId"]
+    if _poll(lambda: _environment_deleted(physical_id), _deadline(context, wait_seconds)) is None:
+        print(f"environmentId: {physical_id} is still deleting.")
+        return {"IsComplete": False}
+    return {"IsComplete": True, "Data": {"status": f"successfully deleted physical_id: {physical_id}"}}